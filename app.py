@@ -1,14 +1,37 @@
 import os
 import requests
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, g
 from google.transit import gtfs_realtime_pb2
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 from flask_cors import CORS
-import time, sys, threading, math, traceback, re
+import time, sys, threading, math, traceback, re, hashlib, hmac, pickle, gzip, heapq, tempfile, itertools
+from array import array
 from bs4 import BeautifulSoup
-from collections import Counter
+from gtfs_store import StopTimesStore, gtfs_time_to_seconds, format_gtfs_time, save_mapped_columns, open_mapped_columns, parse_shapes_csv, ShapeStore
+from spatial_index import GridIndex, haversine_pairs
+from arrival_zones import ArrivalZoneTracker, EMPTY_ZONE_STATE
+from live_stream import LiveHub
+from memo_cache import LRUCache
+from swap_gate import SwapGate
+from service_calendar import ServiceCalendar, parse_service_date, SECONDS_PER_DAY
+from journey_planner import JourneyPlanner, build_footpaths, build_change_times
+from metrics import Registry, timed_acquire, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from sampling_profiler import profile_thread, save_profile, list_profile_files, load_profile
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from google.protobuf.message import DecodeError
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 CORS(app)
@@ -17,20 +40,121 @@ BASE_PATH = os.path.dirname(os.path.abspath(__file__)) + "/"
 
 # --- Глобални променливи ---
 CACHE_DURATION_SECONDS = 15
-recent_official_arrivals_cache, gps_arrival_cache = {}, {}
 RECENT_OFFICIAL_TTL_SECONDS, GPS_CACHE_TTL_SECONDS = 90, 300
-shared_data_lock = threading.Lock()
 trip_updates_feed_cache, vehicle_positions_feed_cache, alerts_feed_cache = None, None, None
 last_cache_update_timestamp = 0
-routes_data, trips_data, stops_data, active_services = {}, {}, {}, set()
-schedule_by_trip, trip_stops_sequence, stop_to_trips_map = {}, {}, {}
-stop_service_info, trip_stop_sequences_map = {}, {}
-weekday_schedule_ids, holiday_schedule_ids = set(), set()
+# Неизменим снимков индекс над live фийдовете; подменя се цял при всяко обновяване.
+RealtimeSnapshot = namedtuple('RealtimeSnapshot', ['version', 'created_at', 'arrival_predictions', 'vehicle_positions', 'vehicles_by_route', 'stop_predicted_trips', 'vehicle_index', 'gps_estimates', 'stop_vehicle_trips', 'vehicle_records'])
+# Превозните средства на една линия: готови за JSON записи, техните кодирани JSON фрагменти (по реда във фийда)
+# и целият масив във формата на /api/full_route_view.
+RouteVehicles = namedtuple('RouteVehicles', ['seqs', 'records', 'fragments', 'view_fragment'])
+realtime_snapshot = RealtimeSnapshot(0, 0, {}, {}, {}, {}, GridIndex([], [], []), {}, {}, {})
+REALTIME_FEED_URL = os.environ.get('REALTIME_FEED_URL', 'https://sofia-traffic-proxy.pavel-manahilov-box.workers.dev/')
+REALTIME_FEED_NAMES, FEED_TIMEOUT_SECONDS = ("trip-updates", "vehicle-positions", "alerts"), 15
+feed_status = {name: {'etag': None, 'last_modified': None, 'last_attempt': 0, 'last_success': 0, 'error': None} for name in REALTIME_FEED_NAMES}
+http_session = None
+# 'thread' - фонова нишка в app.py; 'asyncio' - цикълът на събития в asgi_app.py (който го задава преди да импортира app).
+REALTIME_REFRESHER = os.environ.get('REALTIME_REFRESHER', 'thread')
+realtime_refresh_lock, realtime_refresh_start_lock = threading.Lock(), threading.Lock()
+first_realtime_load_event = threading.Event()
+realtime_refresher_thread, realtime_refresher_pid = None, None
+processed_alerts_cache, alert_parse_cache, alerts_feed_version = {}, {}, 0
+ALERT_LINES_RE = re.compile(r"(трамвайн\w+|автобусн\w+|тролейбусн\w+)\s+.*?№\s+([\d\s,и]+)", re.I)
+ALERT_LINE_SPLIT_RE = re.compile(r'[\s,и]+')
+routes_data, trips_data, stops_data = {}, {}, {}
+stop_times_store = StopTimesStore.from_rows([])
+stop_service_info = {}
+routes_by_short_name, stop_to_routes_map = {}, {}
+stop_code_to_stop_ids_map, stop_id_to_code_map, stop_code_to_trips_map = {}, {}, {}
+trip_service_ids = []
+stops_spatial_index = GridIndex([], [], [])
+# Координатите на спирките, подредени по индексите на stop_times_store.stop_ids (NaN, ако липсват).
+stop_coord_lats, stop_coord_lons = array('d'), array('d')
+NEARBY_MAX_RADIUS_METERS, NEARBY_DEFAULT_RADIUS_METERS, NEARBY_MAX_LIMIT, NEARBY_DEFAULT_LIMIT = 5000, 500, 200, 20
+BBOX_RANGE_ERROR = "min_lat, min_lon, max_lat and max_lon must be finite, with lat in [-90, 90] and lon in [-180, 180]."
+SCHEDULE_WINDOW_SECONDS = 2 * 3600
+service_calendar = ServiceCalendar([], ())
 sofia_tz = pytz.timezone('Europe/Sofia')
 precomputed_route_details_cache, routes_by_line_cache = None, None
+journey_planner = None
+# Пешеходни разстояния по права: PLAN_ACCESS_RADIUS_METERS до/от точка, PLAN_TRANSFER_RADIUS_METERS между две спирки.
+PLAN_WALK_SPEED_MPS, PLAN_ACCESS_RADIUS_METERS, PLAN_TRANSFER_RADIUS_METERS, PLAN_MAX_ACCESS_STOPS = 1.2, 600, 300, 20
+PLAN_MAX_JOURNEY_SECONDS, PLAN_MAX_DELAY_SECONDS = 3 * 3600, 2 * 3600
+# Време за прекачване на друг курс в същата спирка, освен ако transfers.txt не задава друго за нея.
+PLAN_MIN_CHANGE_SECONDS = 90
+# (версия на снимката, поколение на статичните данни) -> {(trip_idx, отместване на деня): закъснение в секунди}
+plan_trip_delays_cache = (None, {})
+# Формите остават в паметта като компактни колони; кешовете по-горе държат само shape_id.
+shape_store = None
 initialization_lock = threading.Lock()
+caches_ready_event, cache_warm_up_thread = threading.Event(), None
+# След неуспешно изграждане на тежките кешове заявките към тях получават 503, а нов опит започва най-рано след CACHE_WARM_UP_RETRY_SECONDS.
+CACHE_WARM_UP_RETRY_SECONDS, cache_warm_up_error, cache_warm_up_failed_at = 30, None, 0
+CACHE_DEPENDENT_ENDPOINTS = {'get_all_lines_structured', 'get_line_details', 'get_full_route_view', 'get_static_route_view', 'get_shape_for_trip', 'get_journey_plan'}
+SHAPE_PARSE_WORKERS = int(os.environ.get('SHAPE_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+STATIC_SNAPSHOT_FILE, STATIC_SNAPSHOT_VERSION = f'{BASE_PATH}gtfs_static.snapshot', 2
+# Големите колонни данни (stop_times, shapes) са в mmap файлове, които всички gunicorn worker-и споделят само за четене.
+STOP_TIMES_MMAP_FILE, SHAPES_MMAP_FILE = f'{BASE_PATH}gtfs_stop_times.bin', f'{BASE_PATH}gtfs_shapes.bin'
+# Файлова ключалка между процесите: CSV-тата се парсват и снимките се записват от един процес, а останалите ги отварят наготово.
+STATIC_BUILD_LOCK_FILE = f'{BASE_PATH}gtfs_static.lock'
+STATIC_SOURCE_FILES, SHAPES_SOURCE_FILES = ('routes.txt', 'trips.txt', 'stop_times.txt', 'stops.txt', 'calendar_dates.txt'), ('shapes.txt',)
+PLANNER_SOURCE_FILES = ('transfers.txt', 'pathways.txt')
+STATIC_FEED_FILES = STATIC_SOURCE_FILES + SHAPES_SOURCE_FILES + PLANNER_SOURCE_FILES
+static_load_phase_timings = {}
+# Последният инсталиран статичен набор като речник (същите обекти като глобалните променливи по-горе).
+static_tables = {}
+# Нов статичен фийд се открива по размера и mtime на файловете, зарежда се изцяло във фонов режим
+# (заедно с тежките кешове и готовите отговори) и се подменя наведнъж; 0 изключва проверката.
+STATIC_RELOAD_CHECK_SECONDS = int(os.environ.get('STATIC_RELOAD_CHECK_SECONDS', 60))
+static_feed_signature, static_reload_thread, static_reload_pid, static_reload_start_lock = None, None, None, threading.Lock()
+static_reload_status = {'generation': 0, 'loaded_at': None, 'last_check': None, 'last_reload_seconds': None, 'last_error': None, 'failed_signature': None}
+# Заявките и цикълът за live данни четат статичните данни под споделен достъп, а подмяната им е изключителна.
+static_data_gate = SwapGate()
+# Готови (сериализирани и компресирани) тела на статичните ендпойнти; изчистват се при всяко ново зареждане на статичните данни.
+prepared_responses_cache = {}
+STATIC_CACHE_CONTROL = 'public, max-age=300'
 ARRIVAL_ZONE_METERS, DEPARTURE_ZONE_METERS, HYBRID_TRIGGER_ZONE_METERS = 50, 70, 20
 AVG_SPEED_MPS = {'0': 6.9, '3': 5.5, '11': 6.0, 'DEFAULT': 5.5}
+# Състоянието на зоните на пристигане се обновява само от цикъла за live данни; заявките го четат без ключалки.
+arrival_zone_tracker = ArrivalZoneTracker(ARRIVAL_ZONE_METERS, DEPARTURE_ZONE_METERS, RECENT_OFFICIAL_TTL_SECONDS, GPS_CACHE_TTL_SECONDS)
+arrival_zone_state = EMPTY_ZONE_STATE
+# Готовите списъци с пристигания по (перони, версия на снимката, на зоните и на alerts, минута); изчиства се при смяна на някоя от версиите.
+arrivals_cache = LRUCache(int(os.environ.get('ARRIVALS_CACHE_MAX_ENTRIES', 4096)))
+LIVE_STREAM_MAX_CLIENTS, LIVE_STREAM_MAX_KEYS, LIVE_STREAM_KEEPALIVE_SECONDS = int(os.environ.get('LIVE_STREAM_MAX_CLIENTS', 100)), 50, 20
+# В gunicorn gthread worker всеки отворен /api/stream държи нишка до затварянето си, затова там post_worker_init
+# (gunicorn.conf.py) вика limit_live_streams_to_threads(); иначе на процес важи LIVE_STREAM_MAX_CLIENTS.
+LIVE_STREAM_RESERVED_THREADS = max(int(os.environ.get('LIVE_STREAM_RESERVED_THREADS', 2)), 2)
+LIVE_STREAM_PROCESS_CLIENTS = LIVE_STREAM_MAX_CLIENTS
+# Всеки процес брои своите заявки. Под gunicorn (METRICS_DIR се задава в gunicorn.conf.py) worker-ите записват стойностите си
+# в METRICS_DIR и /metrics връща сбора на броячите и хистограмите от всички, а моментните стойности - по pid; без нея са само на този процес.
+metrics_registry = Registry(os.environ.get('METRICS_DIR') or None)
+REQUEST_SECONDS = metrics_registry.histogram('sofia_http_request_duration_seconds', 'Време за обработка на заявка по ендпойнт.', ('endpoint', 'method', 'status'))
+FEED_FETCH_SECONDS = metrics_registry.histogram('sofia_realtime_fetch_duration_seconds', 'Време за HTTP заявката към realtime фийд.', ('feed',))
+FEED_PARSE_SECONDS = metrics_registry.histogram('sofia_realtime_parse_duration_seconds', 'Време за парсване на realtime фийд.', ('feed',))
+FEED_PAYLOAD_BYTES = metrics_registry.gauge('sofia_realtime_payload_bytes', 'Размер на последния изтеглен realtime фийд.', ('feed',))
+FEED_FETCHES = metrics_registry.counter('sofia_realtime_fetches_total', 'Заявки към realtime фийдовете по резултат (ok, not_modified, error).', ('feed', 'result'))
+FEED_AGE_SECONDS = metrics_registry.gauge('sofia_realtime_feed_age_seconds', 'Секунди от последното успешно изтегляне на фийда.', ('feed',))
+REFRESH_SECONDS = metrics_registry.histogram('sofia_realtime_refresh_duration_seconds', 'Продължителност на един цикъл за обновяване на live данните.')
+SNAPSHOT_BUILD_SECONDS = metrics_registry.histogram('sofia_realtime_snapshot_build_duration_seconds', 'Време за изграждане на RealtimeSnapshot.')
+SNAPSHOT_AGE_SECONDS = metrics_registry.gauge('sofia_realtime_snapshot_age_seconds', 'Възраст на текущата live снимка.')
+SNAPSHOT_VERSION = metrics_registry.gauge('sofia_realtime_snapshot_version', 'Версия на текущата live снимка.')
+LOCK_WAIT_SECONDS = metrics_registry.histogram('sofia_lock_wait_seconds', 'Време за чакане на ключалка или събитие.', ('lock',), buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10, 60))
+PREPARED_RESPONSES = metrics_registry.counter('sofia_prepared_responses_total', 'Готови статични отговори по резултат (hit, miss, not_modified).', ('result',))
+ARRIVALS_CACHE_REQUESTS = metrics_registry.counter('sofia_arrivals_cache_requests_total', 'Търсения в кеша на пристиганията по резултат.', ('result',))
+ARRIVALS_CACHE_EVICTIONS = metrics_registry.counter('sofia_arrivals_cache_evictions_total', 'Изхвърлени записи от кеша на пристиганията.')
+ARRIVALS_CACHE_INVALIDATIONS = metrics_registry.counter('sofia_arrivals_cache_invalidations_total', 'Изчиствания на кеша на пристиганията.')
+ARRIVALS_CACHE_ENTRIES = metrics_registry.gauge('sofia_arrivals_cache_entries', 'Записи в кеша на пристиганията.')
+STATIC_PHASE_SECONDS = metrics_registry.gauge('sofia_static_load_phase_seconds', 'Продължителност на фазите при последното статично зареждане.', ('phase',))
+STATIC_GENERATION = metrics_registry.gauge('sofia_static_generation', 'Брой инсталирани статични набори (1 след старта, +1 при всяко презареждане).')
+LIVE_SUBSCRIBERS = metrics_registry.gauge('sofia_live_stream_subscribers', 'Отворени /api/stream връзки.')
+PROCESS_RSS_BYTES = metrics_registry.gauge('process_resident_memory_bytes', 'Резидентна памет на процеса.')
+# Профилиране на отделна заявка: заглавие X-Profile със стойността на PROFILE_TOKEN (без токен профилирането е изключено).
+# Профилите са JSON файлове в PROFILE_DIR, общ за всички worker-и, и се четат от /api/debug/profiles.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'sofia-traffic-profiles'))
+PROFILE_SAMPLE_INTERVAL_SECONDS, PROFILE_KEEP = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 1)) / 1000, 200
+PROFILE_ID_RE = re.compile(r'\d+-\d+-\d+')
+profile_sequence = itertools.count(1)
 
 # --- Хелпър функции ---
 def haversine_distance(lat1, lon1, lat2, lon2):
@@ -41,150 +165,469 @@ def haversine_distance(lat1, lon1, lat2, lon2):
         return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     except (ValueError, TypeError): return None
 
+def _build_realtime_snapshot(version, trip_updates_feed, vehicle_positions_feed):
+    arrival_predictions, vehicle_positions, vehicles_by_route, stop_predicted_trips, stop_vehicle_trips, vehicle_points, vehicle_records = {}, {}, {}, {}, {}, [], {}
+    if trip_updates_feed:
+        for e in trip_updates_feed.entity:
+            if e.HasField('trip_update'):
+                arrival_predictions[e.trip_update.trip.trip_id] = {stu.stop_id: stu.arrival.time for stu in e.trip_update.stop_time_update if stu.HasField('arrival') and stu.arrival.time > 0}
+        for t_id, preds in arrival_predictions.items():
+            for s_id in preds:
+                if s_id not in stop_predicted_trips: stop_predicted_trips[s_id] = set()
+                stop_predicted_trips[s_id].add(t_id)
+    if vehicle_positions_feed:
+        route_entries = {}
+        for seq, e in enumerate(vehicle_positions_feed.entity):
+            if not e.HasField('vehicle'): continue
+            v, t_id = e.vehicle, e.vehicle.trip.trip_id
+            vehicle_positions[t_id] = e.vehicle
+            if e.vehicle.HasField('position'): vehicle_points.append((t_id, e.vehicle.position.latitude, e.vehicle.position.longitude))
+            for s_id, _ in stop_times_store.get_trip_stops(t_id):
+                if s_id not in stop_vehicle_trips: stop_vehicle_trips[s_id] = set()
+                stop_vehicle_trips[s_id].add(t_id)
+            trip_info = trips_data.get(t_id)
+            route_info = routes_data.get(trip_info.get('route_id')) if trip_info else None
+            if route_info:
+                r_name = route_info.get('route_short_name')
+                record = {"latitude": v.position.latitude if v.HasField('position') else None, "longitude": v.position.longitude if v.HasField('position') else None, "trip_id": t_id, "route_name": r_name, "route_type": route_info.get('route_type', ''), "destination": trip_info.get('trip_headsign', 'Н/И'), "next_stop_id": v.stop_id if v.HasField('stop_id') else None, "stop_sequence": v.current_stop_sequence if v.HasField('current_stop_sequence') else None}
+                vehicle_records[t_id] = record
+                if r_name not in route_entries: route_entries[r_name] = []
+                route_entries[r_name].append((seq, record))
+        vehicles_by_route = {r_name: _build_route_vehicles(entries) for r_name, entries in route_entries.items()}
+    return RealtimeSnapshot(version, time.time(), arrival_predictions, vehicle_positions, vehicles_by_route, stop_predicted_trips, GridIndex.from_points(vehicle_points), _build_gps_estimates(vehicle_positions), stop_vehicle_trips, vehicle_records)
+
+def _encode_json(payload):
+    # Същата сериализация като jsonify (без завършващия нов ред).
+    return app.json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+def _build_route_vehicles(entries):
+    records = [record for _, record in entries]
+    view_records = [{"latitude": record["latitude"] if record["latitude"] is not None else 0, "longitude": record["longitude"] if record["longitude"] is not None else 0, "trip_id": record["trip_id"], "route_name": record["route_name"], "route_type": record["route_type"], "destination": record["destination"]} for record in records]
+    return RouteVehicles([seq for seq, _ in entries], records, [_encode_json(record) for record in records], _encode_json(view_records))
+
+def _build_gps_estimates(vehicle_positions):
+    # Веднъж на снимка: разстоянието от всяко превозно средство до всяка спирка от курса му (наведнъж за всички редове)
+    # и хибридното ETA за спирките след следващата, ако превозното средство е в HYBRID_TRIGGER_ZONE_METERS от нея.
+    store, trips = stop_times_store, []
+    v_lats, v_lons, s_lats, s_lons = array('d'), array('d'), array('d'), array('d')
+    for t_id, vehicle in vehicle_positions.items():
+        rows = store.trip_rows(t_id)
+        if not rows or not vehicle.HasField('position'): continue
+        trips.append((t_id, vehicle, rows, len(v_lats)))
+        v_lats.extend([vehicle.position.latitude] * len(rows)); v_lons.extend([vehicle.position.longitude] * len(rows))
+        for r in rows:
+            s_idx = store.row_stop_idx[r]
+            s_lats.append(stop_coord_lats[s_idx]); s_lons.append(stop_coord_lons[s_idx])
+    dists, estimates = haversine_pairs(v_lats, v_lons, s_lats, s_lons), {}
+    for t_id, vehicle, rows, base in trips:
+        trip_dists, etas = dists[base:base + len(rows)], None
+        next_row = store.find_trip_stop_row(t_id, vehicle.stop_id) if vehicle.HasField('stop_id') and vehicle.stop_id else None
+        if next_row is not None and trip_dists[next_row - rows.start] < HYBRID_TRIGGER_ZONE_METERS:
+            route_info = routes_data.get(trips_data.get(t_id, {}).get('route_id'), {})
+            avg_speed = AVG_SPEED_MPS.get(route_info.get('route_type', 'DEFAULT'), AVG_SPEED_MPS['DEFAULT'])
+            v_speed = vehicle.position.speed if vehicle.position.HasField('speed') and vehicle.position.speed > 1 else avg_speed
+            if v_speed > 0:
+                next_seq, etas = store.row_sequence[next_row], {}
+                for r in rows:
+                    if store.row_sequence[r] > next_seq and not math.isnan(trip_dists[r - rows.start]): etas[r] = max(0, round((trip_dists[r - rows.start] / v_speed) / 60))
+        estimates[t_id] = (rows.start, trip_dists, etas)
+    return estimates
+
+def _iter_official_arrivals(snapshot):
+    for t_id, preds in snapshot.arrival_predictions.items():
+        for s_id, pred_ts in preds.items(): yield (t_id, s_id), pred_ts
+
+def _iter_gps_distances(snapshot):
+    store = stop_times_store
+    for t_id, (start, trip_dists, _) in snapshot.gps_estimates.items():
+        # При повтаряща се спирка в курса важи последният ред, както във find_trip_stop_row.
+        by_stop = {store.stop_ids[store.row_stop_idx[start + k]]: dist for k, dist in enumerate(trip_dists)}
+        for s_id, dist in by_stop.items(): yield (t_id, s_id), (None if math.isnan(dist) else dist)
+
+def get_gps_estimate(snapshot, t_id, stop_id):
+    # (разстояние до спирката в метри, хибридно ETA в минути); None там, където няма данни.
+    estimate = snapshot.gps_estimates.get(t_id)
+    if estimate is None: return None, None
+    r = stop_times_store.find_trip_stop_row(t_id, stop_id)
+    if r is None: return None, None
+    start, trip_dists, etas = estimate
+    dist = trip_dists[r - start]
+    return (None if math.isnan(dist) else dist), (etas.get(r) if etas else None)
+
+def _create_http_session():
+    session = requests.Session()
+    for prefix in ('https://', 'http://'): session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=len(REALTIME_FEED_NAMES)))
+    return session
+
+def feed_request_headers(feed_name):
+    status = feed_status[feed_name]
+    headers = {}
+    if status['etag']: headers['If-None-Match'] = status['etag']
+    if status['last_modified']: headers['If-Modified-Since'] = status['last_modified']
+    status['last_attempt'] = time.time()
+    return headers
+
+def accept_feed_response(feed_name, status_code, content, headers):
+    # Общата част на синхронното и асинхронното теглене (след raise_for_status): None при 304, иначе парснатият фийд.
+    status = feed_status[feed_name]
+    if status_code == 304:
+        FEED_FETCHES.inc(feed=feed_name, result='not_modified')
+        status['last_success'], status['error'] = time.time(), None
+        return None
+    FEED_PAYLOAD_BYTES.set(len(content), feed=feed_name)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    with FEED_PARSE_SECONDS.time(feed=feed_name): feed.ParseFromString(content)
+    FEED_FETCHES.inc(feed=feed_name, result='ok')
+    status['etag'], status['last_modified'] = headers.get('ETag'), headers.get('Last-Modified')
+    status['last_success'], status['error'] = time.time(), None
+    return feed
+
+def record_feed_error(feed_name, e):
+    FEED_FETCHES.inc(feed=feed_name, result='error')
+    feed_status[feed_name]['error'] = str(e)
+    print(f"КРИТИЧНА ГРЕШКА при мрежова заявка ({feed_name}): {e}", file=sys.stderr)
+
+def _fetch_feed(feed_name):
+    headers = feed_request_headers(feed_name)
+    with FEED_FETCH_SECONDS.time(feed=feed_name):
+        response = http_session.get(REALTIME_FEED_URL, params={'feed': feed_name}, headers=headers, timeout=FEED_TIMEOUT_SECONDS)
+    if response.status_code != 304: response.raise_for_status()
+    return accept_feed_response(feed_name, response.status_code, response.content, response.headers)
+
+def refresh_realtime_feeds():
+    with timed_acquire(realtime_refresh_lock, LOCK_WAIT_SECONDS, lock='realtime_refresh_lock'):
+        print(f"--- [CACHE] Обновяване на live данни...", file=sys.stderr)
+        start_time = time.time()
+        # Трите фийда се теглят паралелно; заявките продължават да четат последната успешна снимка.
+        new_feeds = {}
+        with ThreadPoolExecutor(max_workers=len(REALTIME_FEED_NAMES), thread_name_prefix='feed-fetch') as executor:
+            futures = {name: executor.submit(_fetch_feed, name) for name in REALTIME_FEED_NAMES}
+            for feed_name, future in futures.items():
+                try:
+                    feed = future.result()
+                    if feed is not None: new_feeds[feed_name] = feed
+                except (requests.RequestException, DecodeError) as e: record_feed_error(feed_name, e)
+        install_realtime_feeds(new_feeds)
+        REFRESH_SECONDS.observe(time.time() - start_time)
+        print(f"--- [CACHE] Обновяването приключи за {(time.time() - start_time) * 1000:.2f} мс.", file=sys.stderr)
+
+def install_realtime_feeds(new_feeds):
+    # new_feeds: {име: парснат фийд} само за фийдовете, които са се променили. Вика се под realtime_refresh_lock.
+    global trip_updates_feed_cache, vehicle_positions_feed_cache, alerts_feed_cache, last_cache_update_timestamp, realtime_snapshot, processed_alerts_cache, alerts_feed_version, arrival_zone_state
+    # Снимката и пристиганията се смятат върху статичните данни, затова не бива да се разминат с подмяна на фийда.
+    with timed_acquire(static_data_gate.shared(), LOCK_WAIT_SECONDS, lock='static_data_gate'):
+        versions_before = (realtime_snapshot.version, arrival_zone_state.version, alerts_feed_version)
+        if 'alerts' in new_feeds:
+            processed_alerts_cache, alerts_feed_cache = _build_processed_alerts(new_feeds['alerts']), new_feeds['alerts']
+            alerts_feed_version += 1
+        if 'trip-updates' in new_feeds or 'vehicle-positions' in new_feeds or realtime_snapshot.version == 0:
+            trip_updates_feed = new_feeds.get('trip-updates', trip_updates_feed_cache)
+            vehicle_positions_feed = new_feeds.get('vehicle-positions', vehicle_positions_feed_cache)
+            with SNAPSHOT_BUILD_SECONDS.time(): snapshot = _build_realtime_snapshot(realtime_snapshot.version + 1, trip_updates_feed, vehicle_positions_feed)
+            trip_updates_feed_cache, vehicle_positions_feed_cache, realtime_snapshot = trip_updates_feed, vehicle_positions_feed, snapshot
+        # Зоните се обновяват на всеки цикъл, защото официалните прогнози стигат 0 мин. и без нов фийд.
+        arrival_zone_state = arrival_zone_tracker.update(int(time.time()), _iter_official_arrivals(realtime_snapshot), _iter_gps_distances(realtime_snapshot))
+        if (realtime_snapshot.version, arrival_zone_state.version, alerts_feed_version) != versions_before: arrivals_cache.clear()
+        last_cache_update_timestamp = time.time()
+        first_realtime_load_event.set()
+        # Абонатите на /api/stream получават промените веднъж на цикъл, изчислени веднъж за всяка спирка/линия.
+        live_hub.publish()
+
+def _realtime_refresher_loop():
+    while True:
+        try: refresh_realtime_feeds()
+        except Exception as e:
+            print(f"КРИТИЧНА ГРЕШКА в обновяването на live данни: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+        time.sleep(CACHE_DURATION_SECONDS)
+
+def start_realtime_refresher():
+    global realtime_refresher_thread, realtime_refresher_pid, http_session, realtime_refresh_lock, live_hub
+    with realtime_refresh_start_lock:
+        # Нишките, ключалките и отворените връзки не оцеляват смислено след fork (gunicorn --preload), затова проверяваме и PID-а.
+        if realtime_refresher_thread and realtime_refresher_thread.is_alive() and realtime_refresher_pid == os.getpid(): return
+        if realtime_refresher_pid != os.getpid(): http_session, realtime_refresh_lock, live_hub = _create_http_session(), threading.Lock(), _create_live_hub()
+        realtime_refresher_pid = os.getpid()
+        # В режим 'asyncio' цикълът за обновяване е в asgi_app.py; тук се подготвят само ключалката и хъбът на процеса.
+        if REALTIME_REFRESHER != 'thread': return
+        realtime_refresher_thread = threading.Thread(target=_realtime_refresher_loop, name='realtime-refresher', daemon=True)
+        realtime_refresher_thread.start()
+
 def refresh_realtime_cache_if_needed():
-    global trip_updates_feed_cache, vehicle_positions_feed_cache, alerts_feed_cache, last_cache_update_timestamp
-    with shared_data_lock:
-        if time.time() - last_cache_update_timestamp > CACHE_DURATION_SECONDS:
-            try:
-                print(f"--- [CACHE] Обновяване на live данни...", file=sys.stderr)
-                start_time = time.time()
-                for feed_name in ["trip-updates", "vehicle-positions", "alerts"]:
-                    url = f"https://sofia-traffic-proxy.pavel-manahilov-box.workers.dev/?feed={feed_name}"
-                    response = requests.get(url, timeout=15)
-                    if response.status_code == 200:
-                        feed = gtfs_realtime_pb2.FeedMessage()
-                        feed.ParseFromString(response.content)
-                        if feed_name == "trip-updates": trip_updates_feed_cache = feed
-                        elif feed_name == "vehicle-positions": vehicle_positions_feed_cache = feed
-                        else: alerts_feed_cache = feed
-                last_cache_update_timestamp = time.time()
-                print(f"--- [CACHE] Обновяването приключи за {(time.time() - start_time) * 1000:.2f} мс.", file=sys.stderr)
-            except requests.RequestException as e: print(f"КРИТИЧНА ГРЕШКА при мрежова заявка: {e}", file=sys.stderr)
+    start_realtime_refresher()
+    # Блокираме само докато няма нито една снимка; след това винаги връщаме последната налична.
+    if not first_realtime_load_event.is_set(): first_realtime_load_event.wait(FEED_TIMEOUT_SECONDS + 1)
+
+def get_feed_staleness():
+    now = time.time()
+    return {name: {"age_seconds": round(now - st['last_success'], 1) if st['last_success'] else None, "last_error": st['error']} for name, st in feed_status.items()}
+
+def _process_alert(alert):
+    alert_text, route_keys = "Няма подробно описание.", []
+    def add_alert_to_route(route_info):
+        if route_info:
+            r_name, r_type = route_info.get('route_short_name'), route_info.get('route_type')
+            if r_name and r_type and f"{r_name}-{r_type}" not in route_keys: route_keys.append(f"{r_name}-{r_type}")
+    if alert.HasField('description_text') and alert.description_text.translation:
+        alert_text = BeautifulSoup(alert.description_text.translation[0].text, "html.parser").get_text(separator='\n').strip()
+    if alert_text:
+        for v_type, names in ALERT_LINES_RE.findall(alert_text):
+            for code, prefix in {'0':'трамвайн', '3':'автобусн', '11':'тролейбусн'}.items():
+                if v_type.lower().startswith(prefix):
+                    for name in set(n for n in ALERT_LINE_SPLIT_RE.split(names) if n):
+                        for r_info in routes_by_short_name.get(name, []):
+                            if r_info.get('route_type') == code: add_alert_to_route(r_info)
+                    break
+    for ie in alert.informed_entity:
+        if ie.HasField('route_id'): add_alert_to_route(routes_data.get(ie.route_id))
+        elif ie.HasField('trip') and ie.trip.HasField('trip_id'):
+            trip_info = trips_data.get(ie.trip.trip_id)
+            if trip_info and 'route_id' in trip_info: add_alert_to_route(routes_data.get(trip_info['route_id']))
+        elif ie.HasField('stop_id'):
+            for r_id in stop_to_routes_map.get(ie.stop_id, []): add_alert_to_route(routes_data.get(r_id))
+    return alert_text, route_keys
+
+def _build_processed_alerts(alerts_feed):
+    global alert_parse_cache
+    alerts_by_composite_key, parsed_alerts = {}, {}
+    for entity in alerts_feed.entity:
+        if not entity.HasField('alert'): continue
+        # Непроменените предупреждения не се парсват отново при следващо обновяване.
+        content_hash = hashlib.sha1(entity.alert.SerializeToString(deterministic=True)).hexdigest()
+        parsed_alerts[content_hash] = alert_parse_cache.get(content_hash) or _process_alert(entity.alert)
+        alert_text, route_keys = parsed_alerts[content_hash]
+        for key in route_keys:
+            if key not in alerts_by_composite_key: alerts_by_composite_key[key] = []
+            if alert_text not in alerts_by_composite_key[key]: alerts_by_composite_key[key].append(alert_text)
+    alert_parse_cache = parsed_alerts
+    return alerts_by_composite_key
 
 def get_processed_alerts():
-    if not alerts_feed_cache: return {}
-    alerts_by_composite_key = {}
-    routes_by_short_name = {}
+    return processed_alerts_cache
+
+def _log_phase(phase, start_time):
+    static_load_phase_timings[phase] = time.time() - start_time
+    print(f"--- [Startup] {phase}: {static_load_phase_timings[phase] * 1000:.0f} мс", file=sys.stderr)
+
+def _source_signature(filenames):
+    signature = {}
+    for name in filenames:
+        try: st = os.stat(f'{BASE_PATH}{name}'); signature[name] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError: signature[name] = None
+    return signature
+
+def _snapshot_is_current(header, sources):
+    # Снимката е валидна, ако е от същата версия и всеки наличен CSV файл е непроменен спрямо нея.
+    return header.get('version') == STATIC_SNAPSHOT_VERSION and all(sig is None or header['sources'].get(name) == sig for name, sig in sources.items())
+
+def _load_snapshot(path, sources):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f) if _snapshot_is_current(pickle.load(f), sources) else None
+    except FileNotFoundError: return None
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError, ValueError) as e:
+        print(f"Снимката {path} не може да се използва: {e}", file=sys.stderr)
+        return None
+
+def _open_mapped_stop_times(sources):
+    try:
+        store, meta = StopTimesStore.open_mapped(STOP_TIMES_MMAP_FILE)
+        return store if _snapshot_is_current(meta, sources) else None
+    except FileNotFoundError: return None
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        print(f"Снимката {STOP_TIMES_MMAP_FILE} не може да се използва: {e}", file=sys.stderr)
+        return None
+
+def _save_snapshot(path, sources, data):
+    if any(sig is None for sig in sources.values()): return
+    try:
+        # Записът е под _static_build_lock(); временният файл е по PID за системите без fcntl, където ключалката липсва.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': STATIC_SNAPSHOT_VERSION, 'sources': sources}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e: print(f"Снимката {path} не може да се запише: {e}", file=sys.stderr)
+
+@contextmanager
+def _static_build_lock():
+    if fcntl is None:
+        yield
+        return
+    try: lock_file = open(STATIC_BUILD_LOCK_FILE, 'a')
+    except OSError as e:
+        print(f"Ключалката {STATIC_BUILD_LOCK_FILE} не може да се отвори, процесът зарежда данните самостоятелно: {e}", file=sys.stderr)
+        yield
+        return
+    with lock_file:
+        wait_start = time.perf_counter()
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - wait_start, lock='static_build_file_lock')
+        try: yield
+        finally: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _parse_static_csv():
+    phase_start = time.time()
+    with open(f'{BASE_PATH}routes.txt', mode='r', encoding='utf-8-sig') as f: routes_data = {r['route_id']: r for r in csv.DictReader(f)}
+    IMMUNE_TROLLEYBUS_ROUTE_IDS = {'TB10','TB9','TB32','TB1','TB3','TB6','TB7','TB4','TB8','TB2','TB27','TB30','TB21','TB40'}
     for r_id, r_info in routes_data.items():
+        if r_info.get('route_type') == '11' and r_id not in IMMUNE_TROLLEYBUS_ROUTE_IDS: r_info['route_type'] = '3'
+    routes_by_short_name = {}
+    for r_info in routes_data.values():
         name = r_info.get('route_short_name')
         if name and name not in routes_by_short_name: routes_by_short_name[name] = []
         if name: routes_by_short_name[name].append(r_info)
-    def add_alert_to_route(route_info, alert_text):
+    with open(f'{BASE_PATH}trips.txt', mode='r', encoding='utf-8-sig') as f: trips_data = {r['trip_id']: r for r in csv.DictReader(f)}
+    _log_phase('csv_routes_trips', phase_start)
+    phase_start = time.time()
+    stop_times_store = StopTimesStore.from_rows(_iter_stop_times_rows())
+    _log_phase('csv_stop_times', phase_start)
+    phase_start = time.time()
+    trip_service_ids = [trips_data.get(t_id, {}).get('service_id') for t_id in stop_times_store.trip_ids]
+    used_stop_ids = set(stop_times_store.stop_ids)
+    stop_service_info, stop_to_routes_map = {}, {}
+    for t_idx, t_id in enumerate(stop_times_store.trip_ids):
+        trip_info = trips_data.get(t_id)
+        if not trip_info: continue
+        route_info = routes_data.get(trip_info.get('route_id'))
+        transport_type = None
         if route_info:
-            r_name, r_type = route_info.get('route_short_name'), route_info.get('route_type')
-            if r_name and r_type:
-                key = f"{r_name}-{r_type}"
-                if key not in alerts_by_composite_key: alerts_by_composite_key[key] = []
-                if alert_text not in alerts_by_composite_key[key]: alerts_by_composite_key[key].append(alert_text)
-    for entity in alerts_feed_cache.entity:
-        if entity.HasField('alert'):
-            alert = entity.alert; alert_text = "Няма подробно описание."
-            if alert.HasField('description_text') and alert.description_text.translation:
-                alert_text = BeautifulSoup(alert.description_text.translation[0].text, "html.parser").get_text(separator='\n').strip()
-            if alert_text:
-                for v_type, names in re.findall(r"(трамвайн\w+|автобусн\w+|тролейбусн\w+)\s+.*?№\s+([\d\s,и]+)", alert_text, re.I):
-                    for code, prefix in {'0':'трамвайн', '3':'автобусн', '11':'тролейбусн'}.items():
-                        if v_type.lower().startswith(prefix):
-                            for name in set(n for n in re.split(r'[\s,и]+', names) if n):
-                                for r_info in routes_by_short_name.get(name, []):
-                                    if r_info.get('route_type') == code: add_alert_to_route(r_info, alert_text)
-                            break
-            for ie in alert.informed_entity:
-                if ie.HasField('route_id'): add_alert_to_route(routes_data.get(ie.route_id), alert_text)
-                elif ie.HasField('trip') and ie.trip.HasField('trip_id'):
-                    trip_info = trips_data.get(ie.trip.trip_id)
-                    if trip_info and 'route_id' in trip_info: add_alert_to_route(routes_data.get(trip_info['route_id']), alert_text)
-                elif ie.HasField('stop_id'):
-                    for t_id in stop_to_trips_map.get(ie.stop_id, []):
-                        if t_id in trips_data and 'route_id' in trips_data[t_id]: add_alert_to_route(routes_data.get(trips_data[t_id]['route_id']), alert_text)
-    return alerts_by_composite_key
+            transport_type = {'0':'TRAM', '3':'BUS', '11':'TROLLEY'}.get(route_info.get('route_type'))
+            if route_info.get('route_short_name','').startswith('N'): transport_type = 'NIGHT'
+        for r in range(stop_times_store.trip_offsets[t_idx], stop_times_store.trip_offsets[t_idx + 1]):
+            s_id = stop_times_store.stop_ids[stop_times_store.row_stop_idx[r]]
+            if s_id not in stop_service_info: stop_service_info[s_id] = {'types': set()}
+            if 'route_id' in trip_info:
+                if s_id not in stop_to_routes_map: stop_to_routes_map[s_id] = set()
+                stop_to_routes_map[s_id].add(trip_info['route_id'])
+            if transport_type: stop_service_info[s_id]['types'].add(transport_type)
+    with open(f'{BASE_PATH}stops.txt', mode='r', encoding='utf-8-sig') as f: stops_data = {r['stop_id']: r for r in csv.DictReader(f) if r['stop_id'] in used_stop_ids}
+    # Групиране на физическите спирки по stop_code, за да не се сканира stops_data при всяка заявка.
+    stop_code_to_stop_ids_map, stop_id_to_code_map, stop_code_to_trips_map = {}, {}, {}
+    for s_id, s_data in stops_data.items():
+        code = s_data.get('stop_code')
+        if not code: continue
+        if code not in stop_code_to_stop_ids_map: stop_code_to_stop_ids_map[code], stop_code_to_trips_map[code] = [], set()
+        stop_code_to_stop_ids_map[code].append(s_id)
+        stop_id_to_code_map[s_id] = code
+        stop_code_to_trips_map[code].update(stop_times_store.get_trips_for_stop(s_id))
+    with open(f'{BASE_PATH}calendar_dates.txt', 'r', encoding='utf-8-sig') as f: calendar_dates_rows = list(csv.DictReader(f))
+    _log_phase('csv_stops_indexes', phase_start)
+    return {'routes_data': routes_data, 'routes_by_short_name': routes_by_short_name, 'trips_data': trips_data, 'stop_times_store': stop_times_store, 'trip_service_ids': trip_service_ids,
+            'stop_service_info': stop_service_info, 'stop_to_routes_map': stop_to_routes_map, 'stops_data': stops_data, 'stop_code_to_stop_ids_map': stop_code_to_stop_ids_map,
+            'stop_id_to_code_map': stop_id_to_code_map, 'stop_code_to_trips_map': stop_code_to_trips_map, 'calendar_dates_rows': calendar_dates_rows}
+
+def _build_static_tables():
+    # Зарежда пълен статичен набор, без да докосва глобалните променливи.
+    load_start = phase_start = time.time()
+    sources = _source_signature(STATIC_SOURCE_FILES)
+    tables = _load_snapshot(STATIC_SNAPSHOT_FILE, sources)
+    mapped_store = _open_mapped_stop_times(sources) if tables is not None else None
+    if tables is not None and mapped_store is not None: _log_phase('snapshot_load', phase_start)
+    else:
+        tables = _parse_static_csv()
+        phase_start = time.time()
+        csv_store = tables.pop('stop_times_store')
+        _save_snapshot(STATIC_SNAPSHOT_FILE, sources, tables)
+        if all(sig is not None for sig in sources.values()):
+            try: csv_store.save(STOP_TIMES_MMAP_FILE, {'version': STATIC_SNAPSHOT_VERSION, 'sources': sources})
+            except OSError as e: print(f"Снимката {STOP_TIMES_MMAP_FILE} не може да се запише: {e}", file=sys.stderr)
+        mapped_store = _open_mapped_stop_times(sources) or csv_store
+        _log_phase('snapshot_write', phase_start)
+    tables['stop_times_store'] = store = mapped_store
+    stops_data, trips_data, calendar_dates_rows = tables['stops_data'], tables['trips_data'], tables['calendar_dates_rows']
+    phase_start = time.time()
+    tables['stop_coord_lats'] = array('d', (float(stops_data[s_id]['stop_lat']) if stops_data.get(s_id, {}).get('stop_lat') else math.nan for s_id in store.stop_ids))
+    tables['stop_coord_lons'] = array('d', (float(stops_data[s_id]['stop_lon']) if stops_data.get(s_id, {}).get('stop_lat') else math.nan for s_id in store.stop_ids))
+    tables['stops_spatial_index'] = GridIndex.from_points((s_id, float(s['stop_lat']), float(s['stop_lon'])) for s_id, s in stops_data.items() if s.get('stop_lat') and s.get('stop_lon'))
+    # Наборите активни услуги са за всички дати наведнъж; днешният се избира при всяка заявка, така че сървърът минава през полунощ.
+    tables['service_calendar'] = ServiceCalendar(calendar_dates_rows, {t['service_id'] for t in trips_data.values()})
+    _log_phase('calendar', phase_start)
+    _log_phase('total', load_start)
+    return tables
+
+def _install_static_tables(tables):
+    global static_tables, routes_data, trips_data, stops_data, service_calendar, stop_times_store, trip_service_ids, stop_service_info, routes_by_short_name, stop_to_routes_map, stop_code_to_stop_ids_map, stop_id_to_code_map, stop_code_to_trips_map, prepared_responses_cache, stops_spatial_index, stop_coord_lats, stop_coord_lons
+    static_tables, stop_times_store = tables, tables['stop_times_store']
+    routes_data, routes_by_short_name, trips_data, trip_service_ids = tables['routes_data'], tables['routes_by_short_name'], tables['trips_data'], tables['trip_service_ids']
+    stop_service_info, stop_to_routes_map, stops_data = tables['stop_service_info'], tables['stop_to_routes_map'], tables['stops_data']
+    stop_code_to_stop_ids_map, stop_id_to_code_map, stop_code_to_trips_map = tables['stop_code_to_stop_ids_map'], tables['stop_id_to_code_map'], tables['stop_code_to_trips_map']
+    stop_coord_lats, stop_coord_lons, stops_spatial_index = tables['stop_coord_lats'], tables['stop_coord_lons'], tables['stops_spatial_index']
+    service_calendar = tables['service_calendar']
+    prepared_responses_cache = {}
+    arrivals_cache.clear()
+    static_reload_status['generation'] += 1
+    static_reload_status['loaded_at'] = time.time()
 
 def load_static_data():
-    global routes_data, trips_data, stops_data, active_services, schedule_by_trip, trip_stops_sequence, stop_service_info, stop_to_trips_map, trip_stop_sequences_map, weekday_schedule_ids, holiday_schedule_ids
+    global static_feed_signature
     try:
-        with open(f'{BASE_PATH}routes.txt', mode='r', encoding='utf-8-sig') as f: routes_data = {r['route_id']: r for r in csv.DictReader(f)}
-        IMMUNE_TROLLEYBUS_ROUTE_IDS = {'TB10','TB9','TB32','TB1','TB3','TB6','TB7','TB4','TB8','TB2','TB27','TB30','TB21','TB40'}
-        for r_id, r_info in routes_data.items():
-            if r_info.get('route_type') == '11' and r_id not in IMMUNE_TROLLEYBUS_ROUTE_IDS: r_info['route_type'] = '3'
-        with open(f'{BASE_PATH}trips.txt', mode='r', encoding='utf-8-sig') as f: trips_data = {r['trip_id']: r for r in csv.DictReader(f)}
-        used_stop_ids = set()
-        with open(f'{BASE_PATH}stop_times.txt', mode='r', encoding='utf-8-sig') as f:
-            for r in csv.DictReader(f):
-                try:
-                    t_id, s_id = r['trip_id'], r['stop_id']
-                    used_stop_ids.add(s_id)
-                    s_seq = int(r['stop_sequence'])
-                    if t_id not in schedule_by_trip: schedule_by_trip[t_id] = {}
-                    schedule_by_trip[t_id][s_id] = r['arrival_time']
-                    if t_id not in trip_stops_sequence: trip_stops_sequence[t_id] = []
-                    trip_stops_sequence[t_id].append({'stop_id': s_id, 'stop_sequence': s_seq})
-                    if t_id not in trip_stop_sequences_map: trip_stop_sequences_map[t_id] = {}
-                    trip_stop_sequences_map[t_id][s_id] = s_seq
-                    if s_id not in stop_to_trips_map: stop_to_trips_map[s_id] = []
-                    stop_to_trips_map[s_id].append(t_id)
-                    trip_info = trips_data.get(t_id)
-                    if trip_info and s_id not in stop_service_info: stop_service_info[s_id] = {'types': set()}
-                    if trip_info and 'route_id' in trip_info:
-                        route_info = routes_data.get(trip_info['route_id'])
-                        if route_info:
-                            r_type = route_info.get('route_type')
-                            transport_type = {'0':'TRAM', '3':'BUS', '11':'TROLLEY'}.get(r_type)
-                            if route_info.get('route_short_name','').startswith('N'): transport_type = 'NIGHT'
-                            if transport_type: stop_service_info[s_id]['types'].add(transport_type)
-                except (ValueError, KeyError) as e: print(f"Проблемен ред в stop_times.txt: {r}. Грешка: {e}", file=sys.stderr)
-        for t_id in trip_stops_sequence: trip_stops_sequence[t_id].sort(key=lambda x: x['stop_sequence'])
-        with open(f'{BASE_PATH}stops.txt', mode='r', encoding='utf-8-sig') as f: stops_data = {r['stop_id']: r for r in csv.DictReader(f) if r['stop_id'] in used_stop_ids}
-        with open(f'{BASE_PATH}calendar_dates.txt', 'r', encoding='utf-8-sig') as f: calendar_dates_rows = list(csv.DictReader(f))
-        active_services.clear()
-        today_str = datetime.now(sofia_tz).strftime('%Y%m%d')
-        is_today_holiday = any(r['date'] == today_str and r.get('exception_type') == '1' for r in calendar_dates_rows)
-        all_service_ids = {t['service_id'] for t in trips_data.values()}
-        holiday_service_ids = {r['service_id'] for r in calendar_dates_rows if r.get('exception_type') == '1'}
-        if is_today_holiday: active_services.update(holiday_service_ids)
-        else: active_services.update(all_service_ids - holiday_service_ids)
-        for r in calendar_dates_rows:
-            if r['date'] == today_str:
-                if r['exception_type'] == '1': active_services.add(r['service_id'])
-                elif r['exception_type'] == '2': active_services.discard(r['service_id'])
-        for r in calendar_dates_rows:
-            (holiday_schedule_ids if datetime.strptime(r['date'], '%Y%m%d').weekday() >= 5 else weekday_schedule_ids).add(str(r['service_id']))
-        print(f"Заредени са {len(active_services)} активни услуги.", file=sys.stderr)
+        signature = _source_signature(STATIC_FEED_FILES)
+        with _static_build_lock(): tables = _build_static_tables()
+        _install_static_tables(tables)
+        static_feed_signature = signature
+        print(f"Заредени са {len(service_calendar.services_on(datetime.now(sofia_tz).date()))} активни услуги за днес.", file=sys.stderr)
     except FileNotFoundError as e:
         print(f"КРИТИЧНА ГРЕШКА: Файлът {e.filename} не е намерен.", file=sys.stderr)
         raise
 
-def parse_gtfs_time(time_str, service_date, tz):
+def _iter_stop_times_rows():
+    with open(f'{BASE_PATH}stop_times.txt', mode='r', encoding='utf-8-sig') as f:
+        for r in csv.DictReader(f):
+            try: yield r['trip_id'], r['stop_id'], int(r['stop_sequence']), r['arrival_time']
+            except (ValueError, KeyError) as e: print(f"Проблемен ред в stop_times.txt: {r}. Грешка: {e}", file=sys.stderr)
+
+def get_scheduled_arrivals_in_window(stop_id, start_secs, end_secs, services=None):
+    return [(stop_times_store.trip_ids[t_idx], secs) for t_idx, secs in stop_times_store.arrivals_in_window(stop_id, start_secs, end_secs) if services is None or trip_service_ids[t_idx] in services]
+
+def service_day_seconds(dt):
+    return dt.hour * 3600 + dt.minute * 60 + dt.second + dt.microsecond / 1e6
+
+def _load_shape_store():
+    print("--- [Warm-up] Зареждане на shapes.txt...", file=sys.stderr)
+    phase_start = time.time()
+    sources = _source_signature(SHAPES_SOURCE_FILES)
+    # Всички форми са в една плоска колона [lat, lon, lat, lon, ...] с offsets (в точки) по форма.
     try:
-        h, m, s = map(int, time_str.split(':'))
-        return tz.localize(datetime(service_date.year, service_date.month, service_date.day) + timedelta(hours=h, minutes=m, seconds=s))
-    except: return None
-
-def _load_all_shapes_temporarily():
-    print("--- [Lazy Init] Зареждане на shapes.txt в паметта временно...", file=sys.stderr)
-    all_shapes = {}
-    with open(f'{BASE_PATH}shapes.txt', mode='r', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            shape_id = row['shape_id']
-            if shape_id not in all_shapes:
-                all_shapes[shape_id] = []
-            all_shapes[shape_id].append([float(row['shape_pt_lat']), float(row['shape_pt_lon'])])
-    print("--- [Lazy Init] shapes.txt е зареден временно.", file=sys.stderr)
-    return all_shapes
-
-def _build_precomputed_route_details(all_shapes):
-    global precomputed_route_details_cache
-    for t_id, t_info in trips_data.items():
+        meta, columns = open_mapped_columns(SHAPES_MMAP_FILE)
+        if not _snapshot_is_current(meta, sources): meta = None
+    except FileNotFoundError: meta = None
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Снимката {SHAPES_MMAP_FILE} не може да се използва: {e}", file=sys.stderr)
+        meta = None
+    if meta is None:
+        shape_ids, offsets, points = parse_shapes_csv(f'{BASE_PATH}shapes.txt', SHAPE_PARSE_WORKERS)
+        meta, columns = {'version': STATIC_SNAPSHOT_VERSION, 'sources': sources, 'shape_ids': shape_ids}, {'offsets': offsets, 'points': points}
+        if all(sig is not None for sig in sources.values()):
+            try: save_mapped_columns(SHAPES_MMAP_FILE, meta, columns)
+            except OSError as e: print(f"Снимката {SHAPES_MMAP_FILE} не може да се запише: {e}", file=sys.stderr)
+    store = ShapeStore(meta['shape_ids'], columns['offsets'], columns['points'])
+    _log_phase('shapes', phase_start)
+    print(f"--- [Warm-up] shapes.txt е зареден ({len(store)} форми, {store.memory_usage()['total'] // 1024} KB).", file=sys.stderr)
+    return store
+
+def _route_payload(tables, t_id, shape_id, payload_cache):
+    # Курсовете с еднаква форма и еднаква поредица от спирки споделят един и същ обект.
+    stops_data, stop_service_info = tables['stops_data'], tables['stop_service_info']
+    stop_pattern = tuple(tables['stop_times_store'].get_trip_stops(t_id))
+    key = (shape_id, stop_pattern)
+    if key not in payload_cache:
+        stops_list = [dict(stops_data.get(s_id), **{'stop_sequence': s_seq, 'service_types': sorted(list(stop_service_info.get(s_id,{}).get('types',[])))}) for s_id, s_seq in stop_pattern if stops_data.get(s_id)]
+        payload_cache[key] = {"shape": shape_id, "stops": stops_list} if stops_list else None
+    return payload_cache[key]
+
+def _build_precomputed_route_details(tables, shapes, payload_cache):
+    route_details = {}
+    for t_id, t_info in tables['trips_data'].items():
         s_id = t_info.get('shape_id')
         if not s_id: continue
-        shape_points = all_shapes.get(s_id, [])
-        if not shape_points or t_id not in trip_stops_sequence: continue
-        stops_list = [dict(stops_data.get(s['stop_id']), **{'stop_sequence': s['stop_sequence'], 'service_types': sorted(list(stop_service_info.get(s['stop_id'],{}).get('types',[])))}) for s in trip_stops_sequence.get(t_id, []) if stops_data.get(s['stop_id'])]
-        if stops_list: precomputed_route_details_cache[t_id] = {"shape": shape_points, "stops": stops_list}
-
-def _build_routes_by_line(all_shapes):
-    global routes_by_line_cache
-    lines_to_trips = {}
+        if s_id not in shapes or not tables['stop_times_store'].has_trip(t_id): continue
+        payload = _route_payload(tables, t_id, s_id, payload_cache)
+        if payload: route_details[t_id] = payload
+    return route_details
+
+def _build_routes_by_line(tables, shapes, payload_cache):
+    routes_by_line, lines_to_trips, trips_data, routes_data = {}, {}, tables['trips_data'], tables['routes_data']
     for t_id, t_info in trips_data.items():
         route_info = routes_data.get(t_info.get('route_id'))
         if route_info:
@@ -201,78 +644,284 @@ def _build_routes_by_line(all_shapes):
             if not t_info or t_info.get('trip_headsign') not in main_headsigns: continue
             s_id = t_info.get('shape_id')
             if not s_id or s_id in processed_shapes: continue
-            shape_points = all_shapes.get(s_id, [])
-            if not shape_points: continue
-            stops_list = [dict(stops_data.get(s['stop_id']), **{'stop_sequence': s['stop_sequence'], 'service_types': sorted(list(stop_service_info.get(s['stop_id'],{}).get('types',[])))}) for s in trip_stops_sequence.get(t_id,[]) if stops_data.get(s['stop_id'])]
-            if not stops_list: continue
-            variation_data = {"direction":t_info.get('trip_headsign','Н/И'), "trip_id_sample":t_id, "shape":shape_points, "stops":stops_list}
-            if line_num not in routes_by_line_cache: routes_by_line_cache[line_num] = {}
-            if r_type not in routes_by_line_cache[line_num]: routes_by_line_cache[line_num][r_type] = []
-            routes_by_line_cache[line_num][r_type].append(variation_data)
+            if s_id not in shapes: continue
+            payload = _route_payload(tables, t_id, s_id, payload_cache)
+            if not payload: continue
+            variation_data = {"direction":t_info.get('trip_headsign','Н/И'), "trip_id_sample":t_id, "shape":payload["shape"], "stops":payload["stops"]}
+            if line_num not in routes_by_line: routes_by_line[line_num] = {}
+            if r_type not in routes_by_line[line_num]: routes_by_line[line_num][r_type] = []
+            routes_by_line[line_num][r_type].append(variation_data)
             processed_shapes.add(s_id)
+    return routes_by_line
 
-def ensure_caches_are_built():
-    global precomputed_route_details_cache, routes_by_line_cache
-    if precomputed_route_details_cache is not None and routes_by_line_cache is not None:
-        return
-    with initialization_lock:
-        if precomputed_route_details_cache is not None and routes_by_line_cache is not None:
-            return
-        
-        print("--- [Lazy Init] Първа заявка. Започва изграждане на тежките кешове...")
+def _read_optional_csv(name):
+    try:
+        with open(f'{BASE_PATH}{name}', 'r', encoding='utf-8-sig') as f: return list(csv.DictReader(f))
+    except FileNotFoundError: return []
+
+def _build_journey_planner(tables):
+    phase_start = time.time()
+    store = tables['stop_times_store']
+    transfer_rows = _read_optional_csv('transfers.txt')
+    footpaths = build_footpaths(store, tables['stop_coord_lats'], tables['stop_coord_lons'], transfer_rows, _read_optional_csv('pathways.txt'), PLAN_TRANSFER_RADIUS_METERS, PLAN_WALK_SPEED_MPS)
+    planner = JourneyPlanner(store, tables['trip_service_ids'], footpaths, build_change_times(store, transfer_rows, PLAN_MIN_CHANGE_SECONDS))
+    # Редът на сканиране за днес се подготвя предварително, за да не го плаща първото търсене.
+    planner.scan_order(tables['service_calendar'].service_days(datetime.now(sofia_tz).date()))
+    _log_phase('journey_planner', phase_start)
+    return planner
+
+def _compute_heavy_caches(tables, shapes):
+    payload_cache = {}
+    route_details = _build_precomputed_route_details(tables, shapes, payload_cache)
+    routes_by_line = _build_routes_by_line(tables, shapes, payload_cache)
+    # Общите отговори се подготвят заедно с кешовете, за да не ги плаща първата заявка след подмяната.
+    prepared = {'all_routes': _prepare_response_body(_build_all_routes(tables)), 'all_stops': _prepare_response_body(_build_all_stops(tables)), 'all_lines_structured': _prepare_response_body(_build_all_lines_structured(routes_by_line))}
+    return {'shape_store': shapes, 'precomputed_route_details_cache': route_details, 'routes_by_line_cache': routes_by_line, 'prepared_responses_cache': prepared, 'journey_planner': _build_journey_planner(tables), 'unique_routes': len(payload_cache)}
+
+def _install_heavy_caches(caches):
+    global precomputed_route_details_cache, routes_by_line_cache, shape_store, prepared_responses_cache, journey_planner
+    shape_store, precomputed_route_details_cache, routes_by_line_cache = caches['shape_store'], caches['precomputed_route_details_cache'], caches['routes_by_line_cache']
+    journey_planner = caches['journey_planner']
+    prepared_responses_cache = caches['prepared_responses_cache']
+
+def _build_heavy_caches():
+    global cache_warm_up_error, cache_warm_up_failed_at
+    try:
+        print("--- [Warm-up] Започва изграждане на тежките кешове...", file=sys.stderr)
         start_time = time.time()
-        
-        # Зареждаме shapes.txt само временно
-        all_shapes_temp = _load_all_shapes_temporarily()
-        
-        precomputed_route_details_cache = {}
-        _build_precomputed_route_details(all_shapes_temp)
-        
-        routes_by_line_cache = {}
-        _build_routes_by_line(all_shapes_temp)
-        
-        # Освобождаваме паметта, заета от shapes
-        del all_shapes_temp
-        
-        end_time = time.time()
-        print(f"--- [Lazy Init] Тежките кешове са изградени за {end_time - start_time:.2f} секунди.")
+        with _static_build_lock(): shapes = _load_shape_store()
+        caches = _compute_heavy_caches(static_tables, shapes)
+        # Подменяме формите и кешовете наведнъж
+        _install_heavy_caches(caches)
+        cache_warm_up_error = None
+        caches_ready_event.set()
+        _log_phase('heavy_caches', start_time)
+        print(f"--- [Warm-up] Тежките кешове са изградени за {time.time() - start_time:.2f} секунди ({caches['unique_routes']} уникални маршрута за {len(caches['precomputed_route_details_cache'])} курса).", file=sys.stderr)
+    except Exception as e:
+        # Кешовете остават None и caches_ready_event - незададено, така че зависимите ендпойнти връщат 503 до успешен опит.
+        cache_warm_up_error, cache_warm_up_failed_at = f"{type(e).__name__}: {e}", time.time()
+        print(f"КРИТИЧНА ГРЕШКА при изграждане на тежките кешове: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+
+def start_cache_warm_up():
+    global cache_warm_up_thread
+    with timed_acquire(initialization_lock, LOCK_WAIT_SECONDS, lock='initialization_lock'):
+        if caches_ready_event.is_set() or (cache_warm_up_thread and cache_warm_up_thread.is_alive()): return cache_warm_up_thread
+        if time.time() - cache_warm_up_failed_at < CACHE_WARM_UP_RETRY_SECONDS: return cache_warm_up_thread
+        cache_warm_up_thread = threading.Thread(target=_build_heavy_caches, name='cache-warm-up', daemon=True)
+        cache_warm_up_thread.start()
+        return cache_warm_up_thread
+
+def ensure_caches_are_built():
+    # True, ако тежките кешове са готови; False, ако последният опит да се изградят е неуспешен.
+    if caches_ready_event.is_set(): return True
+    thread = start_cache_warm_up()
+    wait_start = time.perf_counter()
+    thread.join()
+    LOCK_WAIT_SECONDS.observe(time.perf_counter() - wait_start, lock='caches_ready')
+    return caches_ready_event.is_set()
+
+def reload_static_data(signature):
+    # Новият набор и всичките му производни се изграждат встрани; заявките виждат или изцяло стария, или изцяло новия.
+    global static_feed_signature, realtime_snapshot, alert_parse_cache, processed_alerts_cache, alerts_feed_version
+    print("--- [Reload] Открит е нов статичен фийд, зареждане във фонов режим...", file=sys.stderr)
+    start_time = time.time()
+    try:
+        # Първият worker, открил новия фийд, парсва CSV-тата и записва снимките под файловата ключалка; другите чакат
+        # на нея и после само отварят готовите снимки и mmap файлове (без свой ProcessPool и без паралелно парсване).
+        with _static_build_lock():
+            tables = _build_static_tables()
+            shapes = _load_shape_store()
+        caches = _compute_heavy_caches(tables, shapes)
+    except Exception as e:
+        static_reload_status['failed_signature'], static_reload_status['last_error'] = signature, f"{type(e).__name__}: {e}"
+        print(f"КРИТИЧНА ГРЕШКА при зареждане на новия статичен фийд, остават старите данни: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return False
+    with timed_acquire(realtime_refresh_lock, LOCK_WAIT_SECONDS, lock='realtime_refresh_lock'), timed_acquire(static_data_gate.exclusive(), LOCK_WAIT_SECONDS, lock='static_data_gate_exclusive'):
+        _install_static_tables(tables)
+        _install_heavy_caches(caches)
+        # Снимката пази редове от stop_times_store, затова се изгражда наново върху новите данни преди да пуснем заявките.
+        if realtime_snapshot.version: realtime_snapshot = _build_realtime_snapshot(realtime_snapshot.version + 1, trip_updates_feed_cache, vehicle_positions_feed_cache)
+        # Линиите на предупрежденията са изведени от маршрутите и спирките, затова кешът по съдържание не важи за новия фийд.
+        alert_parse_cache = {}
+        if alerts_feed_cache is not None:
+            processed_alerts_cache = _build_processed_alerts(alerts_feed_cache)
+            alerts_feed_version += 1
+        static_feed_signature = signature
+    with static_data_gate.shared(): live_hub.publish()
+    static_reload_status['last_reload_seconds'], static_reload_status['last_error'], static_reload_status['failed_signature'] = round(time.time() - start_time, 2), None, None
+    print(f"--- [Reload] Новият статичен фийд е подменен за {time.time() - start_time:.2f} секунди ({len(service_calendar.services_on(datetime.now(sofia_tz).date()))} активни услуги за днес).", file=sys.stderr)
+    return True
+
+def _static_reload_loop():
+    previous = static_feed_signature
+    while True:
+        time.sleep(STATIC_RELOAD_CHECK_SECONDS)
+        try:
+            signature = _source_signature(STATIC_FEED_FILES)
+            static_reload_status['last_check'] = time.time()
+            # Зареждаме едва когато файловете не са се променили между две проверки, т.е. копирането им е приключило.
+            if signature == previous and None not in signature.values() and signature != static_feed_signature and signature != static_reload_status['failed_signature']:
+                reload_static_data(signature)
+            previous = signature
+        except Exception as e:
+            print(f"КРИТИЧНА ГРЕШКА в проверката за нов статичен фийд: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+def start_static_reload_watcher():
+    global static_reload_thread, static_reload_pid
+    if STATIC_RELOAD_CHECK_SECONDS <= 0 or not caches_ready_event.is_set(): return
+    with static_reload_start_lock:
+        if static_reload_thread and static_reload_thread.is_alive() and static_reload_pid == os.getpid(): return
+        # Подмяната взима realtime_refresh_lock, който след fork трябва първо да е пресъздаден за този процес.
+        start_realtime_refresher()
+        static_reload_thread = threading.Thread(target=_static_reload_loop, name='static-reload', daemon=True)
+        static_reload_pid = os.getpid()
+        static_reload_thread.start()
+
+def _reset_static_data_gate():
+    global static_data_gate
+    # Нишка на родителя може да е държала вратата в момента на fork; в детето никой не я държи.
+    static_data_gate = SwapGate()
+
+os.register_at_fork(after_in_child=_reset_static_data_gate)
+
+def physical_stop_group(stop_id):
+    # Всички перони със същия stop_code като stop_id (и самият stop_id).
+    stop_code = stops_data.get(stop_id, {}).get('stop_code')
+    physical_stop_ids = set(stop_code_to_stop_ids_map.get(stop_code, [])) if stop_code else set()
+    physical_stop_ids.add(stop_id)
+    return physical_stop_ids
+
+def _compute_live_entries(keys):
+    # Ключовете са 'stop:<stop_id>' (пристигания като в /api/vehicles_for_stop) и 'route:<линия>' (като в /api/vehicles_for_routes).
+    stop_groups, results = {}, {}
+    for key in keys:
+        kind, _, ident = key.partition(':')
+        if kind == 'stop' and ident in stops_data: stop_groups[key] = physical_stop_group(ident)
+        elif kind == 'route':
+            route_vehicles = realtime_snapshot.vehicles_by_route.get(ident)
+            results[key] = route_vehicles.records if route_vehicles else []
+    results.update(compute_stop_arrivals(stop_groups))
+    return results
+
+def _create_live_hub():
+    return LiveHub(_compute_live_entries, _encode_json, 'trip_id', LIVE_STREAM_PROCESS_CLIENTS)
+
+live_hub = _create_live_hub()
+
+def limit_live_streams_to_threads(threads):
+    # Поне LIVE_STREAM_RESERVED_THREADS нишки остават за другите заявки; над лимита /api/stream връща 503.
+    global LIVE_STREAM_PROCESS_CLIENTS
+    LIVE_STREAM_PROCESS_CLIENTS = max(min(LIVE_STREAM_MAX_CLIENTS, threads - LIVE_STREAM_RESERVED_THREADS), 0)
+    live_hub.max_subscribers = LIVE_STREAM_PROCESS_CLIENTS
+
+def _collect_metrics():
+    now, snapshot = time.time(), realtime_snapshot
+    SNAPSHOT_VERSION.set(snapshot.version)
+    if snapshot.created_at: SNAPSHOT_AGE_SECONDS.set(round(now - snapshot.created_at, 3))
+    for name, st in feed_status.items():
+        if st['last_success']: FEED_AGE_SECONDS.set(round(now - st['last_success'], 3), feed=name)
+    stats = arrivals_cache.stats()
+    ARRIVALS_CACHE_REQUESTS.set(stats['hits'], result='hit'); ARRIVALS_CACHE_REQUESTS.set(stats['misses'], result='miss')
+    ARRIVALS_CACHE_EVICTIONS.set(stats['evictions']); ARRIVALS_CACHE_INVALIDATIONS.set(stats['invalidations']); ARRIVALS_CACHE_ENTRIES.set(stats['entries'])
+    for phase, seconds in static_load_phase_timings.items(): STATIC_PHASE_SECONDS.set(round(seconds, 4), phase=phase)
+    STATIC_GENERATION.set(static_reload_status['generation'])
+    LIVE_SUBSCRIBERS.set(live_hub.subscribers)
+    try:
+        with open('/proc/self/statm') as f: PROCESS_RSS_BYTES.set(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError, IndexError): pass
+
+metrics_registry.add_collector(_collect_metrics)
 
 # ----------------- СТАРТИРАНЕ НА СЪРВЪРА -----------------
-print("--- Сървърът стартира. Зареждане на основни статични данни...")
-load_static_data()
-print("--- Основните данни са заредени. Първоначално зареждане на данни в реално време...")
-refresh_realtime_cache_if_needed()
-print("--- Сървърът е готов. Тежките кешове ще се изградят при първа нужда. ---")
+# Процесите на паралелния парсър (spawn) импортират този модул като __mp_main__ и не бива да стартират сървъра.
+if __name__ != '__mp_main__':
+    print("--- Сървърът стартира. Зареждане на основни статични данни...")
+    load_static_data()
+    if REALTIME_REFRESHER == 'thread':
+        print("--- Основните данни са заредени. Първоначално зареждане на данни в реално време...")
+        # Първото теглене е синхронно и без фоновия цикъл: под gunicorn --preload това е master процесът, който не обслужва
+        # заявки. Цикълът тръгва във всеки worker (start_realtime_refresher е по PID) - от post_worker_init или при първата заявка.
+        http_session = _create_http_session()
+        try: refresh_realtime_feeds()
+        except Exception as e:
+            print(f"КРИТИЧНА ГРЕШКА в обновяването на live данни: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+    start_cache_warm_up()
+    print("--- Сървърът е готов. Тежките кешове се изграждат във фонов режим. ---")
 
 # ----------------- API ЕНДПОЙНТИ -----------------
 @app.before_request
 def before_request_func():
-    if 'debug' in request.path:
-        return
-    ensure_caches_are_built()
+    g.request_started = time.perf_counter()
+    if PROFILE_TOKEN and hmac.compare_digest(request.headers.get('X-Profile', ''), PROFILE_TOKEN): g.profiler = profile_thread(PROFILE_SAMPLE_INTERVAL_SECONDS)
+    # Само ендпойнтите върху тежките кешове чакат фоновото им изграждане; останалите отговарят веднага.
+    if request.endpoint in CACHE_DEPENDENT_ENDPOINTS and not ensure_caches_are_built():
+        return jsonify({"error": "Static data caches are not available, try again later."}), 503
+    start_static_reload_watcher()
+    # Цялата заявка вижда един и същ статичен набор, дори ако междувременно бъде подменен с нов.
+    g.static_data_gate, wait_start = static_data_gate, time.perf_counter()
+    g.static_data_gate.acquire_shared()
+    LOCK_WAIT_SECONDS.observe(time.perf_counter() - wait_start, lock='static_data_gate')
 
-@app.route('/api/vehicles_for_stop/<stop_id>')
-def get_vehicles_for_stop(stop_id):
-    try:
-        refresh_realtime_cache_if_needed()
-        processed_alerts, now_dt, now_ts = get_processed_alerts(), datetime.now(sofia_tz), int(time.time())
-        arrival_predictions = {e.trip_update.trip.trip_id: {stu.stop_id: stu.arrival.time for stu in e.trip_update.stop_time_update if stu.HasField('arrival') and stu.arrival.time > 0} for e in trip_updates_feed_cache.entity if e.HasField('trip_update')} if trip_updates_feed_cache else {}
-        vehicle_positions = {e.vehicle.trip.trip_id: e.vehicle for e in vehicle_positions_feed_cache.entity if e.HasField('vehicle')} if vehicle_positions_feed_cache else {}
-        stop_info = stops_data.get(stop_id)
-        if not stop_info: return jsonify({"error": "Stop not found"}), 404
-        stop_code = stop_info.get('stop_code')
-        physical_stop_ids = {s_id for s_id, s_data in stops_data.items() if s_data.get('stop_code') == stop_code and stop_code}
-        physical_stop_ids.add(stop_id)
+@app.after_request
+def after_request_func(response):
+    elapsed = time.perf_counter() - g.pop('request_started', time.perf_counter())
+    REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or 'unmatched', method=request.method, status=response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        profile_id = f"{int(time.time() * 1000)}-{os.getpid()}-{next(profile_sequence)}"
+        try:
+            save_profile(PROFILE_DIR, profile_id, {'method': request.method, 'path': request.full_path.rstrip('?'), 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 2), 'pid': os.getpid()}, profiler, PROFILE_KEEP)
+            response.headers['X-Profile-Id'] = profile_id
+        except OSError as e: print(f"Профилът не може да се запише: {e}", file=sys.stderr)
+        print(f"--- [Profile] {request.method} {request.full_path.rstrip('?')}: {elapsed * 1000:.1f} мс, {profiler.samples} проби -> {profile_id}", file=sys.stderr)
+    response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.1f}'
+    return response
+
+@app.teardown_request
+def teardown_request_func(exc):
+    gate = g.pop('static_data_gate', None)
+    if gate is not None: gate.release_shared()
+
+@app.route('/api/ready')
+def get_readiness():
+    ready = caches_ready_event.is_set() and precomputed_route_details_cache is not None
+    return jsonify({"ready": ready, "static_caches": ready, "static_generation": static_reload_status['generation'], "realtime_snapshot_version": realtime_snapshot.version}), 200 if ready else 503
+
+def compute_stop_arrivals(stop_groups):
+    # stop_groups: {ключ: пероните на една физическа спирка}; връща {ключ: [пристигания]}, подредени като в /api/vehicles_for_stop.
+    # Кандидати са само курсовете с разписание в прозореца, с официална прогноза или с превозно средство, минаващо през перона.
+    processed_alerts, now_dt, now_ts = get_processed_alerts(), datetime.now(sofia_tz), int(time.time())
+    snapshot, zone_state = realtime_snapshot, arrival_zone_state
+    arrival_predictions, vehicle_positions = snapshot.arrival_predictions, snapshot.vehicle_positions
+    now_secs, service_days = service_day_seconds(now_dt), service_calendar.service_days(now_dt.date())
+    # Между две обновявания резултатът за група перони се мени само от закръглянето на минутите.
+    versions = (snapshot.version, zone_state.version, alerts_feed_version, now_ts // 60)
+    results = {}
+    for group_key, physical_stop_ids in stop_groups.items():
+        memo_key = (frozenset(physical_stop_ids),) + versions
+        cached = arrivals_cache.get(memo_key)
+        if cached is not None:
+            results[group_key] = cached
+            continue
         all_arrivals = []
-        trip_ids_for_stop = {tid for s_id in physical_stop_ids for tid in stop_to_trips_map.get(s_id, [])}
-        with shared_data_lock:
-            for k in [k for k,v in recent_official_arrivals_cache.items() if now_ts - v > RECENT_OFFICIAL_TTL_SECONDS]: del recent_official_arrivals_cache[k]
-            for k in [k for k,v in gps_arrival_cache.items() if now_ts - v > GPS_CACHE_TTL_SECONDS]: del gps_arrival_cache[k]
-        for t_id in trip_ids_for_stop:
+        scheduled_in_window = {}
+        for services, offset in service_days:
+            for s_id in physical_stop_ids:
+                for t_id, secs in get_scheduled_arrivals_in_window(s_id, now_secs + offset, now_secs + offset + SCHEDULE_WINDOW_SECONDS, services):
+                    if scheduled_in_window.get((t_id, s_id), math.inf) > secs - offset: scheduled_in_window[(t_id, s_id)] = secs - offset
+        candidate_trip_ids = {t_id for t_id, _ in scheduled_in_window}
+        for s_id in physical_stop_ids:
+            candidate_trip_ids.update(snapshot.stop_predicted_trips.get(s_id, ()))
+            candidate_trip_ids.update(snapshot.stop_vehicle_trips.get(s_id, ()))
+        for t_id in candidate_trip_ids:
             trip_info = trips_data.get(t_id)
             if not trip_info: continue
-            trip_schedule = schedule_by_trip.get(t_id, {})
-            rel_stop_id = next((s_id for s_id in physical_stop_ids if s_id in trip_schedule), None)
+            rel_stop_id = stop_times_store.first_served_stop(t_id, physical_stop_ids)
             if not rel_stop_id: continue
             route_info = routes_data.get(trip_info['route_id'])
             if not route_info: continue
@@ -280,50 +929,33 @@ def get_vehicles_for_stop(stop_id):
             pred_ts = arrival_predictions.get(t_id, {}).get(rel_stop_id)
             if pred_ts and pred_ts > now_ts - 60:
                 eta_min, pred_src, is_live = max(0, round((pred_ts - now_ts) / 60)), "official", True
-                if eta_min == 0:
-                    with shared_data_lock: recent_official_arrivals_cache[(t_id, rel_stop_id)] = now_ts
             elif t_id in vehicle_positions:
-                is_live = True
-                with shared_data_lock:
-                    if (t_id, rel_stop_id) in recent_official_arrivals_cache: continue
-                vehicle, target_stop = vehicle_positions[t_id], stops_data.get(rel_stop_id)
-                dist_to_stop = haversine_distance(vehicle.position.latitude, vehicle.position.longitude, float(target_stop['stop_lat']), float(target_stop['stop_lon'])) if vehicle.HasField('position') and target_stop and target_stop.get('stop_lat') else None
-                cache_key = (t_id, rel_stop_id)
-                with shared_data_lock: was_in_zone = cache_key in gps_arrival_cache
-                if was_in_zone and dist_to_stop is not None and dist_to_stop > DEPARTURE_ZONE_METERS:
-                    with shared_data_lock:
-                        if cache_key in gps_arrival_cache: del gps_arrival_cache[cache_key]
-                    continue
+                is_live, zone_key = True, (t_id, rel_stop_id)
+                if zone_key in zone_state.recent_official or zone_key in zone_state.departed: continue
+                dist_to_stop, hybrid_eta = get_gps_estimate(snapshot, t_id, rel_stop_id)
+                was_in_zone = zone_key in zone_state.gps_in_zone
+                # Снимката може да е по-нова от състоянието на зоните; напускането се отчита и тук.
+                if was_in_zone and dist_to_stop is not None and dist_to_stop > DEPARTURE_ZONE_METERS: continue
                 if (dist_to_stop is not None and dist_to_stop < ARRIVAL_ZONE_METERS) or was_in_zone:
                     eta_min, pred_src = 0, "hybrid"
-                    if not was_in_zone:
-                        with shared_data_lock: gps_arrival_cache[cache_key] = now_ts
-                else:
-                    use_hybrid = False
-                    next_gps_stop = vehicle.stop_id if vehicle.HasField('stop_id') else None
-                    if next_gps_stop and vehicle.HasField('position'):
-                        our_seq, next_seq = trip_stop_sequences_map.get(t_id, {}).get(rel_stop_id), trip_stop_sequences_map.get(t_id, {}).get(next_gps_stop)
-                        if our_seq is not None and next_seq is not None and next_seq < our_seq:
-                            prev_stop = stops_data.get(next_gps_stop)
-                            if prev_stop and prev_stop.get('stop_lat'):
-                                dist_to_prev = haversine_distance(vehicle.position.latitude, vehicle.position.longitude, float(prev_stop['stop_lat']), float(prev_stop['stop_lon']))
-                                if dist_to_prev is not None and dist_to_prev < HYBRID_TRIGGER_ZONE_METERS: use_hybrid = True
-                    if use_hybrid:
-                        r_type = route_info.get('route_type', 'DEFAULT')
-                        avg_speed = AVG_SPEED_MPS.get(r_type, AVG_SPEED_MPS['DEFAULT'])
-                        v_speed = vehicle.position.speed if vehicle.position.HasField('speed') and vehicle.position.speed > 1 else avg_speed
-                        if dist_to_stop is not None and v_speed > 0:
-                            eta_min, pred_src = max(0, round((dist_to_stop / v_speed) / 60)), "hybrid"
-            if pred_src is None and trip_info.get('service_id') in active_services:
-                sched_time_str = trip_schedule.get(rel_stop_id, "")
-                sched_dt = parse_gtfs_time(sched_time_str, now_dt, sofia_tz)
-                if sched_dt and now_dt < sched_dt < now_dt + timedelta(hours=2):
-                    eta_min, pred_src, is_live = max(0, round((sched_dt - now_dt).total_seconds() / 60)), "schedule", False
+                elif hybrid_eta is not None:
+                    eta_min, pred_src = hybrid_eta, "hybrid"
+            if pred_src is None and (t_id, rel_stop_id) in scheduled_in_window:
+                eta_min, pred_src, is_live = max(0, round((scheduled_in_window[(t_id, rel_stop_id)] - now_secs) / 60)), "schedule", False
             if pred_src is not None:
                 r_name, r_type = route_info.get('route_short_name', 'Н/А'), route_info.get('route_type')
                 all_arrivals.append({"trip_id": t_id, "route_name": r_name, "route_type": r_type, "destination": trip_info.get('trip_headsign', 'Н/И'), "eta_minutes": eta_min, "prediction_source": pred_src, "is_live": is_live, "alerts": processed_alerts.get(f"{r_name}-{r_type}")})
         all_arrivals.sort(key=lambda x: (not x['is_live'], x['eta_minutes']))
-        return jsonify(all_arrivals)
+        arrivals_cache.put(memo_key, all_arrivals)
+        results[group_key] = all_arrivals
+    return results
+
+@app.route('/api/vehicles_for_stop/<stop_id>')
+def get_vehicles_for_stop(stop_id):
+    try:
+        refresh_realtime_cache_if_needed()
+        if stop_id not in stops_data: return jsonify({"error": "Stop not found"}), 404
+        return jsonify(compute_stop_arrivals({stop_id: physical_stop_group(stop_id)})[stop_id])
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_vehicles_for_stop: {e}", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
@@ -333,39 +965,9 @@ def get_vehicles_for_stop(stop_id):
 def get_bulk_detailed_arrivals():
     try:
         refresh_realtime_cache_if_needed()
-        processed_alerts, stop_codes = get_processed_alerts(), set(request.json.get('stop_codes', []))
+        stop_codes = set(request.json.get('stop_codes', []))
         if not stop_codes: return jsonify({})
-        now_dt, now_ts = datetime.now(sofia_tz), int(time.time())
-        arrival_predictions = {e.trip_update.trip.trip_id: {stu.stop_id: stu.arrival.time for stu in e.trip_update.stop_time_update if stu.HasField('arrival') and stu.arrival.time > 0} for e in trip_updates_feed_cache.entity if e.HasField('trip_update')} if trip_updates_feed_cache else {}
-        vehicle_positions = {e.vehicle.trip.trip_id: e.vehicle for e in vehicle_positions_feed_cache.entity if e.HasField('vehicle')} if vehicle_positions_feed_cache else {}
-        final_results = {code: [] for code in stop_codes}; rel_stop_ids, stop_id_to_code = set(), {}
-        for s_id, s_data in stops_data.items():
-            code = s_data.get('stop_code')
-            if code in stop_codes: rel_stop_ids.add(s_id); stop_id_to_code[s_id] = code
-        trips_to_check = {tid for s_id in rel_stop_ids for tid in stop_to_trips_map.get(s_id, [])}
-        for t_id in trips_to_check:
-            trip_info = trips_data.get(t_id)
-            if not trip_info: continue
-            route_info = routes_data.get(trip_info['route_id'])
-            if not route_info: continue
-            for s_id, sched_time in schedule_by_trip.get(t_id, {}).items():
-                if s_id in rel_stop_ids:
-                    eta_min, pred_src, is_live = -1, None, False
-                    pred_ts = arrival_predictions.get(t_id, {}).get(s_id)
-                    if pred_ts and pred_ts > now_ts - 60:
-                        eta_min, pred_src, is_live = max(0, round((pred_ts - now_ts) / 60)), "official", True
-                    elif t_id in vehicle_positions: pred_src, is_live = "hybrid", True
-                    if not is_live and trip_info.get('service_id') in active_services:
-                        sched_dt = parse_gtfs_time(sched_time, now_dt, sofia_tz)
-                        if sched_dt and now_dt < sched_dt < now_dt + timedelta(hours=2): eta_min, pred_src = max(0, round((sched_dt - now_dt).total_seconds() / 60)), "schedule"
-                    elif is_live and eta_min == -1:
-                        sched_dt = parse_gtfs_time(sched_time, now_dt, sofia_tz)
-                        if sched_dt and now_dt < sched_dt < now_dt + timedelta(hours=2): eta_min = max(0, round((sched_dt - now_dt).total_seconds() / 60))
-                    if pred_src and eta_min != -1:
-                        r_name, r_type = route_info.get('route_short_name', 'Н/А'), route_info.get('route_type')
-                        final_results[stop_id_to_code[s_id]].append({"trip_id": t_id, "route_name": r_name, "route_type": r_type, "destination": trip_info.get('trip_headsign', 'Н/И'), "eta_minutes": eta_min, "prediction_source": pred_src, "is_live": is_live, "alerts": processed_alerts.get(f"{r_name}-{r_type}")})
-        for code in final_results: final_results[code].sort(key=lambda x: (not x['is_live'], x['eta_minutes']))
-        return jsonify(final_results)
+        return jsonify(compute_stop_arrivals({code: set(stop_code_to_stop_ids_map.get(code, [])) for code in stop_codes}))
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_bulk_detailed_arrivals: {e}", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
@@ -377,69 +979,86 @@ def get_bulk_arrivals_for_stops():
         refresh_realtime_cache_if_needed()
         stop_codes = set(request.json.get('stop_codes', []))
         if not stop_codes: return jsonify({})
-        now_dt, now_ts = datetime.now(sofia_tz), int(time.time())
-        arrival_predictions = {e.trip_update.trip.trip_id: {stu.stop_id: stu.arrival.time for stu in e.trip_update.stop_time_update if stu.HasField('arrival') and stu.arrival.time > 0} for e in trip_updates_feed_cache.entity if e.HasField('trip_update')} if trip_updates_feed_cache else {}
-        stop_code_to_ids = {code:[] for code in stop_codes}
-        for s_id, s_data in stops_data.items():
-            code = s_data.get('stop_code')
-            if code in stop_codes: stop_code_to_ids[code].append(s_id)
-        bulk_results = {}
-        trips_to_check = {tid for code in stop_codes for s_id in stop_code_to_ids.get(code,[]) for tid in stop_to_trips_map.get(s_id,[])}
-        for t_id in trips_to_check:
-            trip_info = trips_data.get(t_id)
-            if not trip_info or trip_info.get('service_id') not in active_services: continue
-            for s_id, sched_time in schedule_by_trip.get(t_id, {}).items():
-                s_details = stops_data.get(s_id)
-                if not s_details: continue
-                s_code = s_details.get('stop_code')
-                if s_code in stop_codes:
-                    is_upcoming = False
-                    if arrival_predictions.get(t_id, {}).get(s_id) and arrival_predictions[t_id][s_id] > now_ts - 60: is_upcoming = True
-                    else:
-                        sched_dt = parse_gtfs_time(sched_time, now_dt, sofia_tz)
-                        if sched_dt and now_dt < sched_dt < now_dt + timedelta(hours=2): is_upcoming = True
-                    if is_upcoming:
-                        if s_code not in bulk_results: bulk_results[s_code] = {'arrivals': set()}
-                        r_info = routes_data.get(trip_info['route_id'])
-                        r_type, r_name = r_info.get('route_type', ''), r_info.get('route_short_name', '')
-                        transport_type = 'BUS'
-                        if r_name.startswith('N'): transport_type = 'NIGHT'
-                        elif r_type == '0': transport_type = 'TRAM'
-                        elif r_type == '11': transport_type = 'TROLLEY'
-                        bulk_results[s_code]['arrivals'].add(transport_type)
-        return jsonify({c: {'arrivals': list(d['arrivals'])} for c, d in bulk_results.items()})
+        return jsonify(compute_bulk_arrival_types(stop_codes))
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_bulk_arrivals_for_stops: {e}", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
         return jsonify({"error": "An internal server error occurred."}), 500
 
+def compute_bulk_arrival_types(stop_codes):
+    # {stop_code: {'arrivals': [видове транспорт]}} за спирките с поне едно пристигане в прозореца (прогноза или разписание).
+    now_dt, now_ts = datetime.now(sofia_tz), int(time.time())
+    now_secs, service_days = service_day_seconds(now_dt), service_calendar.service_days(now_dt.date())
+    arrival_predictions = realtime_snapshot.arrival_predictions
+    bulk_results = {}
+    trips_to_check = {tid for code in stop_codes for tid in stop_code_to_trips_map.get(code, ())}
+    for t_id in trips_to_check:
+        trip_info = trips_data.get(t_id)
+        if not trip_info: continue
+        # След полунощ курсът може да е от вчерашния ден на услугата - тогава времената му са с 24 часа напред.
+        offsets = [offset for services, offset in service_days if trip_info.get('service_id') in services]
+        if not offsets: continue
+        for s_id, sched_secs in stop_times_store.get_trip_schedule(t_id).items():
+            s_code = stop_id_to_code_map.get(s_id)
+            if s_code in stop_codes:
+                is_upcoming = False
+                if arrival_predictions.get(t_id, {}).get(s_id) and arrival_predictions[t_id][s_id] > now_ts - 60: is_upcoming = True
+                elif any(now_secs < sched_secs - offset < now_secs + SCHEDULE_WINDOW_SECONDS for offset in offsets): is_upcoming = True
+                if is_upcoming:
+                    if s_code not in bulk_results: bulk_results[s_code] = {'arrivals': set()}
+                    r_info = routes_data.get(trip_info['route_id'])
+                    r_type, r_name = r_info.get('route_type', ''), r_info.get('route_short_name', '')
+                    transport_type = 'BUS'
+                    if r_name.startswith('N'): transport_type = 'NIGHT'
+                    elif r_type == '0': transport_type = 'TRAM'
+                    elif r_type == '11': transport_type = 'TROLLEY'
+                    bulk_results[s_code]['arrivals'].add(transport_type)
+    return {c: {'arrivals': list(d['arrivals'])} for c, d in bulk_results.items()}
+
+def _build_stop_timetables(stop_code, classify):
+    # classify(service_id) -> ключ на разписанието или None; времената се трупат като секунди и се форматират накрая.
+    relevant_stop_ids = stop_code_to_stop_ids_map.get(stop_code, [])
+    timetables = {}
+    for t_id in stop_code_to_trips_map.get(stop_code, ()):
+        trip_info = trips_data.get(t_id)
+        if not trip_info: continue
+        target_key = classify(str(trip_info['service_id']))
+        if target_key is None: continue
+        route_info = routes_data.get(trip_info['route_id'])
+        if not route_info: continue
+        arr_secs = next((stop_times_store.get_trip_arrival(t_id, s_id) for s_id in relevant_stop_ids if stop_times_store.trip_serves_stop(t_id, s_id)), None)
+        if arr_secs is None: continue
+        r_name, dest, r_type = route_info.get('route_short_name', 'Н/А'), trip_info.get('trip_headsign', 'Н/И'), route_info.get('route_type', '3')
+        timetables.setdefault(target_key, {}).setdefault(r_name, {}).setdefault(dest, {"times": set(), "route_type": r_type})["times"].add(arr_secs)
+    for timetable in timetables.values():
+        for route in timetable.values():
+            for dest_data in route.values(): dest_data["times"] = [format_gtfs_time(secs) for secs in sorted(dest_data["times"])]
+    return timetables
+
+def _build_weekday_holiday_schedule(stop_code):
+    def classify(service_id):
+        if service_id in service_calendar.holiday_schedule_ids: return "holiday"
+        if service_id in service_calendar.weekday_schedule_ids: return "weekday"
+        return None
+    return dict({"weekday": {}, "holiday": {}}, **_build_stop_timetables(stop_code, classify))
+
+def _build_dated_schedule(stop_code, services):
+    # Разписанието за деня на услугата: курсовете след полунощ са с времена 24:xx и по-късни, както в GTFS.
+    return _build_stop_timetables(stop_code, lambda service_id: "schedule" if service_id in services else None).get("schedule", {})
+
 @app.route('/api/schedule_for_stop/<stop_code>')
 def get_schedule_for_stop(stop_code):
+    # Без ?date= - делничното и празничното разписание; с ?date=YYYYMMDD (или YYYY-MM-DD) - {линия: {посока: ...}} за тази дата.
+    # Разписанията се строят веднъж за версия на фийда и се пазят готови в prepared_responses_cache.
     try:
-        relevant_stop_ids = {s_id for s_id, s_data in stops_data.items() if s_data.get('stop_code') == stop_code}
-        if not relevant_stop_ids: return jsonify({"error": "Stop not found"}), 404
-        schedule = {"weekday": {}, "holiday": {}}
-        trip_ids_for_stop = {tid for s_id in relevant_stop_ids for tid in stop_to_trips_map.get(s_id, [])}
-        for t_id in trip_ids_for_stop:
-            trip_info = trips_data.get(t_id)
-            if not trip_info: continue
-            service_id = str(trip_info['service_id'])
-            def add_to_schedule(target):
-                route_info = routes_data.get(trip_info['route_id'])
-                if not route_info: return
-                r_name, dest, r_type = route_info.get('route_short_name', 'Н/А'), trip_info.get('trip_headsign', 'Н/И'), route_info.get('route_type', '3')
-                arr_time = next((schedule_by_trip.get(t_id, {}).get(s_id) for s_id in relevant_stop_ids if s_id in schedule_by_trip.get(t_id, {})), None)
-                if not arr_time: return
-                if r_name not in target: target[r_name] = {}
-                if dest not in target[r_name]: target[r_name][dest] = {"times": [], "route_type": r_type}
-                if arr_time not in target[r_name][dest]["times"]: target[r_name][dest]["times"].append(arr_time)
-            if service_id in holiday_schedule_ids: add_to_schedule(schedule["holiday"])
-            elif service_id in weekday_schedule_ids: add_to_schedule(schedule["weekday"])
-        for sched_type in schedule.values():
-            for route in sched_type.values():
-                for dest_data in route.values():
-                    dest_data["times"].sort(key=lambda t: tuple(map(int, t.split(':'))))
-        return jsonify(schedule)
+        if not stop_code_to_stop_ids_map.get(stop_code): return jsonify({"error": "Stop not found"}), 404
+        date_arg = request.args.get('date')
+        if date_arg is None: return _prepared_json_response(('schedule_for_stop', stop_code), lambda: _build_weekday_holiday_schedule(stop_code))
+        try: day = parse_service_date(date_arg)
+        except ValueError: return jsonify({"error": "Invalid date, expected YYYYMMDD"}), 400
+        # Ключът е наборът услуги, а не датата - датите с еднакъв набор делят едно разписание и кешът остава малък.
+        services = service_calendar.services_on(day)
+        return _prepared_json_response(('schedule_for_stop', stop_code, services), lambda: _build_dated_schedule(stop_code, services))
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_schedule_for_stop: {e}", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
@@ -449,64 +1068,249 @@ def get_schedule_for_stop(stop_code):
 def get_vehicles_for_routes(route_names_str):
     try:
         refresh_realtime_cache_if_needed()
-        req_routes = set(route_names_str.split(','))
-        if not vehicle_positions_feed_cache: return jsonify([])
-        vehicles = []
-        for entity in vehicle_positions_feed_cache.entity:
-            if entity.HasField('vehicle'):
-                v = entity.vehicle; t_id = v.trip.trip_id
-                trip_info = trips_data.get(t_id)
-                if not trip_info: continue
-                route_info = routes_data.get(trip_info['route_id'])
-                if route_info and route_info.get('route_short_name') in req_routes:
-                    vehicles.append({"latitude": v.position.latitude if v.HasField('position') else None, "longitude": v.position.longitude if v.HasField('position') else None, "trip_id": t_id, "route_name": route_info.get('route_short_name'), "route_type": route_info.get('route_type', ''), "destination": trip_info.get('trip_headsign', 'Н/И'), "next_stop_id": v.stop_id if v.HasField('stop_id') else None, "stop_sequence": v.current_stop_sequence if v.HasField('current_stop_sequence') else None})
-        return jsonify(vehicles)
+        return Response(route_vehicles_body(route_names_str.split(',')), mimetype=app.json.mimetype)
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_vehicles_for_routes: {e}", file=sys.stderr)
         return jsonify({"error": "An internal server error occurred."}), 500
 
+def route_vehicles_body(route_names):
+    vehicles_by_route = realtime_snapshot.vehicles_by_route
+    groups = [vehicles_by_route[r_name] for r_name in set(route_names) if r_name in vehicles_by_route]
+    # Готовите фрагменти се сливат по реда във фийда, без повторно сериализиране.
+    fragments = [fragment for _, fragment in heapq.merge(*(zip(group.seqs, group.fragments) for group in groups), key=lambda x: x[0])]
+    return b'[' + b','.join(fragments) + b']\n'
+
+def _prepare_response_body(payload):
+    body = _encode_json(payload) + b'\n'
+    encodings = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None: encodings['br'] = brotli.compress(body, quality=9)
+    # Силен ETag по съдържанието - еднакъв във всички worker-и и се сменя само ако тялото се промени.
+    return hashlib.sha1(body).hexdigest(), encodings
+
+def _prepared_json_response(key, build_payload):
+    # build_payload() връща данните за отговора или None (тогава не кешираме и връщаме None).
+    cache = prepared_responses_cache
+    entry = cache.get(key)
+    if entry is None:
+        payload = build_payload()
+        if payload is None: return None
+        entry = cache[key] = _prepare_response_body(payload)
+        PREPARED_RESPONSES.inc(result='miss')
+    else: PREPARED_RESPONSES.inc(result='hit')
+    etag, encodings = entry
+    if request.if_none_match.contains(etag):
+        PREPARED_RESPONSES.inc(result='not_modified')
+        response = Response(status=304)
+    else:
+        encoding = next((enc for enc in ('br', 'gzip') if enc in encodings and request.accept_encodings[enc] and len(encodings[enc]) < len(encodings['identity'])), 'identity')
+        response = Response(encodings[encoding], mimetype=app.json.mimetype)
+        if encoding != 'identity': response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = STATIC_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _shape_args():
+    # ?zoom=N връща формата, опростена за това zoom ниво; ?format=polyline я връща като Google Encoded Polyline низ.
+    return 'polyline' if request.args.get('format') == 'polyline' else 'points', shape_store.normalize_zoom(request.args.get('zoom', type=int))
+
+def _render_shape(shape_id):
+    shape_format, zoom = _shape_args()
+    if shape_format == 'polyline': return shape_store.get_encoded(shape_id, zoom) or ''
+    return shape_store.get_points(shape_id, zoom) or []
+
+def live_stream_keys(stops_arg, routes_arg):
+    # (ключовете на LiveHub, None) или (None, (грешка, HTTP статус)) за ?stops=...&routes=...
+    stop_ids = [s_id for s_id in stops_arg.split(',') if s_id]
+    route_names = [r_name for r_name in routes_arg.split(',') if r_name]
+    if not stop_ids and not route_names: return None, ({"error": "stops or routes query parameter is required."}, 400)
+    unknown_stops = [s_id for s_id in stop_ids if s_id not in stops_data]
+    if unknown_stops: return None, ({"error": f"Stop not found: {', '.join(unknown_stops)}"}, 404)
+    keys = list(dict.fromkeys([f'stop:{s_id}' for s_id in stop_ids] + [f'route:{r_name}' for r_name in route_names]))
+    if len(keys) > LIVE_STREAM_MAX_KEYS: return None, ({"error": f"At most {LIVE_STREAM_MAX_KEYS} stops and routes per stream."}, 400)
+    return keys, None
+
+@app.route('/api/stream')
+def stream_live_updates():
+    # Server-Sent Events: първо събитие 'snapshot' с пълните списъци, после 'update' с разликите (changed/removed/order) при промяна.
+    keys, error = live_stream_keys(request.args.get('stops', ''), request.args.get('routes', ''))
+    if error: return jsonify(error[0]), error[1]
+    refresh_realtime_cache_if_needed()
+    hub = live_hub
+    if not hub.try_subscribe(keys): return jsonify({"error": "Too many live subscribers, try again later."}), 503
+    return Response(hub.stream(keys, LIVE_STREAM_KEEPALIVE_SECONDS), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def valid_coordinates(lat, lon):
+    # float() приема и 'nan'/'inf', които иначе стигат до GridIndex като невалидни клетки.
+    return math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+@app.route('/api/stops_near')
+def get_stops_near():
+    lat, lon = request.args.get('lat', type=float), request.args.get('lon', type=float)
+    if lat is None or lon is None: return jsonify({"error": "lat and lon query parameters are required."}), 400
+    radius = request.args.get('radius', NEARBY_DEFAULT_RADIUS_METERS, type=float)
+    if not valid_coordinates(lat, lon) or not math.isfinite(radius): return jsonify({"error": "lat, lon and radius must be finite, with lat in [-90, 90] and lon in [-180, 180]."}), 400
+    radius = min(max(radius, 0), NEARBY_MAX_RADIUS_METERS)
+    limit = min(max(request.args.get('limit', NEARBY_DEFAULT_LIMIT, type=int), 1), NEARBY_MAX_LIMIT)
+    nearby = []
+    for s_id, dist in stops_spatial_index.within_radius(lat, lon, radius, limit):
+        stop_copy = stops_data[s_id].copy()
+        stop_copy['service_types'] = sorted(list(stop_service_info.get(s_id, {}).get('types', [])))
+        stop_copy['distance'] = round(dist, 1)
+        nearby.append(stop_copy)
+    return jsonify(nearby)
+
+def _plan_endpoint(prefix):
+    # ?<prefix>_stop=<stop_code> (всички перони, без ходене) или ?<prefix>_lat=&<prefix>_lon= (спирките наоколо, с ходене).
+    # Връща ([(индекс на спирка, секунди пеша)], None) или (None, отговор с грешка).
+    lookup, stop_code = journey_planner.store.stop_lookup, request.args.get(f'{prefix}_stop')
+    if stop_code:
+        stop_ids = stop_code_to_stop_ids_map.get(stop_code)
+        if not stop_ids: return None, (jsonify({"error": f"Stop not found: {stop_code}"}), 404)
+        return [(lookup[s_id], 0) for s_id in stop_ids if s_id in lookup], None
+    lat, lon = request.args.get(f'{prefix}_lat', type=float), request.args.get(f'{prefix}_lon', type=float)
+    if lat is None or lon is None: return None, (jsonify({"error": f"{prefix}_stop or {prefix}_lat and {prefix}_lon query parameters are required."}), 400)
+    if not valid_coordinates(lat, lon): return None, (jsonify({"error": f"{prefix}_lat and {prefix}_lon must be finite, with lat in [-90, 90] and lon in [-180, 180]."}), 400)
+    return [(lookup[s_id], math.ceil(dist / PLAN_WALK_SPEED_MPS)) for s_id, dist in stops_spatial_index.within_radius(lat, lon, PLAN_ACCESS_RADIUS_METERS, PLAN_MAX_ACCESS_STOPS) if s_id in lookup], None
+
+def _plan_trip_delays(snapshot):
+    # Закъснението на курса е по най-ранната му официална прогноза; курс, който изглежда с почти денонощие напред, е от вчерашния ден на услугата.
+    global plan_trip_delays_cache
+    key = (snapshot.version, static_reload_status['generation'])
+    if plan_trip_delays_cache[0] == key: return plan_trip_delays_cache[1]
+    today = datetime.now(sofia_tz)
+    midnight_ts, delays = sofia_tz.localize(datetime(today.year, today.month, today.day)).timestamp(), {}
+    for t_id, predictions in snapshot.arrival_predictions.items():
+        t_idx = stop_times_store.trip_lookup.get(t_id)
+        if t_idx is None or not predictions: continue
+        s_id, pred_ts = min(predictions.items(), key=lambda x: x[1])
+        sched_secs = stop_times_store.get_trip_arrival(t_id, s_id)
+        if sched_secs is None: continue
+        delay = pred_ts - midnight_ts - sched_secs
+        offset = SECONDS_PER_DAY if delay < -SECONDS_PER_DAY / 2 else 0
+        if abs(delay + offset) <= PLAN_MAX_DELAY_SECONDS: delays[(t_idx, offset)] = int(delay + offset)
+    plan_trip_delays_cache = (key, delays)
+    return delays
+
+def _journey_payload(journey, day, delays):
+    legs = []
+    for leg in journey['legs']:
+        item = {"mode": leg["mode"]}
+        for end in ('from', 'to'):
+            s_id = leg[f'{end}_stop_id']
+            item[f'{end}_stop'] = None if s_id is None else {"stop_id": s_id, "stop_code": stops_data.get(s_id, {}).get('stop_code'), "stop_name": stops_data.get(s_id, {}).get('stop_name')}
+        item["departure"], item["arrival"] = format_gtfs_time(int(leg["departure"])), format_gtfs_time(int(leg["arrival"]))
+        item["duration_minutes"] = round((leg["arrival"] - leg["departure"]) / 60)
+        if leg["mode"] == "transit":
+            trip_info = trips_data.get(leg["trip_id"], {})
+            route_info = routes_data.get(trip_info.get('route_id'), {})
+            item.update({"trip_id": leg["trip_id"], "route_name": route_info.get('route_short_name', 'Н/А'), "route_type": route_info.get('route_type'), "destination": trip_info.get('trip_headsign', 'Н/И'),
+                         "stops": leg["stops"], "delay_minutes": round(leg["delay_seconds"] / 60), "is_live": delays is not None and (stop_times_store.trip_lookup[leg["trip_id"]], leg["service_day_offset"]) in delays})
+        legs.append(item)
+    transit_legs = sum(1 for leg in legs if leg["mode"] == "transit")
+    return {"date": day.strftime('%Y%m%d'), "departure": format_gtfs_time(int(journey["departure"])), "arrival": format_gtfs_time(int(journey["arrival"])), "duration_minutes": round((journey["arrival"] - journey["departure"]) / 60),
+            "transfers": max(transit_legs - 1, 0), "live": delays is not None, "legs": legs}
+
+@app.route('/api/plan')
+def get_journey_plan():
+    # Най-ранното пристигане от from_* до to_* при тръгване в ?time=HH:MM[:SS] на ?date=YYYYMMDD (по подразбиране - сега).
+    # ?live=1 прилага закъсненията от официалните прогнози (по подразбиране - само когато се тръгва сега; винаги само за днес).
+    try:
+        origins, error = _plan_endpoint('from')
+        if error: return error
+        targets, error = _plan_endpoint('to')
+        if error: return error
+        now_dt = datetime.now(sofia_tz)
+        date_arg, time_arg = request.args.get('date'), request.args.get('time')
+        try:
+            day = parse_service_date(date_arg) if date_arg else now_dt.date()
+            start_secs = int(service_day_seconds(now_dt)) if time_arg is None else gtfs_time_to_seconds(time_arg if time_arg.count(':') == 2 else f'{time_arg}:00')
+            if start_secs is None: raise ValueError(time_arg)
+        except ValueError: return jsonify({"error": "Invalid date or time, expected date=YYYYMMDD and time=HH:MM[:SS]."}), 400
+        # Извън периода на фийда разписанието е само предположение (и всяка такава дата би изградила свой ред на сканиране).
+        if date_arg and not service_calendar.covers(day):
+            return jsonify({"error": f"date must be between {service_calendar.first_date:%Y%m%d} and {service_calendar.last_date:%Y%m%d}."}), 400
+        live = request.args.get('live', '1' if date_arg is None and time_arg is None else '0') == '1' and day == now_dt.date()
+        if live: refresh_realtime_cache_if_needed()
+        delays = _plan_trip_delays(realtime_snapshot) if live else None
+        journey = journey_planner.plan(origins, targets, start_secs, service_calendar.service_days(day), delays, PLAN_MAX_JOURNEY_SECONDS)
+        if journey is None: return jsonify({"error": "No journey found."}), 404
+        return jsonify(_journey_payload(journey, day, delays))
+    except Exception as e:
+        print(f"КРИТИЧНА ГРЕШКА в get_journey_plan: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return jsonify({"error": "An internal server error occurred."}), 500
+
+@app.route('/api/vehicles_in_bbox')
+def get_vehicles_in_bbox():
+    bbox = [request.args.get(k, type=float) for k in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+    if None in bbox: return jsonify({"error": "min_lat, min_lon, max_lat and max_lon query parameters are required."}), 400
+    if not (valid_coordinates(bbox[0], bbox[1]) and valid_coordinates(bbox[2], bbox[3])): return jsonify({"error": BBOX_RANGE_ERROR}), 400
+    limit = min(max(request.args.get('limit', NEARBY_MAX_LIMIT, type=int), 1), NEARBY_MAX_LIMIT)
+    refresh_realtime_cache_if_needed()
+    return jsonify(vehicles_in_bbox(bbox, limit))
+
+def vehicles_in_bbox(bbox, limit):
+    snapshot = realtime_snapshot
+    vehicles = []
+    for t_id in snapshot.vehicle_index.within_bbox(*bbox):
+        record = snapshot.vehicle_records.get(t_id)
+        if not record: continue
+        vehicles.append(record)
+        if len(vehicles) >= limit: break
+    return vehicles
+
 @app.route('/api/shape/<trip_id>')
 def get_shape_for_trip(trip_id):
     trip_info = trips_data.get(trip_id)
     if not trip_info: return jsonify({"error": "Trip not found"}), 404
     shape_id = trip_info.get('shape_id')
-    shape_points = get_shape_by_id(shape_id)
-    return jsonify(shape_points)
+    if not shape_id or shape_id not in shape_store: return jsonify({"error": f"Shape not found for trip {trip_id}."}), 404
+    return jsonify(_render_shape(shape_id))
 
 @app.route('/api/stops_for_trip/<trip_id>')
 def get_stops_for_trip(trip_id):
-    if trip_id not in trip_stops_sequence: return jsonify({"error": "Trip not found"}), 404
-    stops_list = [dict(stops_data.get(s['stop_id']), **{'stop_sequence': s['stop_sequence']}) for s in trip_stops_sequence.get(trip_id, []) if stops_data.get(s['stop_id'])]
+    if not stop_times_store.has_trip(trip_id): return jsonify({"error": "Trip not found"}), 404
+    stops_list = [dict(stops_data.get(s_id), **{'stop_sequence': s_seq}) for s_id, s_seq in stop_times_store.get_trip_stops(trip_id) if stops_data.get(s_id)]
     return jsonify(stops_list)
 
+def _build_all_routes(tables):
+    return list(tables['routes_data'].values())
+
 @app.route('/api/all_routes')
 def get_all_routes():
-    return jsonify(list(routes_data.values()))
+    return _prepared_json_response('all_routes', lambda: _build_all_routes(static_tables))
 
-@app.route('/api/all_stops')
-def get_all_stops():
+def _build_all_stops(tables):
     enriched_stops = []
-    for stop_id, stop_data in stops_data.items():
-        info = stop_service_info.get(stop_id, {})
+    for stop_id, stop_data in tables['stops_data'].items():
+        info = tables['stop_service_info'].get(stop_id, {})
         stop_copy = stop_data.copy()
         stop_copy['service_types'] = sorted(list(info.get('types', [])))
         enriched_stops.append(stop_copy)
-    return jsonify(enriched_stops)
+    return enriched_stops
+
+@app.route('/api/all_stops')
+def get_all_stops():
+    return _prepared_json_response('all_stops', lambda: _build_all_stops(static_tables))
+
+def _build_all_lines_structured(routes_by_line):
+    final_list = []
+    for line_num, types in routes_by_line.items():
+        for r_type, variations in types.items():
+            transport_type = 'BUS'
+            if line_num.startswith('N'): transport_type = 'NIGHT'
+            elif r_type == '0': transport_type = 'TRAM'
+            elif r_type == '11': transport_type = 'TROLLEY'
+            elif r_type in ['1','2']: transport_type = 'METRO'
+            directions = [{"headsign": v['direction'], "example_trip_id": v['trip_id_sample']} for v in variations]
+            final_list.append({"line_name": line_num, "transport_type": transport_type, "directions": directions})
+    return final_list
 
 @app.route('/api/all_lines_structured')
 def get_all_lines_structured():
     try:
-        final_list = []
-        for line_num, types in routes_by_line_cache.items():
-            for r_type, variations in types.items():
-                transport_type = 'BUS'
-                if line_num.startswith('N'): transport_type = 'NIGHT'
-                elif r_type == '0': transport_type = 'TRAM'
-                elif r_type == '11': transport_type = 'TROLLEY'
-                elif r_type in ['1','2']: transport_type = 'METRO'
-                directions = [{"headsign": v['direction'], "example_trip_id": v['trip_id_sample']} for v in variations]
-                final_list.append({"line_name": line_num, "transport_type": transport_type, "directions": directions})
-        return jsonify(final_list)
+        return _prepared_json_response('all_lines_structured', lambda: _build_all_lines_structured(routes_by_line_cache))
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_all_lines_structured: {e}", file=sys.stderr)
         return jsonify({"error": "An internal server error occurred."}), 500
@@ -516,7 +1320,7 @@ def get_line_details(line_number, route_type_code):
     line_data = routes_by_line_cache.get(line_number, {}).get(route_type_code, [])
     if not line_data:
         return jsonify({"error": f"Няма данни за линия {line_number}."}), 404
-    return jsonify(line_data)
+    return _prepared_json_response(('line_details', line_number, route_type_code) + _shape_args(), lambda: [dict(variation, shape=_render_shape(variation["shape"])) for variation in line_data])
 
 @app.route('/api/full_route_view/<trip_id>')
 def get_full_route_view(trip_id):
@@ -527,19 +1331,14 @@ def get_full_route_view(trip_id):
         if not trip_info: return jsonify({"error": f"Trip info for {trip_id} not found."}), 404
         route_info = routes_data.get(trip_info.get('route_id'))
         if not route_info: return jsonify({"error": f"Route info for trip {trip_id} not found."}), 404
-        r_name_fetch = route_info.get('route_short_name')
         refresh_realtime_cache_if_needed()
-        live_vehicles = []
-        if vehicle_positions_feed_cache:
-            for entity in vehicle_positions_feed_cache.entity:
-                if entity.HasField('vehicle'):
-                    v = entity.vehicle; t_id = v.trip.trip_id
-                    v_trip_info = trips_data.get(t_id)
-                    if not v_trip_info: continue
-                    v_route_info = routes_data.get(v_trip_info.get('route_id'))
-                    if v_route_info and v_route_info.get('route_short_name') == r_name_fetch:
-                        live_vehicles.append({"latitude": v.position.latitude if v.HasField('position') else 0, "longitude": v.position.longitude if v.HasField('position') else 0, "trip_id": t_id, "route_name": v_route_info.get('route_short_name'), "route_type": v_route_info.get('route_type', ''), "destination": v_trip_info.get('trip_headsign', 'Н/И')})
-        return jsonify({"shape": cached_data["shape"], "stops": cached_data["stops"], "vehicles": live_vehicles})
+        route_vehicles = realtime_snapshot.vehicles_by_route.get(route_info.get('route_short_name'))
+        # Статичната част се сериализира веднъж за маршрута; превозните средства идват като готов фрагмент от снимката.
+        prefix_key = ('full_route_view_prefix', id(cached_data)) + _shape_args()
+        prefix = prepared_responses_cache.get(prefix_key)
+        if prefix is None:
+            prefix = prepared_responses_cache[prefix_key] = _encode_json({"shape": _render_shape(cached_data["shape"]), "stops": cached_data["stops"]})[:-1] + b',"vehicles":'
+        return Response(prefix + (route_vehicles.view_fragment if route_vehicles else b'[]') + b'}\n', mimetype=app.json.mimetype)
     except Exception as e:
         print(f"КРИТИЧНА ГРЕШКА в get_full_route_view: {e}", file=sys.stderr)
         return jsonify({"error": "An internal server error occurred."}), 500
@@ -548,7 +1347,8 @@ def get_full_route_view(trip_id):
 def get_static_route_view(trip_id):
     cached_data = precomputed_route_details_cache.get(trip_id)
     if not cached_data: return jsonify({"error": f"Static route details not found for trip {trip_id}."}), 404
-    return jsonify({"shape": cached_data.get("shape", []), "stops": cached_data.get("stops", [])})
+    # Курсовете със споделен маршрут (същия payload обект) споделят и готовото тяло.
+    return _prepared_json_response(('static_route_view', id(cached_data)) + _shape_args(), lambda: {"shape": _render_shape(cached_data["shape"]), "stops": cached_data.get("stops", [])})
 
 @app.route('/api/debug/alerts_raw')
 def debug_alerts_raw():
@@ -559,6 +1359,35 @@ def debug_alerts_raw():
     except Exception as e:
         return jsonify({"error": f"Възникна грешка: {e}"}), 500
 
+@app.route('/api/debug/realtime_status')
+def debug_realtime_status():
+    snapshot = realtime_snapshot
+    return jsonify({"snapshot_version": snapshot.version, "snapshot_age_seconds": round(time.time() - snapshot.created_at, 1) if snapshot.created_at else None, "feeds": get_feed_staleness(), "arrival_zones_version": arrival_zone_state.version, "arrivals_cache": arrivals_cache.stats()})
+
+@app.route('/api/debug/static_status')
+def debug_static_status():
+    return jsonify(dict(static_reload_status, cache_warm_up_error=cache_warm_up_error, feed_files=static_feed_signature, check_interval_seconds=STATIC_RELOAD_CHECK_SECONDS, phase_timings_ms={phase: round(seconds * 1000) for phase, seconds in static_load_phase_timings.items()}))
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/debug/profiles')
+def debug_profiles():
+    summaries = []
+    for name in list_profile_files(PROFILE_DIR)[:50]:
+        profile = load_profile(PROFILE_DIR, name[:-len('.json')])
+        if profile: summaries.append({k: v for k, v in profile.items() if k != 'stacks'})
+    return jsonify(summaries)
+
+@app.route('/api/debug/profiles/<profile_id>')
+def debug_profile(profile_id):
+    # ?format=folded връща стековете в "folded" формат за flamegraph.pl / speedscope.
+    profile = load_profile(PROFILE_DIR, profile_id) if PROFILE_ID_RE.fullmatch(profile_id) else None
+    if profile is None: return jsonify({"error": f"Profile {profile_id} not found."}), 404
+    if request.args.get('format') == 'folded': return Response(''.join(f'{stack} {count}\n' for stack, count in profile['stacks'].items()), mimetype='text/plain')
+    return jsonify(profile)
+
 @app.route('/api/debug/alerts')
 def debug_alerts():
     try:
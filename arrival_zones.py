@@ -0,0 +1,52 @@
+# Файл: arrival_zones.py
+import heapq
+from collections import namedtuple
+
+# Неизменимо състояние за четене от заявките; подменя се цяло при всеки цикъл на обновяване.
+# recent_official: {(trip_id, stop_id): ts} - официалната прогноза е стигнала 0 мин.;
+# gps_in_zone: {(trip_id, stop_id): ts} - превозното средство е влязло в зоната на пристигане;
+# departed: двойките, излезли от зоната в последния цикъл; version се сменя само при промяна на някое от трите множества.
+ArrivalZoneState = namedtuple('ArrivalZoneState', ['version', 'updated_at', 'recent_official', 'gps_in_zone', 'departed'])
+EMPTY_ZONE_STATE = ArrivalZoneState(0, 0, {}, {}, frozenset())
+
+_OFFICIAL, _GPS = 0, 1
+
+
+class ArrivalZoneTracker:
+    """Поддържа ArrivalZoneState от цикъла за обновяване на live данните (един писач).
+
+    Всеки запис изтича TTL секунди след последното си обновяване; сроковете са в min-heap
+    с мързеливо изтриване, така че цикълът не сканира всички записи.
+    """
+
+    def __init__(self, arrival_zone_m, departure_zone_m, official_ttl, gps_ttl):
+        self.arrival_zone_m, self.departure_zone_m = arrival_zone_m, departure_zone_m
+        self.ttl = {_OFFICIAL: official_ttl, _GPS: gps_ttl}
+        self.state, self._expiry_heap = EMPTY_ZONE_STATE, []
+
+    def update(self, now_ts, official_arrivals, gps_distances):
+        """official_arrivals: [((trip_id, stop_id), pred_ts)]; gps_distances: [((trip_id, stop_id), метри или None)]. Връща новото състояние."""
+        entries = {_OFFICIAL: dict(self.state.recent_official), _GPS: dict(self.state.gps_in_zone)}
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now_ts:
+            _, kind, key, ts = heapq.heappop(heap)
+            if entries[kind].get(key) == ts: del entries[kind][key]
+        for key, pred_ts in official_arrivals:
+            # Същото условие като при отговора: прогнозата е валидна и закръглена до 0 минути.
+            if pred_ts > now_ts - 60 and round((pred_ts - now_ts) / 60) <= 0: self._touch(entries, _OFFICIAL, key, now_ts)
+        departed, in_zone = set(), entries[_GPS]
+        for key, dist in gps_distances:
+            if dist is None: continue
+            if key in in_zone:
+                if dist > self.departure_zone_m:
+                    del in_zone[key]
+                    departed.add(key)
+            elif dist < self.arrival_zone_m: self._touch(entries, _GPS, key, now_ts)
+        old, departed = self.state, frozenset(departed)
+        changed = departed != old.departed or entries[_OFFICIAL].keys() != old.recent_official.keys() or in_zone.keys() != old.gps_in_zone.keys()
+        self.state = ArrivalZoneState(old.version + 1 if changed else old.version, now_ts, entries[_OFFICIAL], in_zone, departed)
+        return self.state
+
+    def _touch(self, entries, kind, key, now_ts):
+        entries[kind][key] = now_ts
+        heapq.heappush(self._expiry_heap, (now_ts + self.ttl[kind], kind, key, now_ts))
@@ -0,0 +1,233 @@
+# Файл: asgi_app.py
+# ASGI режим на същия сървър: live ендпойнтите са async, а всички останали /api/... минават през Flask приложението.
+# Realtime фийдовете се теглят от цикъла на събития с httpx; парсването на protobuf, изграждането на снимката и
+# изчисленията за заявките вървят в пул от нишки, за да не спират цикъла. Зависимостите са в requirements-asgi.txt.
+# Стартиране: gunicorn asgi_app:asgi_app -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker
+#             uvicorn asgi_app:asgi_app --port 8000   (един процес, за разработка)
+import asyncio
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import httpx
+from google.protobuf.message import DecodeError
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+
+# Обновяването на live данните е тук, а не в нишката на app.py; трябва да е зададено преди импорта.
+os.environ['REALTIME_REFRESHER'] = 'asyncio'
+import app as wsgi
+from metrics import timed_acquire
+
+ASGI_EXECUTOR_THREADS = int(os.environ.get('ASGI_EXECUTOR_THREADS', 4))
+# Нишките за Flask ендпойнтите (статичните и тежките кешове); live ендпойнтите не ги заемат.
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 8))
+JSON_MEDIA_TYPE = 'application/json'
+
+cpu_executor, http_client, refresher_task = None, None, None
+first_snapshot_event = asyncio.Event()
+# Подменя се след всеки publish() на live_hub (вж. _notify_published); чакащите потоци се будят от set() на стария.
+live_published_event = asyncio.Event()
+
+
+async def _run(fn, *args):
+    # Изчисленията за една заявка виждат един и същ статичен набор, както в before_request на Flask.
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, _with_static_data, fn, args)
+
+
+def _with_static_data(fn, args):
+    with wsgi.static_data_gate.shared(): return fn(*args)
+
+
+async def _fetch_feed(feed_name):
+    headers = wsgi.feed_request_headers(feed_name)
+    with wsgi.FEED_FETCH_SECONDS.time(feed=feed_name):
+        response = await http_client.get(wsgi.REALTIME_FEED_URL, params={'feed': feed_name}, headers=headers)
+    if response.status_code != 304: response.raise_for_status()
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, wsgi.accept_feed_response, feed_name, response.status_code, response.content, response.headers)
+
+
+def _install_realtime_feeds(new_feeds):
+    with timed_acquire(wsgi.realtime_refresh_lock, wsgi.LOCK_WAIT_SECONDS, lock='realtime_refresh_lock'): wsgi.install_realtime_feeds(new_feeds)
+
+
+async def refresh_realtime_feeds():
+    print("--- [CACHE] Обновяване на live данни (async)...", file=sys.stderr)
+    start_time = time.time()
+    results = await asyncio.gather(*(_fetch_feed(name) for name in wsgi.REALTIME_FEED_NAMES), return_exceptions=True)
+    new_feeds = {}
+    for feed_name, result in zip(wsgi.REALTIME_FEED_NAMES, results):
+        if isinstance(result, (httpx.HTTPError, DecodeError)): wsgi.record_feed_error(feed_name, result)
+        elif isinstance(result, BaseException): raise result
+        elif result is not None: new_feeds[feed_name] = result
+    await asyncio.get_running_loop().run_in_executor(cpu_executor, _install_realtime_feeds, new_feeds)
+    first_snapshot_event.set()
+    wsgi.REFRESH_SECONDS.observe(time.time() - start_time)
+    print(f"--- [CACHE] Обновяването приключи за {(time.time() - start_time) * 1000:.2f} мс.", file=sys.stderr)
+
+
+async def _realtime_refresher_loop():
+    while True:
+        try: await refresh_realtime_feeds()
+        except Exception as e:
+            print(f"КРИТИЧНА ГРЕШКА в обновяването на live данни: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+        await asyncio.sleep(wsgi.CACHE_DURATION_SECONDS)
+
+
+async def wait_for_realtime_data():
+    # Като refresh_realtime_cache_if_needed(): чакаме само докато няма нито една снимка.
+    if wsgi.first_realtime_load_event.is_set(): return
+    try: await asyncio.wait_for(first_snapshot_event.wait(), wsgi.FEED_TIMEOUT_SECONDS + 1)
+    except asyncio.TimeoutError: pass
+
+
+def _notify_published():
+    global live_published_event
+    published, live_published_event = live_published_event, asyncio.Event()
+    published.set()
+
+
+async def _wait_for_publish(timeout):
+    try: await asyncio.wait_for(live_published_event.wait(), timeout)
+    except asyncio.TimeoutError: return False
+    return True
+
+
+def _json(payload, status_code=200):
+    # Същите байтове като jsonify (компактен JSON и нов ред накрая).
+    return Response(wsgi._encode_json(payload) + b'\n', status_code, media_type=JSON_MEDIA_TYPE)
+
+
+def _json_body(fn, *args):
+    return wsgi._encode_json(fn(*args)) + b'\n'
+
+
+def _stop_arrivals(stop_id):
+    return wsgi.compute_stop_arrivals({stop_id: wsgi.physical_stop_group(stop_id)})[stop_id]
+
+
+def _query_number(request, name, kind, default=None):
+    try: return kind(request.query_params[name])
+    except (KeyError, ValueError): return default
+
+
+def endpoint(name):
+    """Общата обвивка на async ендпойнтите: 500 при грешка, метриката за латентност, Server-Timing и CORS като във Flask."""
+    def decorate(handler):
+        async def wrapper(request):
+            start = time.perf_counter()
+            try: response = await handler(request)
+            except Exception as e:
+                print(f"КРИТИЧНА ГРЕШКА в {name}: {e}", file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+                response = _json({"error": "An internal server error occurred."}, 500)
+            elapsed = time.perf_counter() - start
+            wsgi.REQUEST_SECONDS.observe(elapsed, endpoint=name, method=request.method, status=response.status_code)
+            response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.1f}'
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            return response
+        return wrapper
+    return decorate
+
+
+class _LiveStreamResponse(StreamingResponse):
+    # Отписването е тук, а не във finally на генератора: при прекъсната връзка генераторът може да не е стартиран.
+    def __init__(self, hub, keys):
+        super().__init__(hub.stream_async(keys, wsgi.LIVE_STREAM_KEEPALIVE_SECONDS, _wait_for_publish), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        self.hub, self.keys = hub, keys
+
+    async def __call__(self, scope, receive, send):
+        try: await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+            self.hub.unsubscribe(self.keys)
+
+
+@endpoint('get_vehicles_for_stop')
+async def get_vehicles_for_stop(request):
+    stop_id = request.path_params['stop_id']
+    await wait_for_realtime_data()
+    if stop_id not in wsgi.stops_data: return _json({"error": "Stop not found"}, 404)
+    return Response(await _run(_json_body, _stop_arrivals, stop_id), media_type=JSON_MEDIA_TYPE)
+
+
+@endpoint('get_bulk_detailed_arrivals')
+async def get_bulk_detailed_arrivals(request):
+    await wait_for_realtime_data()
+    stop_codes = set((await request.json()).get('stop_codes', []))
+    if not stop_codes: return _json({})
+    groups = {code: set(wsgi.stop_code_to_stop_ids_map.get(code, [])) for code in stop_codes}
+    return Response(await _run(_json_body, wsgi.compute_stop_arrivals, groups), media_type=JSON_MEDIA_TYPE)
+
+
+@endpoint('get_bulk_arrivals_for_stops')
+async def get_bulk_arrivals_for_stops(request):
+    await wait_for_realtime_data()
+    stop_codes = set((await request.json()).get('stop_codes', []))
+    if not stop_codes: return _json({})
+    return Response(await _run(_json_body, wsgi.compute_bulk_arrival_types, stop_codes), media_type=JSON_MEDIA_TYPE)
+
+
+@endpoint('get_vehicles_for_routes')
+async def get_vehicles_for_routes(request):
+    await wait_for_realtime_data()
+    return Response(await _run(wsgi.route_vehicles_body, request.path_params['route_names_str'].split(',')), media_type=JSON_MEDIA_TYPE)
+
+
+@endpoint('get_vehicles_in_bbox')
+async def get_vehicles_in_bbox(request):
+    bbox = [_query_number(request, k, float) for k in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+    if None in bbox: return _json({"error": "min_lat, min_lon, max_lat and max_lon query parameters are required."}, 400)
+    if not (wsgi.valid_coordinates(bbox[0], bbox[1]) and wsgi.valid_coordinates(bbox[2], bbox[3])): return _json({"error": wsgi.BBOX_RANGE_ERROR}, 400)
+    limit = min(max(_query_number(request, 'limit', int, wsgi.NEARBY_MAX_LIMIT), 1), wsgi.NEARBY_MAX_LIMIT)
+    await wait_for_realtime_data()
+    return Response(await _run(_json_body, wsgi.vehicles_in_bbox, bbox, limit), media_type=JSON_MEDIA_TYPE)
+
+
+@endpoint('stream_live_updates')
+async def stream_live_updates(request):
+    # Всеки абонат е корутина, която чака publish(), а не нишка - броят им е ограничен само от LIVE_STREAM_MAX_CLIENTS.
+    keys, error = wsgi.live_stream_keys(request.query_params.get('stops', ''), request.query_params.get('routes', ''))
+    if error: return _json(*error)
+    await wait_for_realtime_data()
+    hub = wsgi.live_hub
+    if not await _run(hub.try_subscribe, keys): return _json({"error": "Too many live subscribers, try again later."}, 503)
+    return _LiveStreamResponse(hub, keys)
+
+
+@asynccontextmanager
+async def lifespan(_):
+    global cpu_executor, http_client, refresher_task
+    # След fork (gunicorn --preload) всеки worker пресъздава ключалката и хъба си, после стартира цикъла за обновяване.
+    wsgi.start_realtime_refresher()
+    loop = asyncio.get_running_loop()
+    # publish() се вика от нишки (пула тук и нишката за статично презареждане), затова събуждането минава през цикъла.
+    wsgi.live_hub.add_listener(lambda: loop.call_soon_threadsafe(_notify_published))
+    cpu_executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_THREADS, thread_name_prefix='asgi-cpu')
+    http_client = httpx.AsyncClient(timeout=wsgi.FEED_TIMEOUT_SECONDS, limits=httpx.Limits(max_connections=len(wsgi.REALTIME_FEED_NAMES)))
+    refresher_task = asyncio.create_task(_realtime_refresher_loop())
+    wsgi.start_static_reload_watcher()
+    wsgi.metrics_registry.start_sync()
+    try: yield
+    finally:
+        refresher_task.cancel()
+        await http_client.aclose()
+        cpu_executor.shutdown(wait=False)
+
+
+# Пътищата и методите са същите като във Flask; всичко друго (и OPTIONS за CORS) стига до Flask приложението.
+asgi_app = Starlette(routes=[
+    Route('/api/vehicles_for_stop/{stop_id}', get_vehicles_for_stop),
+    Route('/api/bulk_detailed_arrivals', get_bulk_detailed_arrivals, methods=['POST']),
+    Route('/api/bulk_arrivals_for_stops', get_bulk_arrivals_for_stops, methods=['POST']),
+    Route('/api/vehicles_for_routes/{route_names_str}', get_vehicles_for_routes),
+    Route('/api/vehicles_in_bbox', get_vehicles_in_bbox),
+    Route('/api/stream', stream_live_updates),
+    Mount('/', app=WSGIMiddleware(wsgi.app, workers=ASGI_WSGI_THREADS)),
+], lifespan=lifespan)
@@ -0,0 +1,102 @@
+# Файл: benchmarks/bench_planner.py
+# Мери JourneyPlanner (алгоритъма зад /api/plan) без HTTP: изграждането на връзките и прехвърлянията и латентността
+# на случайни заявки между две спирки в различни часове на деня.
+# Стартиране: python benchmarks/bench_planner.py --stops 4500 --routes 170 --stops-per-route 30 --queries 500
+#             python benchmarks/bench_planner.py --feed GTFS_DIR --queries 500
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from datetime import date, timedelta
+
+import gen_gtfs
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from gtfs_store import StopTimesStore
+from journey_planner import JourneyPlanner, build_footpaths, build_change_times
+from service_calendar import ServiceCalendar
+
+
+def _read_csv(gtfs_dir, name):
+    try:
+        with open(os.path.join(gtfs_dir, name), encoding='utf-8-sig') as f: return list(csv.DictReader(f))
+    except FileNotFoundError: return []
+
+
+def _iter_stop_times(gtfs_dir):
+    with open(os.path.join(gtfs_dir, 'stop_times.txt'), encoding='utf-8-sig') as f:
+        for r in csv.DictReader(f): yield r['trip_id'], r['stop_id'], int(r['stop_sequence']), r['arrival_time']
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк на JourneyPlanner със синтетичен или даден GTFS фийд.")
+    parser.add_argument('--feed', help="директория с готов GTFS фийд (по подразбиране се генерира синтетичен)")
+    parser.add_argument('--stops', type=int, default=4500)
+    parser.add_argument('--routes', type=int, default=170)
+    parser.add_argument('--stops-per-route', type=int, default=30)
+    parser.add_argument('--headway', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--walk-radius', type=float, default=300, help="метри за прехвърляне пеша между две спирки")
+    parser.add_argument('--min-change', type=int, default=90, help="секунди за прекачване на друг курс в същата спирка")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    gtfs_dir = args.feed
+    if not gtfs_dir:
+        gtfs_dir = tempfile.mkdtemp(prefix='sofia-planner-')
+        counts = gen_gtfs.generate(gtfs_dir, args.stops, args.routes, args.stops_per_route, args.headway, seed=args.seed)
+        print("Синтетичен фийд: " + ', '.join(f"{name} {count}" for name, count in counts.items()))
+
+    start = time.perf_counter()
+    store = StopTimesStore.from_rows(_iter_stop_times(gtfs_dir))
+    trips = {r['trip_id']: r['service_id'] for r in _read_csv(gtfs_dir, 'trips.txt')}
+    stops = {r['stop_id']: r for r in _read_csv(gtfs_dir, 'stops.txt')}
+    calendar = ServiceCalendar(_read_csv(gtfs_dir, 'calendar_dates.txt'), set(trips.values()))
+    lats = array('d', (float(stops[s]['stop_lat']) if stops.get(s, {}).get('stop_lat') else float('nan') for s in store.stop_ids))
+    lons = array('d', (float(stops[s]['stop_lon']) if stops.get(s, {}).get('stop_lon') else float('nan') for s in store.stop_ids))
+    print(f"stop_times: {len(store)} реда за {time.perf_counter() - start:.2f} с")
+
+    start = time.perf_counter()
+    transfer_rows = _read_csv(gtfs_dir, 'transfers.txt')
+    footpaths = build_footpaths(store, lats, lons, transfer_rows, _read_csv(gtfs_dir, 'pathways.txt'), args.walk_radius, 1.2)
+    change_times = build_change_times(store, transfer_rows, args.min_change)
+    footpaths_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    planner = JourneyPlanner(store, [trips.get(t_id) for t_id in store.trip_ids], footpaths, change_times)
+    print(f"Прехвърляния: {sum(map(len, footpaths))} за {footpaths_seconds:.2f} с; връзки: {len(planner)} за {time.perf_counter() - start:.2f} с")
+
+    # Делничен ден от календара на фийда (синтетичният е центриран около днес).
+    day = next(d for d in (date.today() + timedelta(days=k) for k in range(7)) if d.weekday() < 5)
+    service_days = calendar.service_days(day)
+    start = time.perf_counter()
+    order = planner.scan_order(service_days)
+    print(f"Активни връзки за {day} ({', '.join(sorted(service_days[0][0]))}): {len(order)}, редът е изграден за {time.perf_counter() - start:.2f} с")
+    rnd, stop_count = random.Random(args.seed), len(store.stop_ids)
+    latencies, found, transfers = [], 0, 0
+    for _ in range(args.queries):
+        origin, target, start_secs = rnd.randrange(stop_count), rnd.randrange(stop_count), rnd.randint(6 * 3600, 22 * 3600)
+        start = time.perf_counter()
+        journey = planner.plan([(origin, 0)], [(target, 0)], start_secs, service_days)
+        latencies.append(time.perf_counter() - start)
+        if journey:
+            found += 1
+            transfers += max(sum(1 for leg in journey['legs'] if leg['mode'] == 'transit') - 1, 0)
+    latencies.sort()
+    print(f"{args.queries} заявки: намерени {found}, средно {transfers / max(found, 1):.1f} прехвърляния")
+    print(f"p50 {_percentile(latencies, 0.5) * 1000:.1f} мс   p90 {_percentile(latencies, 0.9) * 1000:.1f} мс   p99 {_percentile(latencies, 0.99) * 1000:.1f} мс   max {latencies[-1] * 1000:.1f} мс")
+    if not args.feed: shutil.rmtree(gtfs_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Файл: benchmarks/feed_server.py
+# Локален заместител на realtime проксито: отговаря на GET /?feed=<име> с кадрите от gen_realtime.py, с ETag и 304.
+# Стартиране: python benchmarks/feed_server.py FIXTURES_DIR --port 8765  (и REALTIME_FEED_URL=http://127.0.0.1:8765/ за app.py)
+import argparse
+import hashlib
+import http.server
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+from gen_realtime import FEED_NAMES, load_manifest, frame_path
+
+
+class FeedFixtures:
+    """Кадрите в паметта; текущият се избира по часовника, така че на всеки interval секунди фийдът се сменя."""
+
+    def __init__(self, fixtures_dir):
+        manifest = load_manifest(fixtures_dir)
+        self.interval, self.frames = manifest['interval'], manifest['frames']
+        self.payloads = [{name: open(frame_path(fixtures_dir, index, name), 'rb').read() for name in FEED_NAMES} for index in range(self.frames)]
+        self.etags = [{name: f'"{hashlib.md5(payload).hexdigest()}"' for name, payload in frame.items()} for frame in self.payloads]
+        # Кадрите за текущия момент вървят синхронно с часовника; иначе (напр. записани по-рано) се въртят от старта на сървъра.
+        now = time.time()
+        self.base = manifest['start'] if manifest['start'] <= now < manifest['start'] + self.frames * self.interval else now
+        self.requests, self.not_modified, self.lock = 0, 0, threading.Lock()
+
+    def current(self, feed_name):
+        index = int((time.time() - self.base) // self.interval) % self.frames
+        return self.payloads[index][feed_name], self.etags[index][feed_name]
+
+
+def make_handler(fixtures):
+    class FeedHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            feed_name = parse_qs(urlparse(self.path).query).get('feed', [''])[0]
+            if feed_name not in FEED_NAMES:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            payload, etag = fixtures.current(feed_name)
+            with fixtures.lock: fixtures.requests += 1
+            if self.headers.get('If-None-Match') == etag:
+                with fixtures.lock: fixtures.not_modified += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FeedHandler
+
+
+def serve(fixtures_dir, port, host='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((host, port), make_handler(FeedFixtures(fixtures_dir)))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локален сървър за realtime кадри.")
+    parser.add_argument('fixtures_dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = serve(args.fixtures_dir, args.port, args.host)
+    print(f"Realtime фийдът е на http://{args.host}:{server.server_address[1]}/", file=sys.stderr)
+    server.serve_forever()
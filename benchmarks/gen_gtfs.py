@@ -0,0 +1,106 @@
+# Файл: benchmarks/gen_gtfs.py
+# Генерира синтетичен GTFS фийд с размер по избор, със същата структура като фийда на София.
+# Стартиране: python benchmarks/gen_gtfs.py OUT_DIR --stops 3000 --routes 150 --headway 8
+import argparse
+import csv
+import math
+import os
+import random
+from datetime import date, timedelta
+
+ROUTE_TYPES = ['0', '3', '11', '3', '3']
+ROUTE_ID_PREFIX = {'0': 'TM', '3': 'A', '11': 'TB'}
+
+
+def _write(out_dir, name, columns, rows):
+    with open(os.path.join(out_dir, name), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def _format_time(secs):
+    return f"{secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+
+
+def _route_pattern(rnd, n_stops, side, length):
+    # Случайна разходка по решетката от спирки без повторения.
+    pattern = [rnd.randrange(n_stops)]
+    while len(pattern) < length:
+        current = pattern[-1]
+        candidates = [c for c in (current + 1, current - 1, current + side, current - side) if 0 <= c < n_stops and c not in pattern]
+        if not candidates: break
+        pattern.append(rnd.choice(candidates))
+    return pattern
+
+
+def generate(out_dir, stops=300, routes=20, stops_per_route=15, headway_min=10, shape_points=4, days=30, start_date=None, first_departure_hour=5, last_departure_hour=25, seed=1):
+    """Записва stops, routes, trips, stop_times, shapes, calendar_dates и transfers в out_dir; връща броя редове по файл."""
+    rnd = random.Random(seed)
+    start_date = start_date or date.today() - timedelta(days=days // 2)
+    os.makedirs(out_dir, exist_ok=True)
+    side = math.ceil(math.sqrt(stops))
+    stop_rows = []
+    for i in range(stops):
+        # Решетка около центъра на София; всеки две съседни спирки са перони с общ stop_code.
+        lat = 42.65 + (i // side) * 0.004 + rnd.uniform(-0.0005, 0.0005)
+        lon = 23.25 + (i % side) * 0.005 + rnd.uniform(-0.0005, 0.0005)
+        code = f"{i // 2 + 1:04d}"
+        stop_rows.append((str(i + 1), code, f"Спирка {code}", f"{lat:.6f}", f"{lon:.6f}"))
+    route_rows, trip_rows, shape_rows, counts = [], [], [], {'stop_times.txt': 0}
+    stop_times_file = open(os.path.join(out_dir, 'stop_times.txt'), 'w', newline='', encoding='utf-8')
+    stop_times = csv.writer(stop_times_file)
+    stop_times.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+    for r in range(routes):
+        route_type = ROUTE_TYPES[r % len(ROUTE_TYPES)]
+        name = f"N{r + 1}" if r % 10 == 9 else str(r + 1)
+        route_id = f"{ROUTE_ID_PREFIX[route_type]}{r + 1}"
+        route_rows.append((route_id, name, f"Линия {name}", route_type))
+        pattern = _route_pattern(rnd, stops, side, stops_per_route)
+        for direction, stop_pattern in enumerate((pattern, pattern[::-1])):
+            shape_id, seq = f"SH{r + 1}_{direction}", 0
+            for a, b in zip(stop_pattern, stop_pattern[1:] + stop_pattern[-1:]):
+                lat_a, lon_a, lat_b, lon_b = (float(v) for v in (stop_rows[a][3], stop_rows[a][4], stop_rows[b][3], stop_rows[b][4]))
+                for k in range(shape_points):
+                    seq += 1
+                    shape_rows.append((shape_id, f"{lat_a + (lat_b - lat_a) * k / shape_points:.6f}", f"{lon_a + (lon_b - lon_a) * k / shape_points:.6f}", seq))
+            headsign = stop_rows[stop_pattern[-1]][2]
+            for service_id, headway in (('WD', headway_min), ('HD', headway_min * 2)):
+                departure, n = first_departure_hour * 3600 + rnd.randrange(headway * 60), 0
+                while departure < last_departure_hour * 3600:
+                    trip_id = f"{route_id}_{direction}_{service_id}_{n}"
+                    trip_rows.append((route_id, service_id, trip_id, headsign, direction, shape_id))
+                    arrival = departure
+                    for i, s in enumerate(stop_pattern):
+                        if i: arrival += rnd.randint(80, 100)
+                        stop_times.writerow((trip_id, _format_time(arrival), _format_time(arrival), stop_rows[s][0], i + 1))
+                    counts['stop_times.txt'] += len(stop_pattern)
+                    departure, n = departure + headway * 60, n + 1
+    stop_times_file.close()
+    # Както във фийда на София, calendar_dates.txt изброява само празничните дни: услугата WD няма редове и се движи във всички останали.
+    calendar_rows = [('HD', d.strftime('%Y%m%d'), '1') for d in (start_date + timedelta(days=k) for k in range(days)) if d.weekday() >= 5]
+    transfer_rows = [row for i in range(0, stops - 1, 2) for row in ((stop_rows[i][0], stop_rows[i + 1][0], '2', '60'), (stop_rows[i + 1][0], stop_rows[i][0], '2', '60'))]
+    for name, columns, rows in (('stops.txt', ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon'], stop_rows),
+                                ('routes.txt', ['route_id', 'route_short_name', 'route_long_name', 'route_type'], route_rows),
+                                ('trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'], trip_rows),
+                                ('shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], shape_rows),
+                                ('calendar_dates.txt', ['service_id', 'date', 'exception_type'], calendar_rows),
+                                ('transfers.txt', ['from_stop_id', 'to_stop_id', 'transfer_type', 'min_transfer_time'], transfer_rows)):
+        _write(out_dir, name, columns, rows)
+        counts[name] = len(rows)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Синтетичен GTFS фийд за бенчмарковете.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--stops', type=int, default=300)
+    parser.add_argument('--routes', type=int, default=20)
+    parser.add_argument('--stops-per-route', type=int, default=15)
+    parser.add_argument('--headway', type=int, default=10, help="интервал в минути в делничен ден (в празничен е двоен)")
+    parser.add_argument('--shape-points', type=int, default=4, help="точки на формата между две съседни спирки")
+    parser.add_argument('--days', type=int, default=30, help="дни в calendar_dates.txt, центрирани около днес")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    counts = generate(args.out_dir, args.stops, args.routes, args.stops_per_route, args.headway, args.shape_points, args.days, seed=args.seed)
+    for name, count in counts.items(): print(f"{name:<20} {count:>10} реда")
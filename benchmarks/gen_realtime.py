@@ -0,0 +1,141 @@
+# Файл: benchmarks/gen_realtime.py
+# Подготвя поредица от gtfs_realtime_pb2.FeedMessage кадри (trip-updates, vehicle-positions, alerts) за feed_server.py:
+# синтетични - изчислени от разписанието на GTFS фийд, или записани от истинското прокси с --record.
+# Стартиране: python benchmarks/gen_realtime.py GTFS_DIR OUT_DIR --frames 40 --interval 15
+#             python benchmarks/gen_realtime.py --record https://... OUT_DIR --frames 40 --interval 15
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from datetime import datetime
+
+import pytz
+import requests
+from google.transit import gtfs_realtime_pb2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from service_calendar import ServiceCalendar
+
+FEED_NAMES = ("trip-updates", "vehicle-positions", "alerts")
+MANIFEST_FILE = 'manifest.json'
+sofia_tz = pytz.timezone('Europe/Sofia')
+ALERT_TEXTS = ["<p>Автобусни линии № 2, 4 и 8 се отклоняват.</p>", "<b>Трамвайна линия № 1</b> спира временно.", "<div>Тролейбусни линии № 3 и 7</div>"]
+
+
+def _frame_dir(out_dir, index):
+    return os.path.join(out_dir, f'frame_{index:04d}')
+
+
+def _write_frame(out_dir, index, payloads):
+    os.makedirs(_frame_dir(out_dir, index), exist_ok=True)
+    for name, payload in payloads.items():
+        with open(os.path.join(_frame_dir(out_dir, index), f'{name}.pb'), 'wb') as f: f.write(payload)
+
+
+def _write_manifest(out_dir, start, interval, frames, source):
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'start': start, 'interval': interval, 'frames': frames, 'source': source}, f)
+
+
+def load_manifest(out_dir):
+    with open(os.path.join(out_dir, MANIFEST_FILE), encoding='utf-8') as f: return json.load(f)
+
+
+def frame_path(out_dir, index, feed_name):
+    return os.path.join(_frame_dir(out_dir, index), f'{feed_name}.pb')
+
+
+def _load_schedule(gtfs_dir):
+    with open(os.path.join(gtfs_dir, 'stops.txt'), encoding='utf-8-sig') as f:
+        stops = {r['stop_id']: (float(r['stop_lat']), float(r['stop_lon'])) for r in csv.DictReader(f)}
+    with open(os.path.join(gtfs_dir, 'trips.txt'), encoding='utf-8-sig') as f:
+        trip_services = {r['trip_id']: r['service_id'] for r in csv.DictReader(f)}
+    with open(os.path.join(gtfs_dir, 'calendar_dates.txt'), encoding='utf-8-sig') as f:
+        # Активните услуги по дата - по същите правила като app.py.
+        calendar = ServiceCalendar(list(csv.DictReader(f)), set(trip_services.values()))
+    schedule = {}
+    with open(os.path.join(gtfs_dir, 'stop_times.txt'), encoding='utf-8-sig') as f:
+        for r in csv.DictReader(f):
+            h, m, s = map(int, r['arrival_time'].split(':'))
+            schedule.setdefault(r['trip_id'], []).append((int(r['stop_sequence']), r['stop_id'], h * 3600 + m * 60 + s))
+    for rows in schedule.values(): rows.sort()
+    return stops, trip_services, calendar, schedule
+
+
+def _synthetic_frame(now_ts, stops, trip_services, calendar, schedule, seed):
+    now = datetime.fromtimestamp(now_ts, sofia_tz)
+    midnight = sofia_tz.localize(datetime(now.year, now.month, now.day)).timestamp()
+    services = calendar.services_on(now.date())
+    trip_updates, vehicle_positions, alerts = (gtfs_realtime_pb2.FeedMessage() for _ in FEED_NAMES)
+    for feed in (trip_updates, vehicle_positions, alerts):
+        feed.header.gtfs_realtime_version, feed.header.timestamp = '2.0', int(now_ts)
+    for t_id, rows in schedule.items():
+        if trip_services.get(t_id) not in services: continue
+        # Закъснението и това дали курсът има прогноза/GPS са постоянни за курса, за да са кадрите последователни.
+        rnd = random.Random(zlib.crc32(t_id.encode()) ^ seed)
+        delay, kind = rnd.choice([0, 60, 120, -30, 240]), rnd.random()
+        times = [(seq, s_id, midnight + secs + delay) for seq, s_id, secs in rows]
+        if not times[0][2] - 120 <= now_ts <= times[-1][2]: continue
+        if kind < 0.6:
+            entity = trip_updates.entity.add()
+            entity.id, entity.trip_update.trip.trip_id = f'tu{t_id}', t_id
+            for seq, s_id, ts in times:
+                if ts < now_ts - 30: continue
+                update = entity.trip_update.stop_time_update.add()
+                update.stop_id, update.stop_sequence, update.arrival.time = s_id, seq, int(ts)
+        if kind < 0.9:
+            next_i = next((i for i, (_, _, ts) in enumerate(times) if ts > now_ts), len(times) - 1)
+            (_, prev_stop, prev_ts), (next_seq, next_stop, next_ts) = times[max(next_i - 1, 0)], times[next_i]
+            fraction = min(max((now_ts - prev_ts) / (next_ts - prev_ts), 0), 1) if next_ts > prev_ts else 1
+            (lat_a, lon_a), (lat_b, lon_b) = stops[prev_stop], stops[next_stop]
+            entity = vehicle_positions.entity.add()
+            entity.id, vehicle = f'vp{t_id}', entity.vehicle
+            vehicle.trip.trip_id = t_id
+            vehicle.position.latitude, vehicle.position.longitude = lat_a + (lat_b - lat_a) * fraction, lon_a + (lon_b - lon_a) * fraction
+            if kind < 0.45: vehicle.position.speed = rnd.uniform(2, 12)
+            vehicle.stop_id, vehicle.current_stop_sequence = next_stop, next_seq
+    for i, text in enumerate(ALERT_TEXTS):
+        entity = alerts.entity.add()
+        entity.id = f'al{i}'
+        translation = entity.alert.description_text.translation.add()
+        translation.text, translation.language = text, 'bg'
+    return {"trip-updates": trip_updates.SerializeToString(), "vehicle-positions": vehicle_positions.SerializeToString(), "alerts": alerts.SerializeToString()}
+
+
+def generate(gtfs_dir, out_dir, frames=40, interval=15, start=None, seed=2):
+    """Синтетични кадри за моментите start, start + interval, ...; връща манифеста."""
+    start = start if start is not None else time.time()
+    stops, trip_services, calendar, schedule = _load_schedule(gtfs_dir)
+    for index in range(frames):
+        _write_frame(out_dir, index, _synthetic_frame(start + index * interval, stops, trip_services, calendar, schedule, seed))
+    _write_manifest(out_dir, start, interval, frames, os.path.abspath(gtfs_dir))
+    return load_manifest(out_dir)
+
+
+def record(url, out_dir, frames=40, interval=15):
+    """Записва кадри от истинското прокси на всеки interval секунди (подходящи само за истинския GTFS фийд)."""
+    start, session = time.time(), requests.Session()
+    for index in range(frames):
+        _write_frame(out_dir, index, {name: session.get(url, params={'feed': name}, timeout=15).content for name in FEED_NAMES})
+        print(f"Кадър {index + 1}/{frames} е записан.")
+        if index + 1 < frames: time.sleep(max(0, start + (index + 1) * interval - time.time()))
+    _write_manifest(out_dir, start, interval, frames, url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Realtime кадри за feed_server.py.")
+    parser.add_argument('source', help="директория с GTFS фийд или URL на проксито (с --record)")
+    parser.add_argument('out_dir')
+    parser.add_argument('--record', action='store_true', help="записва от проксито вместо да генерира")
+    parser.add_argument('--frames', type=int, default=40)
+    parser.add_argument('--interval', type=int, default=15, help="секунди между два кадъра")
+    parser.add_argument('--seed', type=int, default=2)
+    args = parser.parse_args()
+    if args.record: record(args.source, args.out_dir, args.frames, args.interval)
+    else:
+        generate(args.source, args.out_dir, args.frames, args.interval, seed=args.seed)
+        print(f"{args.frames} кадъра са записани в {args.out_dir}.")
@@ -0,0 +1,316 @@
+# Файл: benchmarks/run_bench.py
+# Пуска app.py (gunicorn, gunicorn с ASGI worker-и върху asgi_app.py или вградения сървър на Flask) върху синтетичен
+# или даден GTFS фийд и локален realtime фийд и измерва времето за старт, паметта на всеки процес и
+# латентността/пропускателността по ендпойнт за всеки сценарий.
+# Стартиране: python benchmarks/run_bench.py --stops 3000 --routes 150 --duration 30 --output before.json
+#             python benchmarks/run_bench.py ... --output after.json --compare before.json
+#             python benchmarks/run_bench.py ... --server asgi --streams 200 --concurrency 64 --compare wsgi.json
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import gen_gtfs
+import gen_realtime
+import feed_server
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GTFS_FILES = ('stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt', 'shapes.txt', 'calendar_dates.txt', 'transfers.txt', 'pathways.txt')
+SNAPSHOT_FILES = ('gtfs_static.snapshot', 'gtfs_stop_times.bin', 'gtfs_shapes.bin')
+STARTUP_TIMEOUT_SECONDS = 600
+
+
+class FeedSample:
+    """Идентификаторите от фийда, от които сценариите избират случайни заявки."""
+
+    def __init__(self, gtfs_dir):
+        with open(os.path.join(gtfs_dir, 'stops.txt'), encoding='utf-8-sig') as f: stops = list(csv.DictReader(f))
+        with open(os.path.join(gtfs_dir, 'routes.txt'), encoding='utf-8-sig') as f: routes = list(csv.DictReader(f))
+        with open(os.path.join(gtfs_dir, 'trips.txt'), encoding='utf-8-sig') as f: self.trip_ids = [r['trip_id'] for r in csv.DictReader(f)]
+        self.stop_ids = [s['stop_id'] for s in stops]
+        self.stop_codes = sorted({s['stop_code'] for s in stops if s.get('stop_code')})
+        self.stop_points = [(float(s['stop_lat']), float(s['stop_lon'])) for s in stops if s.get('stop_lat') and s.get('stop_lon')]
+        self.route_names = sorted({r['route_short_name'] for r in routes if r.get('route_short_name')})
+
+
+# Сценарий: [(тегло, етикет на ендпойнта, функция(rnd, sample) -> (метод, път, JSON тяло или None))].
+SCENARIOS = {
+    # Телефон, който опреснява една спирка.
+    'stop_polling': [(1, 'GET /api/vehicles_for_stop/<stop_id>', lambda rnd, s: ('GET', f'/api/vehicles_for_stop/{rnd.choice(s.stop_ids)}', None))],
+    # Табло на спирка с няколко физически спирки наведнъж.
+    'kiosk_bulk': [(3, 'POST /api/bulk_detailed_arrivals', lambda rnd, s: ('POST', '/api/bulk_detailed_arrivals', {'stop_codes': rnd.sample(s.stop_codes, min(10, len(s.stop_codes)))})),
+                   (1, 'POST /api/bulk_arrivals_for_stops', lambda rnd, s: ('POST', '/api/bulk_arrivals_for_stops', {'stop_codes': rnd.sample(s.stop_codes, min(10, len(s.stop_codes)))}))],
+    # Карта, която следи няколко линии и отваря маршрут.
+    'map_routes': [(4, 'GET /api/vehicles_for_routes/<names>', lambda rnd, s: ('GET', f"/api/vehicles_for_routes/{','.join(rnd.sample(s.route_names, min(3, len(s.route_names))))}", None)),
+                   (1, 'GET /api/full_route_view/<trip_id>', lambda rnd, s: ('GET', f'/api/full_route_view/{rnd.choice(s.trip_ids)}', None)),
+                   (1, 'GET /api/all_lines_structured', lambda rnd, s: ('GET', '/api/all_lines_structured', None))],
+    # Търсене на маршрут между две спирки или две точки на картата, с тръгване сега.
+    'journey_plan': [(3, 'GET /api/plan?from_stop&to_stop', lambda rnd, s: ('GET', '/api/plan?from_stop={}&to_stop={}'.format(*rnd.sample(s.stop_codes, 2)), None)),
+                     (1, 'GET /api/plan?from_lat&to_lat', lambda rnd, s: ('GET', '/api/plan?from_lat={}&from_lon={}&to_lat={}&to_lon={}'.format(*rnd.choice(s.stop_points), *rnd.choice(s.stop_points)), None))],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)] if sorted_values else None
+
+
+def _git_revision():
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+
+def prepare_server_dir(server_dir, gtfs_dir):
+    # app.py търси данните до себе си, затова модулите и данните се свързват в една директория.
+    os.makedirs(server_dir, exist_ok=True)
+    for name in os.listdir(REPO_PATH):
+        if name.endswith('.py'): _link(os.path.join(REPO_PATH, name), os.path.join(server_dir, name))
+    for name in GTFS_FILES:
+        if os.path.exists(os.path.join(gtfs_dir, name)): _link(os.path.abspath(os.path.join(gtfs_dir, name)), os.path.join(server_dir, name))
+
+
+def _link(src, dst):
+    if os.path.lexists(dst): os.remove(dst)
+    os.symlink(src, dst)
+
+
+def start_app(server_dir, server, workers, threads, port, feed_url):
+    env = dict(os.environ, REALTIME_FEED_URL=feed_url, PYTHONUNBUFFERED='1')
+    if server in ('gunicorn', 'asgi'):
+        env.update(GUNICORN_BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads))
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '-c', 'gunicorn.conf.py']
+        if server == 'asgi': command = [sys.executable, '-m', 'gunicorn', 'asgi_app:asgi_app', '-c', 'gunicorn.conf.py', '-k', 'uvicorn_worker.UvicornWorker']
+    else:
+        command = [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(os.path.join(server_dir, 'server.log'), 'wb')
+    return subprocess.Popen(command, cwd=server_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(base_url, process):
+    start = time.perf_counter()
+    while time.perf_counter() - start < STARTUP_TIMEOUT_SECONDS:
+        if process.poll() is not None: raise RuntimeError(f"Сървърът спря с код {process.returncode}, вижте server.log")
+        try:
+            if requests.get(f'{base_url}/api/ready', timeout=5).status_code == 200: return time.perf_counter() - start
+        except requests.RequestException: pass
+        time.sleep(0.05)
+    raise RuntimeError("Сървърът не стана готов навреме")
+
+
+def _process_tree(root_pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f: ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError): continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def _memory_kb(pid):
+    # RSS брои споделените (fork/mmap) страници във всеки процес; PSS ги разделя между процесите, които ги споделят.
+    result = {}
+    for path, fields in ((f'/proc/{pid}/status', ('VmRSS',)), (f'/proc/{pid}/smaps_rollup', ('Pss',))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key = line.split(':', 1)[0]
+                    if key in fields: result[key.lower()] = int(line.split()[1])
+        except OSError: pass
+    return result
+
+
+def memory_report(root_pid):
+    """Паметта (KB) на master процеса и на всеки worker; празно, ако /proc не е наличен."""
+    if not os.path.isdir('/proc'): return []
+    return [dict(_memory_kb(pid), pid=pid, role='master' if pid == root_pid else 'worker') for pid in _process_tree(root_pid)]
+
+
+class LiveStreams:
+    """count отворени /api/stream връзки през цялото пускане, всяка в своя нишка; при gthread всяка заема нишка на worker."""
+
+    def __init__(self, base_url, sample, count, seed):
+        rnd = random.Random(seed)
+        # По линии, а не по спирки: във фийда има и спирки без курсове, за които потокът връща 404.
+        self.urls = [f"{base_url}/api/stream?routes={','.join(rnd.sample(sample.route_names, min(3, len(sample.route_names))))}" for _ in range(count)]
+        self.opened, self.events, self.errors, self.lock = 0, 0, 0, threading.Lock()
+        self.threads = [threading.Thread(target=self._listen, args=(url,), daemon=True) for url in self.urls]
+
+    def start(self, timeout=30):
+        for t in self.threads: t.start()
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and self.opened + self.errors < len(self.urls): time.sleep(0.05)
+        return self
+
+    def _listen(self, url):
+        try:
+            with requests.get(url, stream=True, timeout=(5, 120)) as response:
+                if response.status_code != 200: raise requests.HTTPError(response.status_code)
+                for line in response.iter_lines():
+                    if not line.startswith(b'event: '): continue
+                    with self.lock:
+                        if line == b'event: snapshot': self.opened += 1
+                        self.events += 1
+        except requests.RequestException:
+            with self.lock: self.errors += 1
+
+    def report(self):
+        with self.lock: return {'requested': len(self.urls), 'opened': self.opened, 'errors': self.errors, 'events': self.events}
+
+
+def run_scenario(base_url, name, sample, duration, concurrency, seed):
+    entries = SCENARIOS[name]
+    labels, weights = [label for _, label, _ in entries], [weight for weight, _, _ in entries]
+    builders = {label: build for _, label, build in entries}
+    latencies, errors, lock, deadline = {label: [] for label in labels}, {label: 0 for label in labels}, threading.Lock(), time.perf_counter() + duration
+
+    def client(client_seed):
+        rnd, session, local, local_errors = random.Random(client_seed), requests.Session(), {label: [] for label in labels}, {label: 0 for label in labels}
+        while time.perf_counter() < deadline:
+            label = rnd.choices(labels, weights)[0]
+            method, path, body = builders[label](rnd, sample)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, json=body, timeout=30)
+                response.content
+                ok = response.status_code < 500
+            except requests.RequestException: ok = False
+            local[label].append(time.perf_counter() - start)
+            if not ok: local_errors[label] += 1
+        with lock:
+            for label in labels:
+                latencies[label].extend(local[label])
+                errors[label] += local_errors[label]
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(seed * 1000 + i,)) for i in range(concurrency)]
+    for t in clients: t.start()
+    for t in clients: t.join()
+    elapsed = time.perf_counter() - started
+    results = {}
+    for label in labels:
+        values = sorted(latencies[label])
+        results[label] = {'requests': len(values), 'errors': errors[label], 'rps': round(len(values) / elapsed, 1),
+                          'p50_ms': round(_percentile(values, 0.5) * 1000, 2) if values else None, 'p99_ms': round(_percentile(values, 0.99) * 1000, 2) if values else None}
+    return results
+
+
+def print_report(report, baseline=None):
+    print(f"\nРевизия: {report['revision']}, сървър: {report['server']} ({report['workers']} worker-а), фийд: {report['feed']}")
+    print(f"Старт до /api/ready: {report['startup_seconds']:.2f} с")
+    if report.get('streams'): print("Live потоци: {requested} заявени, {opened} отворени, {errors} грешки, {events} събития".format(**report['streams']))
+    for phase, ms in report.get('static_phase_timings_ms', {}).items(): print(f"  {phase:<22} {ms:>8} мс")
+    for proc in report['memory']: print(f"  {proc['role']:<7} pid {proc['pid']:<8} RSS {proc.get('vmrss', 0) / 1024:8.1f} MB   PSS {proc.get('pss', 0) / 1024:8.1f} MB")
+    print(f"\n{'сценарий / ендпойнт':<52} {'заявки':>8} {'грешки':>7} {'rps':>9} {'p50 мс':>9} {'p99 мс':>9}")
+    for scenario, endpoints in report['scenarios'].items():
+        for label, stats in endpoints.items():
+            line = f"{scenario + ' ' + label:<52} {stats['requests']:>8} {stats['errors']:>7} {stats['rps']:>9} {stats['p50_ms'] or '-':>9} {stats['p99_ms'] or '-':>9}"
+            old = ((baseline or {}).get('scenarios', {}).get(scenario) or {}).get(label)
+            if old and old.get('p50_ms') and stats['p50_ms']:
+                line += f"   p50 {(stats['p50_ms'] / old['p50_ms'] - 1) * 100:+.0f}%, rps {(stats['rps'] / old['rps'] - 1) * 100 if old['rps'] else 0:+.0f}% спрямо {baseline.get('revision')}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк на app.py със синтетични данни и сценарии на натоварване.")
+    parser.add_argument('--feed', help="директория с готов GTFS фийд (по подразбиране се генерира синтетичен)")
+    parser.add_argument('--stops', type=int, default=3000)
+    parser.add_argument('--routes', type=int, default=150)
+    parser.add_argument('--stops-per-route', type=int, default=25)
+    parser.add_argument('--headway', type=int, default=8)
+    parser.add_argument('--fixtures', help="директория с готови realtime кадри (по подразбиране се генерират за фийда)")
+    parser.add_argument('--server', choices=('gunicorn', 'asgi', 'flask'), default='gunicorn', help="asgi: asgi_app.py с uvicorn worker-и под gunicorn")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="сценарии, разделени със запетая: " + ', '.join(SCENARIOS))
+    parser.add_argument('--duration', type=float, default=20, help="секунди на сценарий")
+    parser.add_argument('--concurrency', type=int, default=8, help="едновременни клиенти")
+    parser.add_argument('--streams', type=int, default=0, help="отворени /api/stream връзки по време на сценариите")
+    parser.add_argument('--warm-snapshot', action='store_true', help="не изтрива снимките от предишен старт (мери топъл старт)")
+    parser.add_argument('--workdir', help="работна директория (по подразбиране временна)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON файл за резултатите")
+    parser.add_argument('--compare', help="JSON файл от предишно пускане за сравнение")
+    args = parser.parse_args()
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown: parser.error(f"непознати сценарии: {', '.join(unknown)}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sofia-bench-')
+    gtfs_dir = args.feed
+    if not gtfs_dir:
+        gtfs_dir = os.path.join(workdir, 'gtfs')
+        if not os.path.exists(os.path.join(gtfs_dir, 'stop_times.txt')):
+            # Денонощно движение, за да не зависят резултатите от часа на пускане.
+            counts = gen_gtfs.generate(gtfs_dir, args.stops, args.routes, args.stops_per_route, args.headway, first_departure_hour=0, last_departure_hour=24, seed=args.seed)
+            print("Синтетичен фийд: " + ', '.join(f"{name} {count}" for name, count in counts.items()))
+    fixtures_dir = args.fixtures
+    if not fixtures_dir:
+        fixtures_dir = os.path.join(workdir, 'realtime')
+        interval = 15
+        frames = math.ceil((STARTUP_TIMEOUT_SECONDS / 10 + args.duration * len(scenarios)) / interval) + 1
+        print(f"Генериране на {frames} realtime кадъра...")
+        gen_realtime.generate(gtfs_dir, fixtures_dir, frames, interval, seed=args.seed)
+    server_dir = os.path.join(workdir, 'server')
+    prepare_server_dir(server_dir, gtfs_dir)
+    if not args.warm_snapshot:
+        for name in SNAPSHOT_FILES:
+            if os.path.exists(os.path.join(server_dir, name)): os.remove(os.path.join(server_dir, name))
+
+    feed = feed_server.serve(fixtures_dir, _free_port())
+    threading.Thread(target=feed.serve_forever, daemon=True).start()
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    process = start_app(server_dir, args.server, args.workers, args.threads, port, f'http://127.0.0.1:{feed.server_address[1]}/')
+    try:
+        startup_seconds = wait_until_ready(base_url, process)
+        sample = FeedSample(gtfs_dir)
+        report = {'revision': _git_revision(), 'server': args.server, 'workers': args.workers if args.server != 'flask' else 1, 'feed': gtfs_dir,
+                  'startup_seconds': round(startup_seconds, 3), 'scenarios': {}}
+        streams = LiveStreams(base_url, sample, args.streams, args.seed).start() if args.streams else None
+        try: report['static_phase_timings_ms'] = requests.get(f'{base_url}/api/debug/static_status', timeout=10).json().get('phase_timings_ms', {})
+        except (requests.RequestException, ValueError): pass
+        for name in scenarios:
+            print(f"Сценарий {name} ({args.duration:.0f} с, {args.concurrency} клиента)...")
+            report['scenarios'][name] = run_scenario(base_url, name, sample, args.duration, args.concurrency, args.seed)
+        # Паметта се мери след натоварването, когато кешовете на worker-ите вече са пълни.
+        report['memory'] = memory_report(process.pid)
+        if streams: report['streams'] = streams.report()
+    finally:
+        process.terminate()
+        try: process.wait(timeout=30)
+        except subprocess.TimeoutExpired: process.kill()
+        feed.shutdown()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f: baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=1)
+    if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+# Файл: gtfs_store.py
+import csv
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+MAPPED_FILE_MAGIC = b'GTFSCOL1'
+PARALLEL_PARSE_MIN_BYTES = 8 * 2**20
+
+
+def gtfs_time_to_seconds(time_str):
+    """Превръща GTFS време 'HH:MM:SS' (вкл. 25:xx) в секунди от началото на деня на услугата."""
+    try:
+        h, m, s = map(int, time_str.split(':'))
+        return h * 3600 + m * 60 + s
+    except (ValueError, AttributeError):
+        return None
+
+
+def format_gtfs_time(secs):
+    return f"{secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+
+
+def _group_rows(keys, n_groups):
+    """Стабилно групиране (counting sort) на редовете по ключ; връща offsets и реда на редовете."""
+    offsets = array('i', [0]) * (n_groups + 1)
+    for k in keys:
+        offsets[k + 1] += 1
+    for g in range(n_groups):
+        offsets[g + 1] += offsets[g]
+    cursor, order = array('i', offsets), array('i', [0]) * len(keys)
+    for row, k in enumerate(keys):
+        order[cursor[k]] = row
+        cursor[k] += 1
+    return offsets, order
+
+
+def save_mapped_columns(path, meta, columns):
+    """Записва колони (array) в двоичен файл, подходящ за mmap: заглавие JSON + подравнени сурови данни."""
+    layout, offset = {}, 0
+    for name, col in columns.items():
+        layout[name] = [col.typecode, offset, len(col)]
+        offset += (len(col) * col.itemsize + 7) // 8 * 8
+    header = json.dumps({'meta': meta, 'columns': layout}, ensure_ascii=False).encode('utf-8')
+    data_start = (len(MAPPED_FILE_MAGIC) + 8 + len(header) + 7) // 8 * 8
+    # Временният файл е по PID, за да не си пречат процеси, които записват снимката без обща ключалка;
+    # os.replace оставя вече mmap-натия стар файл валиден до затварянето му.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAPPED_FILE_MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, col in columns.items():
+            f.seek(data_start + layout[name][1])
+            f.write(col.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def open_mapped_columns(path):
+    """Отваря файл от save_mapped_columns само за четене; колоните са memoryview върху споделените страници."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAPPED_FILE_MAGIC)) != MAPPED_FILE_MAGIC: raise ValueError(f"{path} не е колонен файл")
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = (len(MAPPED_FILE_MAGIC) + 8 + header_len + 7) // 8 * 8
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view, columns = memoryview(mapped), {}
+    for name, (typecode, offset, length) in header['columns'].items():
+        start = data_start + offset
+        columns[name] = view[start:start + length * array(typecode).itemsize].cast(typecode)
+    return header['meta'], columns
+
+
+def _parse_shapes_chunk(path, header, start, end):
+    """Парсва редовете на shapes.txt в байтовия интервал [start, end), който започва и завършва на граница на ред."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8').splitlines()
+    id_col, lat_col, lon_col = header.index('shape_id'), header.index('shape_pt_lat'), header.index('shape_pt_lon')
+    shapes = {}
+    for row in csv.reader(lines):
+        if not row: continue
+        if row[id_col] not in shapes: shapes[row[id_col]] = array('d')
+        shapes[row[id_col]].extend((float(row[lat_col]), float(row[lon_col])))
+    return list(shapes.items())
+
+
+def parse_shapes_csv(path, workers=1):
+    """Парсва shapes.txt до (shape_ids, offsets, points), където точките на i-тата форма са points[2*offsets[i]:2*offsets[i+1]].
+
+    За големи файлове частите се парсват паралелно в отделни процеси; редът на точките остава като във файла.
+    """
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+        size = os.fstat(f.fileno()).st_size
+        if size < PARALLEL_PARSE_MIN_BYTES: workers = 1
+        bounds = [f.tell()]
+        for k in range(1, workers):
+            f.seek(max(bounds[-1], size * k // workers))
+            f.readline()
+            bounds.append(f.tell())
+        bounds.append(size)
+    chunks = [(path, header, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context('spawn')) as executor:
+            parts = list(executor.map(_parse_shapes_chunk, *zip(*chunks)))
+    else:
+        parts = [_parse_shapes_chunk(*chunk) for chunk in chunks]
+    shapes = {}
+    for part in parts:
+        for shape_id, pts in part:
+            if shape_id not in shapes: shapes[shape_id] = array('d')
+            shapes[shape_id].extend(pts)
+    offsets, points = array('i', [0]), array('d')
+    for pts in shapes.values():
+        points.extend(pts)
+        offsets.append(len(points) // 2)
+    return list(shapes), offsets, points
+
+
+class StopTimesStore:
+    """Колонно представяне на stop_times.txt.
+
+    Курсовете и спирките са интернирани до цели числа. Редовете са подредени по курс и
+    stop_sequence (CSR offsets по курс), а отделен CSR индекс по спирка държи редовете
+    ѝ, сортирани по време на пристигане, за търсене на прозорец с bisect.
+    """
+    COLUMNS = ('trip_offsets', 'row_stop_idx', 'row_sequence', 'row_arrival_secs', 'stop_offsets', 'stop_row_trip_idx', 'stop_row_arrival_secs')
+    __slots__ = ('trip_ids', 'stop_ids', 'trip_lookup', 'stop_lookup') + COLUMNS
+
+    def __init__(self, trip_ids, stop_ids, trip_offsets, row_stop_idx, row_sequence, row_arrival_secs, stop_offsets, stop_row_trip_idx, stop_row_arrival_secs):
+        self.trip_ids, self.stop_ids = trip_ids, stop_ids
+        self.trip_lookup = {t_id: i for i, t_id in enumerate(trip_ids)}
+        self.stop_lookup = {s_id: i for i, s_id in enumerate(stop_ids)}
+        self.trip_offsets, self.row_stop_idx, self.row_sequence, self.row_arrival_secs = trip_offsets, row_stop_idx, row_sequence, row_arrival_secs
+        self.stop_offsets, self.stop_row_trip_idx, self.stop_row_arrival_secs = stop_offsets, stop_row_trip_idx, stop_row_arrival_secs
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Изгражда хранилището от итератор на (trip_id, stop_id, stop_sequence, arrival_time)."""
+        trip_ids, stop_ids, trip_lookup, stop_lookup = [], [], {}, {}
+        t_col, s_col, q_col, a_col = array('i'), array('i'), array('i'), array('i')
+        for t_id, s_id, seq, arrival in rows:
+            t_idx = trip_lookup.get(t_id)
+            if t_idx is None:
+                t_idx = trip_lookup[t_id] = len(trip_ids)
+                trip_ids.append(t_id)
+            s_idx = stop_lookup.get(s_id)
+            if s_idx is None:
+                s_idx = stop_lookup[s_id] = len(stop_ids)
+                stop_ids.append(s_id)
+            secs = gtfs_time_to_seconds(arrival)
+            t_col.append(t_idx); s_col.append(s_idx); q_col.append(seq); a_col.append(-1 if secs is None else secs)
+        trip_offsets, order = _group_rows(t_col, len(trip_ids))
+        for t_idx in range(len(trip_ids)):
+            start, end = trip_offsets[t_idx], trip_offsets[t_idx + 1]
+            order[start:end] = array('i', sorted(order[start:end], key=q_col.__getitem__))
+        row_stop_idx = array('i', [s_col[i] for i in order])
+        row_sequence = array('i', [q_col[i] for i in order])
+        row_arrival_secs = array('i', [a_col[i] for i in order])
+        del t_col, s_col, q_col, a_col, order
+        row_trip_idx = array('i', [0]) * len(row_stop_idx)
+        for t_idx in range(len(trip_ids)):
+            row_trip_idx[trip_offsets[t_idx]:trip_offsets[t_idx + 1]] = array('i', [t_idx]) * (trip_offsets[t_idx + 1] - trip_offsets[t_idx])
+        stop_offsets, stop_order = _group_rows(row_stop_idx, len(stop_ids))
+        for s_idx in range(len(stop_ids)):
+            start, end = stop_offsets[s_idx], stop_offsets[s_idx + 1]
+            stop_order[start:end] = array('i', sorted(stop_order[start:end], key=row_arrival_secs.__getitem__))
+        stop_row_trip_idx = array('i', [row_trip_idx[r] for r in stop_order])
+        stop_row_arrival_secs = array('i', [row_arrival_secs[r] for r in stop_order])
+        return cls(trip_ids, stop_ids, trip_offsets, row_stop_idx, row_sequence, row_arrival_secs, stop_offsets, stop_row_trip_idx, stop_row_arrival_secs)
+
+    def __len__(self):
+        return len(self.row_stop_idx)
+
+    def has_trip(self, trip_id):
+        return trip_id in self.trip_lookup
+
+    def trip_rows(self, trip_id):
+        t_idx = self.trip_lookup.get(trip_id)
+        return range(0) if t_idx is None else range(self.trip_offsets[t_idx], self.trip_offsets[t_idx + 1])
+
+    def get_trip_stops(self, trip_id):
+        """Спирките на курса като [(stop_id, stop_sequence)], подредени по stop_sequence."""
+        return [(self.stop_ids[self.row_stop_idx[r]], self.row_sequence[r]) for r in self.trip_rows(trip_id)]
+
+    def find_trip_stop_row(self, trip_id, stop_id):
+        s_idx = self.stop_lookup.get(stop_id)
+        if s_idx is None: return None
+        found = None
+        for r in self.trip_rows(trip_id):
+            if self.row_stop_idx[r] == s_idx: found = r
+        return found
+
+    def trip_serves_stop(self, trip_id, stop_id):
+        return self.find_trip_stop_row(trip_id, stop_id) is not None
+
+    def first_served_stop(self, trip_id, stop_ids):
+        """Първата от stop_ids (в реда на обхождане), през която минава курсът, или None."""
+        served = {self.row_stop_idx[r] for r in self.trip_rows(trip_id)}
+        return next((s_id for s_id in stop_ids if self.stop_lookup.get(s_id) in served), None)
+
+    def get_trip_arrival(self, trip_id, stop_id):
+        """Време на пристигане (секунди от началото на деня) на курса в спирката или None."""
+        r = self.find_trip_stop_row(trip_id, stop_id)
+        return None if r is None or self.row_arrival_secs[r] < 0 else self.row_arrival_secs[r]
+
+    def get_trip_stop_sequence(self, trip_id, stop_id):
+        r = self.find_trip_stop_row(trip_id, stop_id)
+        return None if r is None else self.row_sequence[r]
+
+    def get_trip_schedule(self, trip_id):
+        """Разписанието на курса като {stop_id: секунди}."""
+        return {self.stop_ids[self.row_stop_idx[r]]: self.row_arrival_secs[r] for r in self.trip_rows(trip_id) if self.row_arrival_secs[r] >= 0}
+
+    def get_trips_for_stop(self, stop_id):
+        s_idx = self.stop_lookup.get(stop_id)
+        if s_idx is None: return []
+        return [self.trip_ids[t_idx] for t_idx in self.stop_row_trip_idx[self.stop_offsets[s_idx]:self.stop_offsets[s_idx + 1]]]
+
+    def arrivals_in_window(self, stop_id, start_secs, end_secs):
+        """Пристигания в спирката със start_secs < време < end_secs като [(trip_idx, секунди)]."""
+        s_idx = self.stop_lookup.get(stop_id)
+        if s_idx is None: return []
+        times = self.stop_row_arrival_secs
+        lo = bisect_right(times, start_secs, self.stop_offsets[s_idx], self.stop_offsets[s_idx + 1])
+        hi = bisect_left(times, end_secs, lo, self.stop_offsets[s_idx + 1])
+        return list(zip(self.stop_row_trip_idx[lo:hi], times[lo:hi]))
+
+    def save(self, path, meta):
+        save_mapped_columns(path, dict(meta, trip_ids=self.trip_ids, stop_ids=self.stop_ids), {name: getattr(self, name) for name in self.COLUMNS})
+
+    @classmethod
+    def open_mapped(cls, path):
+        """Зарежда хранилище, чиито колони са mmap-нати от файл, записан със save(); връща (store, meta)."""
+        meta, columns = open_mapped_columns(path)
+        return cls(meta.pop('trip_ids'), meta.pop('stop_ids'), *(columns[name] for name in cls.COLUMNS)), meta
+
+    def memory_usage(self):
+        """Приблизителен размер в байтове по колони (без самите низове на идентификаторите)."""
+        report = {name: len(getattr(self, name)) * getattr(self, name).itemsize for name in self.COLUMNS}
+        report['id_tables'] = sum(sys.getsizeof(x) for x in (self.trip_ids, self.stop_ids, self.trip_lookup, self.stop_lookup))
+        report['total'] = sum(report.values())
+        return report
+
+
+def simplify_polyline(points, start, end, tolerance):
+    """Douglas–Peucker върху точките [start, end) от плоска колона [lat, lon, ...]; връща индексите на запазените точки.
+
+    Разстоянието е равнинно в градуси, с дължина, скалирана по косинуса на географската ширина.
+    """
+    if end - start <= 2 or tolerance <= 0: return array('i', range(start, end))
+    lon_scale = math.cos(math.radians(points[2 * start]))
+    keep = bytearray(end - start)
+    keep[0] = keep[-1] = 1
+    stack, tol_sq = [(start, end - 1)], tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        ay, ax = points[2 * first], points[2 * first + 1] * lon_scale
+        dy, dx = points[2 * last] - ay, points[2 * last + 1] * lon_scale - ax
+        seg_sq = dx * dx + dy * dy
+        best, best_dist = -1, tol_sq
+        for j in range(first + 1, last):
+            py, px = points[2 * j] - ay, points[2 * j + 1] * lon_scale - ax
+            if seg_sq == 0: dist = px * px + py * py
+            else:
+                cross = px * dy - py * dx
+                dist = cross * cross / seg_sq
+            if dist > best_dist: best, best_dist = j, dist
+        if best >= 0:
+            keep[best - start] = 1
+            stack.append((first, best)); stack.append((best, last))
+    return array('i', (start + k for k, kept in enumerate(keep) if kept))
+
+
+def encode_polyline(points, indices, precision=5):
+    """Кодира точките с дадените индекси в Google Encoded Polyline формат."""
+    factor, out, prev_lat, prev_lon = 10 ** precision, [], 0, 0
+    for j in indices:
+        lat, lon = round(points[2 * j] * factor), round(points[2 * j + 1] * factor)
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+
+class ShapeStore:
+    """Формите от shapes.txt като една плоска колона [lat, lon, ...] с offsets (в точки) по форма.
+
+    Опростените (Douglas–Peucker) варианти по zoom ниво и кодираните polyline низове се кешират при първа нужда.
+    """
+    MAX_SIMPLIFY_ZOOM = 18
+    __slots__ = ('shape_ids', 'shape_lookup', 'offsets', 'points', '_simplified', '_encoded')
+
+    def __init__(self, shape_ids, offsets, points):
+        self.shape_ids, self.offsets, self.points = shape_ids, offsets, points
+        self.shape_lookup = {shape_id: i for i, shape_id in enumerate(shape_ids)}
+        self._simplified, self._encoded = {}, {}
+
+    def __contains__(self, shape_id):
+        idx = self.shape_lookup.get(shape_id)
+        return idx is not None and self.offsets[idx + 1] > self.offsets[idx]
+
+    def __len__(self):
+        return len(self.shape_ids)
+
+    @staticmethod
+    def zoom_tolerance(zoom):
+        """Половин пиксел (256px плочки) при даденото zoom ниво, в градуси."""
+        return 180.0 / (256 << zoom)
+
+    def normalize_zoom(self, zoom):
+        return None if zoom is None or zoom >= self.MAX_SIMPLIFY_ZOOM else max(zoom, 0)
+
+    def indices(self, shape_id, zoom=None):
+        idx = self.shape_lookup.get(shape_id)
+        if idx is None: return None
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        zoom = self.normalize_zoom(zoom)
+        if zoom is None: return range(start, end)
+        key = (idx, zoom)
+        if key not in self._simplified:
+            self._simplified[key] = simplify_polyline(self.points, start, end, self.zoom_tolerance(zoom))
+        return self._simplified[key]
+
+    def get_points(self, shape_id, zoom=None):
+        """Точките на формата като [[lat, lon], ...] (опростени за zoom, ако е зададен) или None."""
+        indices = self.indices(shape_id, zoom)
+        if indices is None: return None
+        points = self.points
+        return [[points[2 * j], points[2 * j + 1]] for j in indices]
+
+    def get_encoded(self, shape_id, zoom=None):
+        """Формата като Google Encoded Polyline низ или None."""
+        key = (shape_id, self.normalize_zoom(zoom))
+        if key not in self._encoded:
+            indices = self.indices(shape_id, zoom)
+            if indices is None: return None
+            self._encoded[key] = encode_polyline(self.points, indices)
+        return self._encoded[key]
+
+    def memory_usage(self):
+        report = {'offsets': len(self.offsets) * self.offsets.itemsize, 'points': len(self.points) * self.points.itemsize}
+        report['simplified'] = sum(len(v) * v.itemsize for v in self._simplified.values())
+        report['encoded'] = sum(sys.getsizeof(v) for v in self._encoded.values())
+        report['total'] = sum(report.values())
+        return report
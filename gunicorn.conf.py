@@ -0,0 +1,46 @@
+# Файл: gunicorn.conf.py
+# Стартиране: gunicorn app:app -c gunicorn.conf.py
+# ASGI режим:  gunicorn asgi_app:asgi_app -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker (threads не се ползва)
+import gc
+import os
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+# В gthread всеки отворен /api/stream държи една от тези нишки до затварянето си: worker-ът приема най-много
+# threads - LIVE_STREAM_RESERVED_THREADS (поне 2) потока и връща 503 над това, за да остане място за другите заявки.
+# За много едновременни потоци - повече нишки (с цената на памет и конкуренция за GIL) или ASGI режимът (вж. по-горе).
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+# Статичните данни се зареждат веднъж в master процеса; worker-ите ги наследяват при fork,
+# а stop_times и shapes са mmap-нати от файл и остават споделени страници.
+preload_app = True
+# Worker-ите записват метриките си в METRICS_DIR, а /metrics ги събира от всички (вж. metrics.Registry);
+# по подразбиране директорията е нова за всяко стартиране.
+if not os.environ.get('METRICS_DIR'): os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='sofia-traffic-metrics-')
+
+
+def on_starting(server):
+    """Изчиства метриките от предишно стартиране, ако METRICS_DIR е зададена отвън."""
+    from metrics import clear_multiprocess_dir
+    clear_multiprocess_dir(os.environ['METRICS_DIR'])
+
+
+def when_ready(server):
+    """Изгражда тежките кешове в master процеса преди стартирането на worker-ите."""
+    import app
+    # При неуспех worker-ите стартират без кешовете и опитват отново при заявка към тях.
+    app.ensure_caches_are_built()
+    # Броячите от зареждането в master процеса влизат в сбора веднъж; worker-ите започват от нула след fork.
+    app.metrics_registry.dump(gauges=False)
+    # Замразените обекти не се обхождат от GC, така че worker-ите не "докосват" и не копират страниците им.
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    """Всеки worker започва да обновява live данните и да записва метриките си веднага, а не при първата заявка."""
+    import app
+    from gunicorn.workers.gthread import ThreadWorker
+    if isinstance(worker, ThreadWorker): app.limit_live_streams_to_threads(worker.cfg.threads)
+    app.start_realtime_refresher()
+    app.metrics_registry.start_sync()
@@ -0,0 +1,209 @@
+# Файл: journey_planner.py
+import heapq
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+from spatial_index import GridIndex, haversine_pairs
+
+UNREACHED = 2**31 - 1
+
+
+def _walk_seconds(meters, walk_speed):
+    return int(math.ceil(meters / walk_speed))
+
+
+def build_footpaths(store, lats, lons, transfer_rows, pathway_rows, radius_m, walk_speed):
+    """Пешеходните прехвърляния между спирките на store като [((до спирка, секунди), ...)] по индекс на спирка.
+
+    Всяка двойка спирки на не повече от radius_m метра по права е свързана; pathways.txt добавя пътеките в станциите
+    (и през възли без курсове), а transfers.txt е с предимство: тип 2 задава времето, тип 3 забранява прехвърлянето.
+    """
+    n_stops, lookup = len(store.stop_ids), store.stop_lookup
+    paths = [{} for _ in range(n_stops)]
+    index = GridIndex.from_points((s, lats[s], lons[s]) for s in range(n_stops) if not math.isnan(lats[s]))
+    for s in range(n_stops):
+        if math.isnan(lats[s]): continue
+        for other, dist in index.within_radius(lats[s], lons[s], radius_m):
+            if other != s: paths[s][other] = _walk_seconds(dist, walk_speed)
+    graph = {}
+    for r in pathway_rows:
+        try: secs = int(r['traversal_time'])
+        except (KeyError, TypeError, ValueError): secs = None
+        a, b = r.get('from_stop_id'), r.get('to_stop_id')
+        if secs is None:
+            # Без traversal_time - по разстоянието, ако и двата края са спирки с координати.
+            if a not in lookup or b not in lookup or math.isnan(lats[lookup[a]]) or math.isnan(lats[lookup[b]]): continue
+            secs = _walk_seconds(haversine_pairs(*(array('d', [c[lookup[x]]]) for c, x in ((lats, a), (lons, a), (lats, b), (lons, b))))[0], walk_speed)
+        graph.setdefault(a, []).append((b, secs))
+        if r.get('is_bidirectional') == '1': graph.setdefault(b, []).append((a, secs))
+    max_path_secs = _walk_seconds(radius_m, walk_speed)
+    for start in graph:
+        if start not in lookup: continue
+        s, best, heap = lookup[start], {start: 0}, [(0, start)]
+        while heap:
+            secs, node = heapq.heappop(heap)
+            if secs > best.get(node, UNREACHED): continue
+            if node != start and node in lookup and secs < paths[s].get(lookup[node], UNREACHED): paths[s][lookup[node]] = secs
+            for nxt, step in graph.get(node, ()):
+                if secs + step <= max_path_secs and secs + step < best.get(nxt, UNREACHED):
+                    best[nxt] = secs + step
+                    heapq.heappush(heap, (secs + step, nxt))
+    for r in transfer_rows:
+        # Прехвърляния между конкретни курсове/линии не се поддържат; важат само тези между спирки (в една спирка - build_change_times).
+        if r.get('from_trip_id') or r.get('to_trip_id') or r.get('from_route_id') or r.get('to_route_id'): continue
+        a, b = lookup.get(r.get('from_stop_id')), lookup.get(r.get('to_stop_id'))
+        if a is None or b is None or a == b: continue
+        if r.get('transfer_type') == '3': paths[a].pop(b, None)
+        elif r.get('transfer_type') == '2' and (r.get('min_transfer_time') or '').isdigit(): paths[a][b] = int(r['min_transfer_time'])
+        elif b not in paths[a]: paths[a][b] = 0
+    return [tuple(p.items()) for p in paths]
+
+
+def build_change_times(store, transfer_rows, default_secs):
+    """Минималното време за прекачване от един курс на друг във всяка спирка на store (array по индекс на спирка).
+
+    По подразбиране е default_secs; редовете на transfers.txt от спирка към самата нея го задават: тип 1 (гарантирано
+    прехвърляне) - 0, тип 2 - min_transfer_time, тип 3 - прекачването в спирката е забранено.
+    """
+    lookup, change = store.stop_lookup, array('i', [default_secs]) * len(store.stop_ids)
+    for r in transfer_rows:
+        if r.get('from_trip_id') or r.get('to_trip_id') or r.get('from_route_id') or r.get('to_route_id'): continue
+        s = lookup.get(r.get('from_stop_id'))
+        if s is None or r.get('to_stop_id') != r.get('from_stop_id'): continue
+        if r.get('transfer_type') == '1': change[s] = 0
+        elif r.get('transfer_type') == '2' and (r.get('min_transfer_time') or '').isdigit(): change[s] = int(r['min_transfer_time'])
+        elif r.get('transfer_type') == '3': change[s] = UNREACHED
+    return change
+
+
+class JourneyPlanner:
+    """Най-ранно пристигане с Connection Scan върху връзките (от спирка до следващата спирка на курса) на store.
+
+    Връзките са подредени по час на тръгване веднъж за версия на фийда. За всяка двойка набори услуги (днес, вчера) се
+    пази отделен ред на сканиране само с активните връзки, в който са вплетени и курсовете на предишния ден след 24:00
+    (с индекс + len(self)). Едно търсене минава веднъж през този ред от началния час и спира, щом тръгването стане по-късно
+    от най-доброто пристигане в целта.
+    """
+    __slots__ = ('store', 'trip_service_ids', 'footpaths', 'change_times', 'conn_dep', 'conn_arr', 'conn_from', 'conn_to', 'conn_trip', 'conn_row', 'scan_orders')
+
+    def __init__(self, store, trip_service_ids, footpaths, change_times):
+        self.store, self.trip_service_ids, self.footpaths, self.change_times = store, trip_service_ids, footpaths, change_times
+        offsets, secs = store.trip_offsets, store.row_arrival_secs
+        rows, trips = array('i'), array('i')
+        for t_idx in range(len(store.trip_ids)):
+            for r in range(offsets[t_idx], offsets[t_idx + 1] - 1):
+                # Хранилището има само времена на пристигане; престоят в спирката се приема за нула.
+                if 0 <= secs[r] <= secs[r + 1]:
+                    rows.append(r); trips.append(t_idx)
+        departures = array('i', [secs[r] for r in rows])
+        order = sorted(range(len(rows)), key=departures.__getitem__)
+        self.conn_row = array('i', [rows[i] for i in order])
+        self.conn_trip = array('i', [trips[i] for i in order])
+        self.conn_dep = array('i', [departures[i] for i in order])
+        del rows, trips, order, departures
+        self.conn_arr = array('i', [secs[r + 1] for r in self.conn_row])
+        self.conn_from = array('i', [store.row_stop_idx[r] for r in self.conn_row])
+        self.conn_to = array('i', [store.row_stop_idx[r + 1] for r in self.conn_row])
+        # По (днешни услуги, вчерашни услуги): различните двойки във фийда са малко (делник, празник и преходите между тях),
+        # затова се пазят всички, вместо датите на поредните заявки да се изместват една друга от кеша.
+        self.scan_orders = {}
+
+    def __len__(self):
+        return len(self.conn_dep)
+
+    def scan_order(self, service_days):
+        """Редът на сканиране за service_days (от ServiceCalendar.service_days); изгражда се веднъж за двойка набори услуги."""
+        (services, _), (prev_services, prev_offset) = service_days[0], service_days[1]
+        key = (services, prev_services)
+        order = self.scan_orders.get(key)
+        if order is not None: return order
+        n, dep, trip, service_ids = len(self), self.conn_dep, self.conn_trip, self.trip_service_ids
+        active, prev_active = bytearray(sid in services for sid in service_ids), bytearray(sid in prev_services for sid in service_ids)
+        today = array('i', [i for i in range(n) if active[trip[i]]])
+        overnight = [i + n for i in range(bisect_left(dep, prev_offset), n) if prev_active[trip[i]]]
+        if overnight:
+            # Нощните курсове от вчера се вплитат само в началото на деня, докъдето стигат.
+            effective_dep = lambda i: dep[i] if i < n else dep[i - n] - prev_offset
+            cut = bisect_left(today, effective_dep(overnight[-1]) + 1, key=effective_dep)
+            today[:cut] = array('i', sorted(list(today[:cut]) + overnight, key=effective_dep))
+        self.scan_orders[key] = today
+        return today
+
+    def plan(self, origins, targets, start_secs, service_days, delays=None, max_duration=3 * 3600):
+        """origins/targets: [(stop_idx, секунди пеша от/до точката)]; service_days: от ServiceCalendar.service_days.
+
+        delays: {(trip_idx, отместване на деня): секунди закъснение}. Връща {"departure", "arrival", "legs"} или None.
+        Закъсненията не пренареждат връзките, така че с тях резултатът е приближение (но винаги изпълним).
+        Качването на друг курс в спирка, до която се е стигнало с превозно средство, е най-рано change_times[спирка]
+        секунди след пристигането; при равни времена печели пътят с по-малко возения, т.е. оставането в същия курс.
+        """
+        store, footpaths, change_times = self.store, self.footpaths, self.change_times
+        dep, arr, frm, to, trip = self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip
+        n, n_trips, n_stops, prev_offset = len(self), len(store.trip_ids), len(store.stop_ids), service_days[1][1]
+        # ready - от кога може да се качи на курс в спирката; ridden - най-ранното пристигане в нея с превозно средство
+        # (оттам се тръгва пеша). Етикетите (how) сочат предишния си етикет и завършват с броя возения.
+        ready, ridden, ready_by, ridden_by, target_walk = [UNREACHED] * n_stops, [UNREACHED] * n_stops, {}, {}, {}
+        for s, walk in targets: target_walk[s] = min(walk, target_walk.get(s, UNREACHED))
+        best, best_stop, best_how = UNREACHED, None, None
+
+        def reach(s, secs, board_secs, how):
+            nonlocal best, best_stop, best_how
+            walk = target_walk.get(s)
+            if walk is not None and (secs + walk < best or (secs + walk == best and how[-1] < best_how[-1])): best, best_stop, best_how = secs + walk, s, how
+            if board_secs < ready[s] or (board_secs == ready[s] and how[-1] < ready_by[s][-1]): ready[s], ready_by[s] = board_secs, how
+
+        for s, walk in origins:
+            origin = ('origin', s, start_secs + walk, walk, 0)
+            reach(s, start_secs + walk, start_secs + walk, origin)
+            for other, secs in footpaths[s]: reach(other, start_secs + walk + secs, start_secs + walk + secs, ('walk', s, other, start_secs + walk + secs, secs, origin, 0))
+        # Ключ на курса е trip_idx за днешния ден и trip_idx + n_trips за вчерашния.
+        delays = {t + (n_trips if o else 0): d for (t, o), d in (delays or {}).items()}
+        max_delay = max(delays.values(), default=0)
+        order, boarded = self.scan_order(service_days), {}
+        effective_dep = lambda i: dep[i] if i < n else dep[i - n] - prev_offset
+        k_end = bisect_right(order, start_secs + max_duration, key=effective_dep)
+        for c in memoryview(order)[bisect_left(order, start_secs, lo=0, hi=k_end, key=effective_dep):k_end]:
+            if c < n:
+                i = c
+                d, key = dep[i], trip[i]
+            else:
+                i = c - n
+                d, key = dep[i] - prev_offset, trip[i] + n_trips
+            if d >= best: break
+            if key not in boarded:
+                # Най-честият случай - спирката още не е достигната - се отсява без търсене на закъснение.
+                e = ready[frm[i]]
+                if e > d + max_delay or (delays and e > d + delays.get(key, 0)): continue
+                boarded[key] = (c, ready_by[frm[i]])
+            delay = delays.get(key, 0) if delays else 0
+            arrival, s = arr[i] - dep[i] + d + delay, to[i]
+            if arrival > ridden[s]: continue
+            board, board_how = boarded[key]
+            rides = board_how[-1] + 1
+            if arrival == ridden[s] and rides >= ridden_by[s][-1]: continue
+            how = ridden_by[s] = ('ride', board, i, dep[i] - d, delay, board_how, rides)
+            ridden[s] = arrival
+            reach(s, arrival, arrival + change_times[s], how)
+            for other, secs in footpaths[s]:
+                # Пеша не се чака за прекачване: времето на прехвърлянето вече го включва.
+                if arrival + secs <= ready[other]: reach(other, arrival + secs, arrival + secs, ('walk', s, other, arrival + secs, secs, how, rides))
+        if best_stop is None: return None
+        return {"departure": start_secs, "arrival": best, "legs": self._legs(best_stop, target_walk[best_stop], best - target_walk[best_stop], best_how)}
+
+    def _legs(self, stop, target_walk, arrival, how):
+        store, n, legs = self.store, len(self), []
+        if target_walk: legs.append({"mode": "walk", "from_stop_id": store.stop_ids[stop], "to_stop_id": None, "departure": arrival, "arrival": arrival + target_walk})
+        while how[0] != 'origin':
+            if how[0] == 'walk':
+                _, prev, stop, arrival, secs, how, _ = how
+                legs.append({"mode": "walk", "from_stop_id": store.stop_ids[prev], "to_stop_id": store.stop_ids[stop], "departure": arrival - secs, "arrival": arrival})
+            else:
+                _, board, alight, o, delay, how, _ = how
+                board -= n if board >= n else 0
+                legs.append({"mode": "transit", "trip_id": store.trip_ids[self.conn_trip[board]], "service_day_offset": o, "from_stop_id": store.stop_ids[self.conn_from[board]], "to_stop_id": store.stop_ids[self.conn_to[alight]],
+                             "departure": self.conn_dep[board] - o + delay, "arrival": self.conn_arr[alight] - o + delay, "stops": self.conn_row[alight] - self.conn_row[board] + 1, "delay_seconds": delay})
+        _, stop, arrival, walk, _ = how
+        if walk: legs.append({"mode": "walk", "from_stop_id": None, "to_stop_id": store.stop_ids[stop], "departure": arrival - walk, "arrival": arrival})
+        legs.reverse()
+        return legs
@@ -0,0 +1,144 @@
+# Файл: live_stream.py
+import threading
+from collections import Counter, namedtuple
+
+# Последното състояние на един абониран ключ: версията, в която се е променило, предишната такава версия,
+# пълният списък (кодиран JSON) и разликата спрямо предишния (кодиран JSON или None).
+LiveEntry = namedtuple('LiveEntry', ['changed_version', 'previous_version', 'items', 'full_json', 'diff_json'])
+KEEPALIVE = b': keep-alive\n\n'
+
+
+def _diff_items(old_items, new_items, id_field):
+    old_by_id = {item[id_field]: item for item in old_items}
+    new_by_id = {item[id_field]: item for item in new_items}
+    changed = [item for item_id, item in new_by_id.items() if old_by_id.get(item_id) != item]
+    removed = [item_id for item_id in old_by_id if item_id not in new_by_id]
+    return {"changed": changed, "removed": removed, "order": [item[id_field] for item in new_items]}
+
+
+class LiveHub:
+    """Разпраща промените в live данните към абонатите на Server-Sent Events поток.
+
+    publish() се вика от цикъла за обновяване: за всеки абониран ключ резултатът се изчислява и
+    кодира веднъж, заедно с разликата спрямо предишния, а всички абонати получават едни и същи байтове.
+    """
+
+    def __init__(self, compute, encode, id_field, max_subscribers):
+        self.compute, self.encode, self.id_field, self.max_subscribers = compute, encode, id_field, max_subscribers
+        self.condition = threading.Condition()
+        self.version, self.subscribers, self.entries, self.refcounts = 0, 0, {}, Counter()
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """callback() се вика след всеки publish() от нишката, която публикува (напр. за да събуди async абонатите)."""
+        self.listeners.append(callback)
+
+    def try_subscribe(self, keys):
+        """Регистрира абонат за ключовете; връща False, ако лимитът е достигнат."""
+        with self.condition:
+            if self.subscribers >= self.max_subscribers: return False
+            self.subscribers += 1
+            self.refcounts.update(keys)
+            missing = [key for key in keys if key not in self.entries]
+        if missing:
+            computed = self.compute(missing)
+            with self.condition:
+                for key in missing:
+                    if key not in self.entries and key in computed:
+                        self.entries[key] = LiveEntry(self.version, None, computed[key], self.encode(computed[key]), None)
+        return True
+
+    def unsubscribe(self, keys):
+        with self.condition:
+            self.subscribers -= 1
+            self.refcounts.subtract(keys)
+            for key in keys:
+                if self.refcounts[key] <= 0:
+                    del self.refcounts[key]
+                    self.entries.pop(key, None)
+
+    def publish(self):
+        with self.condition:
+            keys = list(self.refcounts)
+        if not keys: return
+        computed = self.compute(keys)
+        with self.condition:
+            self.version += 1
+            for key, items in computed.items():
+                if key not in self.refcounts: continue
+                old, full_json = self.entries.get(key), self.encode(items)
+                if old is not None and old.full_json == full_json: continue
+                diff_json = self.encode(_diff_items(old.items, items, self.id_field)) if old is not None else None
+                self.entries[key] = LiveEntry(self.version, old.changed_version if old is not None else None, items, full_json, diff_json)
+            self.condition.notify_all()
+        for callback in self.listeners: callback()
+
+    def stream(self, keys, keepalive_seconds):
+        """SSE потокът за вече абониран (try_subscribe) клиент; WSGI сървърът вика close() при затваряне на връзката."""
+        return _SubscriberStream(self, keys, self._events(keys, keepalive_seconds))
+
+    def _events(self, keys, keepalive_seconds):
+        version, seen, event = self._snapshot_event(keys)
+        yield event
+        while True:
+            with self.condition:
+                changed = self.condition.wait_for(lambda: self.version > version, timeout=keepalive_seconds)
+            if not changed:
+                yield KEEPALIVE
+                continue
+            version, event = self._update_event(keys, seen)
+            if event: yield event
+
+    async def stream_async(self, keys, keepalive_seconds, wait_for_publish):
+        """Като stream(), но за ASGI: wait_for_publish(timeout) е корутина, която чака следващия publish() и връща
+        False при изтичане. Отписването (unsubscribe) е грижа на извикващия."""
+        version, seen, event = self._snapshot_event(keys)
+        yield event
+        while True:
+            # Между проверката и началото на чакането няма await, така че publish() не може да се изпусне.
+            if self.version <= version and not await wait_for_publish(keepalive_seconds):
+                yield KEEPALIVE
+                continue
+            version, event = self._update_event(keys, seen)
+            if event: yield event
+
+    def _snapshot_event(self, keys):
+        with self.condition:
+            version, entries = self.version, {key: self.entries.get(key) for key in keys}
+        seen = {key: entry.changed_version for key, entry in entries.items() if entry is not None}
+        return version, seen, self._event('snapshot', version, [(key, b'{"full":' + entry.full_json + b'}') for key, entry in entries.items() if entry is not None])
+
+    def _update_event(self, keys, seen):
+        # Промените след seen (обновява го на място); събитието е None, ако за тези ключове няма промяна.
+        with self.condition:
+            version, fresh = self.version, {key: self.entries.get(key) for key in keys}
+        parts = []
+        for key, entry in fresh.items():
+            if entry is None or seen.get(key) == entry.changed_version: continue
+            # Разлика пращаме само ако клиентът има точно предишното състояние; иначе - пълния списък.
+            if entry.diff_json is not None and entry.previous_version == seen.get(key): parts.append((key, entry.diff_json))
+            else: parts.append((key, b'{"full":' + entry.full_json + b'}'))
+            seen[key] = entry.changed_version
+        return version, (self._event('update', version, parts) if parts else None)
+
+    def _event(self, name, version, parts):
+        body = b','.join(self.encode(key) + b':' + value for key, value in parts)
+        return b'event: ' + name.encode() + b'\ndata: {"version":' + str(version).encode() + b',"keys":{' + body + b'}}\n\n'
+
+
+class _SubscriberStream:
+    # Отписването е в close(), а не във finally на генератора, защото close() на още нестартиран генератор не изпълнява finally.
+    def __init__(self, hub, keys, events):
+        self.hub, self.keys, self.events, self.closed = hub, keys, events, False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.events)
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.events.close()
+        self.hub.unsubscribe(self.keys)
@@ -0,0 +1,45 @@
+# Файл: memo_cache.py
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Ограничен по брой записи LRU кеш с броячи за попадения, пропуски, изхвърляния и изчиствания.
+
+    Ключалката пази само операциите по речника; стойностите се изчисляват извън нея.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries, self._lock = OrderedDict(), threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            if self._entries: self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else None, "evictions": self.evictions, "invalidations": self.invalidations}
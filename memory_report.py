@@ -0,0 +1,55 @@
+# Файл: memory_report.py
+# Сравнява паметта за stop_times.txt: старите вложени речници срещу колонното StopTimesStore.
+import csv
+import os
+import sys
+import time
+import tracemalloc
+
+from gtfs_store import StopTimesStore
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__)) + "/"
+
+
+def read_rows(path):
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for r in csv.DictReader(f):
+            try:
+                yield r['trip_id'], r['stop_id'], int(r['stop_sequence']), r['arrival_time']
+            except (ValueError, KeyError):
+                continue
+
+
+def build_legacy(path):
+    """Същите четири структури, които app.py държеше преди колонното хранилище."""
+    schedule_by_trip, trip_stops_sequence, trip_stop_sequences_map, stop_to_trips_map = {}, {}, {}, {}
+    for t_id, s_id, s_seq, arrival in read_rows(path):
+        schedule_by_trip.setdefault(t_id, {})[s_id] = arrival
+        trip_stops_sequence.setdefault(t_id, []).append({'stop_id': s_id, 'stop_sequence': s_seq})
+        trip_stop_sequences_map.setdefault(t_id, {})[s_id] = s_seq
+        stop_to_trips_map.setdefault(s_id, []).append(t_id)
+    for t_id in trip_stops_sequence:
+        trip_stops_sequence[t_id].sort(key=lambda x: x['stop_sequence'])
+    return schedule_by_trip, trip_stops_sequence, trip_stop_sequences_map, stop_to_trips_map
+
+
+def measure(label, builder):
+    tracemalloc.start()
+    start_time = time.time()
+    result = builder()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<20} {current / 2**20:9.1f} MB задържани, {peak / 2**20:9.1f} MB пик, {time.time() - start_time:6.2f} с")
+    return result, current
+
+
+if __name__ == "__main__":
+    path = os.path.join(sys.argv[1] if len(sys.argv) > 1 else BASE_PATH, 'stop_times.txt')
+    print(f"Файл: {path}")
+    legacy, legacy_bytes = measure("Вложени речници", lambda: build_legacy(path))
+    del legacy
+    store, store_bytes = measure("StopTimesStore", lambda: StopTimesStore.from_rows(read_rows(path)))
+    print(f"Редове: {len(store)}, курсове: {len(store.trip_ids)}, спирки: {len(store.stop_ids)}")
+    for column, size in store.memory_usage().items():
+        print(f"  {column:<24} {size / 2**20:9.2f} MB")
+    print(f"Съотношение: {legacy_bytes / max(store_bytes, 1):.1f}x по-малко памет")
@@ -0,0 +1,237 @@
+# Файл: metrics.py
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}' if labels else ''
+
+
+def _format_value(value):
+    if value == math.inf: return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _is_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+
+def clear_multiprocess_dir(directory):
+    """Изтрива файловете с метрики от предишно стартиране - броячите на спрелите процеси иначе остават в сумата."""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('metrics-'):
+            try: os.remove(os.path.join(directory, name))
+            except FileNotFoundError: pass
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values, self._lock = {}, threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def set(self, value, **labels):
+        # За броячи - само от collector, който огледално показва брояч, поддържан другаде.
+        key = self._key(labels)
+        with self._lock: self._values[key] = value
+
+    def render(self, labelnames=None, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        if values is None:
+            with self._lock: values = dict(self._values)
+            labelnames = self.labelnames
+        for key, value in sorted(values.items()): lines.extend(self._render_value(list(zip(labelnames, key)), value))
+        return lines
+
+    def dump_values(self):
+        with self._lock: return [[list(key), value] for key, value in self._values.items()]
+
+    def merge_values(self, processes):
+        # processes: [(pid, жив ли е, стойности от dump_values)]; броячите на спрелите процеси остават в сумата.
+        merged = {}
+        for _, _, values in processes:
+            for key, value in values: merged[tuple(key)] = merged.get(tuple(key), 0) + value
+        return self.labelnames, merged
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def merge_values(self, processes):
+        # Моментните стойности не се сумират: всеки жив процес е отделна серия с етикет pid.
+        merged = {tuple(key) + (str(pid),): value for pid, alive, values in processes if alive for key, value in values}
+        return self.labelnames + ('pid',), merged
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None: state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - start, **labels)
+
+    def dump_values(self):
+        with self._lock: return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def merge_values(self, processes):
+        merged = {}
+        for _, _, values in processes:
+            for key, (counts, total, count) in values:
+                state = merged.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+                state[0] = [a + b for a, b in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+        return self.labelnames, merged
+
+    def _render_value(self, labels, value):
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", _format_value(bound))])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+
+class Registry:
+    """Метриките на един процес в текстовия формат на Prometheus.
+
+    collectors са функции, които се викат при всяко четене и обновяват стойности, които иначе се пазят другаде
+    (възраст на снимката, статистики на кешове и т.н.), вместо да се поддържат при всяка промяна.
+
+    С multiprocess_dir (обща за всички worker-и директория) всеки процес записва стойностите си там на всеки
+    sync_interval секунди и при всяко четене, а render() връща сбора на броячите и хистограмите от всички процеси
+    и моментните стойности на живите процеси с етикет pid - без значение кой worker е получил заявката.
+    """
+
+    def __init__(self, multiprocess_dir=None, sync_interval=5):
+        self.metrics, self.collectors = [], []
+        self.multiprocess_dir, self.sync_interval, self._sync_pid, self._sync_lock = multiprocess_dir, sync_interval, None, threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # Нишка на родителя може да е държала ключалката на някоя метрика в момента на fork.
+        self._sync_lock = threading.Lock()
+        for metric in self.metrics:
+            metric._lock = threading.Lock()
+            # Натрупаното в родителя е в неговия файл (вж. dump); детето брои само своето, за да не се сумира два пъти.
+            if self.multiprocess_dir is not None and not isinstance(metric, Gauge): metric._values = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        for collect in self.collectors: collect()
+        if self.multiprocess_dir is None: return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+        self.dump()
+        processes, lines = self._load_processes(), []
+        for metric in self.metrics:
+            labelnames, values = metric.merge_values([(pid, alive, values.get(metric.name, [])) for pid, alive, values in processes])
+            lines.extend(metric.render(labelnames, values))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, gauges=True):
+        """Записва стойностите на процеса във файла му в multiprocess_dir; gauges=False - само броячите и хистограмите."""
+        values = {metric.name: metric.dump_values() for metric in self.metrics if gauges or not isinstance(metric, Gauge)}
+        path = os.path.join(self.multiprocess_dir, f'metrics-{os.getpid()}.json')
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f: json.dump(values, f)
+        os.replace(f'{path}.tmp', path)
+
+    def _load_processes(self):
+        processes = []
+        for name in os.listdir(self.multiprocess_dir):
+            if not (name.startswith('metrics-') and name.endswith('.json')): continue
+            try:
+                pid = int(name[len('metrics-'):-len('.json')])
+                with open(os.path.join(self.multiprocess_dir, name), encoding='utf-8') as f: processes.append((pid, _is_alive(pid), json.load(f)))
+            except (OSError, ValueError): continue
+        return processes
+
+    def start_sync(self):
+        """В многопроцесен режим стартира (веднъж за процес) нишката, която периодично записва стойностите му."""
+        if self.multiprocess_dir is None or self._sync_pid == os.getpid(): return
+        with self._sync_lock:
+            if self._sync_pid == os.getpid(): return
+            self._sync_pid = os.getpid()
+            threading.Thread(target=self._sync_loop, name='metrics-sync', daemon=True).start()
+
+    def _sync_loop(self):
+        while True:
+            try:
+                for collect in self.collectors: collect()
+                self.dump()
+            except Exception as e: print(f"Метриките не могат да се запишат в {self.multiprocess_dir}: {e}", file=sys.stderr)
+            time.sleep(self.sync_interval)
+
+
+@contextmanager
+def timed_acquire(guard, histogram, **labels):
+    """Като `with guard:` (ключалка или context manager), но записва времето за чакане в histogram."""
+    start = time.perf_counter()
+    with guard:
+        histogram.observe(time.perf_counter() - start, **labels)
+        yield
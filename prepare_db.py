@@ -2,126 +2,148 @@
 import sqlite3
 import csv
 import os
+import time
+import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from gtfs_store import gtfs_time_to_seconds
 
 # Път до GTFS файловете
 BASE_PATH = os.path.dirname(os.path.abspath(__file__)) + "/"
 DB_FILE = os.path.join(BASE_PATH, "gtfs.db")
+BATCH_SIZE = 50000
+
+# Таблица -> (файл, колони, ограничения). Всяка колона е (име, SQL тип, поле в CSV, преобразуване или None).
+# Времената от stop_times се пазят и като текст, и като цели секунди от началото на деня на услугата.
+TABLES = {
+    'stops': ('stops.txt', [('stop_id', 'TEXT', 'stop_id', None), ('stop_code', 'TEXT', 'stop_code', None), ('stop_name', 'TEXT', 'stop_name', None), ('stop_lat', 'REAL', 'stop_lat', None), ('stop_lon', 'REAL', 'stop_lon', None)], 'PRIMARY KEY (stop_id)'),
+    'routes': ('routes.txt', [('route_id', 'TEXT', 'route_id', None), ('route_short_name', 'TEXT', 'route_short_name', None), ('route_long_name', 'TEXT', 'route_long_name', None), ('route_type', 'INTEGER', 'route_type', None)], 'PRIMARY KEY (route_id)'),
+    'trips': ('trips.txt', [('route_id', 'TEXT', 'route_id', None), ('service_id', 'TEXT', 'service_id', None), ('trip_id', 'TEXT', 'trip_id', None), ('trip_headsign', 'TEXT', 'trip_headsign', None), ('direction_id', 'INTEGER', 'direction_id', None), ('shape_id', 'TEXT', 'shape_id', None)], 'PRIMARY KEY (trip_id)'),
+    'stop_times': ('stop_times.txt', [('trip_id', 'TEXT', 'trip_id', None), ('arrival_time', 'TEXT', 'arrival_time', None), ('departure_time', 'TEXT', 'departure_time', None), ('stop_id', 'TEXT', 'stop_id', None), ('stop_sequence', 'INTEGER', 'stop_sequence', None),
+                   ('arrival_secs', 'INTEGER', 'arrival_time', gtfs_time_to_seconds), ('departure_secs', 'INTEGER', 'departure_time', gtfs_time_to_seconds)], 'PRIMARY KEY (trip_id, stop_sequence)'),
+    'shapes': ('shapes.txt', [('shape_id', 'TEXT', 'shape_id', None), ('shape_pt_lat', 'REAL', 'shape_pt_lat', None), ('shape_pt_lon', 'REAL', 'shape_pt_lon', None), ('shape_pt_sequence', 'INTEGER', 'shape_pt_sequence', None)], None),
+    'calendar_dates': ('calendar_dates.txt', [('service_id', 'TEXT', 'service_id', None), ('date', 'TEXT', 'date', None), ('exception_type', 'INTEGER', 'exception_type', None)], 'PRIMARY KEY (service_id, date)'),
+    'transfers': ('transfers.txt', [('from_stop_id', 'TEXT', 'from_stop_id', None), ('to_stop_id', 'TEXT', 'to_stop_id', None), ('transfer_type', 'INTEGER', 'transfer_type', None), ('min_transfer_time', 'INTEGER', 'min_transfer_time', None)], None),
+    'translations': ('translations.txt', [('table_name', 'TEXT', 'table_name', None), ('field_name', 'TEXT', 'field_name', None), ('language', 'TEXT', 'language', None), ('translation', 'TEXT', 'translation', None), ('record_id', 'TEXT', 'record_id', None), ('record_sub_id', 'TEXT', 'record_sub_id', None), ('field_value', 'TEXT', 'field_value', None)], None),
+}
+# Ред на вмъкване в крайната база, съвпадащ с първичния ключ, за да се пълни B-дървото последователно.
+MERGE_ORDER = {'stop_times': 'trip_id, stop_sequence', 'shapes': 'shape_id, shape_pt_sequence'}
+INDEXES = [
+    "CREATE INDEX idx_stop_times_stop_id ON stop_times (stop_id, arrival_secs);",
+    "CREATE INDEX idx_trips_route_id ON trips (route_id);",
+    "CREATE INDEX idx_shapes_shape_id ON shapes (shape_id, shape_pt_sequence);",
+    "CREATE INDEX idx_calendar_dates_date ON calendar_dates (date);",
+    "CREATE INDEX idx_transfers_from_stop_id ON transfers (from_stop_id);",
+]
+# Настройки за еднократно масово зареждане: без fsync и с голям кеш; журналът е WAL в крайната база.
+BULK_LOAD_PRAGMAS = ["PRAGMA journal_mode=WAL;", "PRAGMA synchronous=OFF;", "PRAGMA temp_store=MEMORY;", "PRAGMA cache_size=-262144;"]
+
+
+def _table_ddl(table_name, with_constraints=True):
+    _, columns, constraints = TABLES[table_name]
+    parts = [f"{name} {sql_type}" for name, sql_type, _, _ in columns]
+    if with_constraints and constraints: parts.append(constraints)
+    return f"CREATE TABLE {table_name} ({', '.join(parts)})"
+
+
+def _iter_rows(filename, columns):
+    """Чете CSV файла ред по ред и връща кортежи за вмъкване, без да държи файла в паметта."""
+    with open(os.path.join(BASE_PATH, filename), 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            yield tuple(convert(row.get(field)) if convert and row.get(field) else row.get(field) for _, _, field, convert in columns)
+
+
+def _import_table_part(table_name, part_file, batch_size):
+    """Импортира една таблица в отделен временен файл (в отделен процес); връща (таблица, файл, брой редове, секунди)."""
+    start = time.time()
+    filename, columns, _ = TABLES[table_name]
+    if os.path.exists(part_file): os.remove(part_file)
+    conn = sqlite3.connect(part_file)
+    conn.execute("PRAGMA journal_mode=OFF;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute(_table_ddl(table_name, with_constraints=False))
+    sql = f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * len(columns))})"
+    rows, count = _iter_rows(filename, columns), 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch: break
+        conn.executemany(sql, batch)
+        count += len(batch)
+    conn.commit()
+    conn.close()
+    return table_name, part_file, count, time.time() - start
+
 
 def create_database():
     """Създава SQLite базата данни и таблиците."""
     # Изтриваме старата база данни, ако съществува
-    if os.path.exists(DB_FILE):
-        os.remove(DB_FILE)
-        
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    for path in (DB_FILE, DB_FILE + '-wal', DB_FILE + '-shm'):
+        if os.path.exists(path): os.remove(path)
 
+    conn = sqlite3.connect(DB_FILE)
     print("Създаване на таблици...")
-
-    # Създаваме таблици, които отразяват структурата на GTFS файловете
-    cursor.execute("""
-        CREATE TABLE stops (
-            stop_id TEXT PRIMARY KEY,
-            stop_code TEXT,
-            stop_name TEXT,
-            stop_lat REAL,
-            stop_lon REAL
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE routes (
-            route_id TEXT PRIMARY KEY,
-            route_short_name TEXT,
-            route_long_name TEXT,
-            route_type INTEGER
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE trips (
-            route_id TEXT,
-            service_id TEXT,
-            trip_id TEXT PRIMARY KEY,
-            trip_headsign TEXT,
-            direction_id INTEGER,
-            shape_id TEXT
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE stop_times (
-            trip_id TEXT,
-            arrival_time TEXT,
-            departure_time TEXT,
-            stop_id TEXT,
-            stop_sequence INTEGER,
-            PRIMARY KEY (trip_id, stop_sequence)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE shapes (
-            shape_id TEXT,
-            shape_pt_lat REAL,
-            shape_pt_lon REAL,
-            shape_pt_sequence INTEGER
-        )
-    """)
-    
-    # ... добави и други таблици, ако са нужни (напр. calendar_dates) ...
-
+    for table_name in TABLES: conn.execute(_table_ddl(table_name))
     conn.commit()
     conn.close()
     print("Таблиците са създадени.")
 
-def import_data():
-    """Импортира данните от CSV файловете в базата данни."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    def import_file(filename, table_name, columns):
-        print(f"Импортиране на {filename}...")
-        with open(os.path.join(BASE_PATH, filename), 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            # Създаваме SQL заявка от типа INSERT INTO table (...) VALUES (?, ?, ...)
-            sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
-            
-            # Подготвяме данните за bulk insert
-            data_to_insert = []
-            for row in reader:
-                data_to_insert.append(tuple(row.get(col) for col in columns))
-
-            cursor.executemany(sql, data_to_insert)
-        conn.commit()
-        print(f"{filename} е импортиран успешно.")
-
-    import_file('stops.txt', 'stops', ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon'])
-    import_file('routes.txt', 'routes', ['route_id', 'route_short_name', 'route_long_name', 'route_type'])
-    import_file('trips.txt', 'trips', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'])
-    import_file('stop_times.txt', 'stop_times', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
-    import_file('shapes.txt', 'shapes', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'])
 
-    conn.close()
+def import_data(workers=None, batch_size=BATCH_SIZE):
+    """Импортира данните от CSV файловете в базата данни.
+
+    Всяка таблица се чете поточно на партиди в собствен временен файл, като таблиците се обработват паралелно
+    в отделни процеси; после временните файлове се прикачват (ATTACH) и се сливат в основната база.
+    """
+    tables = [t for t, (filename, _, _) in TABLES.items() if os.path.exists(os.path.join(BASE_PATH, filename))]
+    for t in TABLES:
+        if t not in tables: print(f"{TABLES[t][0]} липсва, таблицата {t} остава празна.")
+    parts = {t: f"{DB_FILE}.{t}.part" for t in tables}
+    # Най-големите файлове тръгват първи, за да не чакаме накрая един дълъг процес.
+    tables.sort(key=lambda t: os.path.getsize(os.path.join(BASE_PATH, TABLES[t][0])), reverse=True)
+    with ProcessPoolExecutor(max_workers=workers or min(len(tables), os.cpu_count() or 1) or 1) as executor:
+        futures = [executor.submit(_import_table_part, t, parts[t], batch_size) for t in tables]
+        for future in futures:
+            table_name, _, count, seconds = future.result()
+            print(f"{TABLES[table_name][0]} е прочетен: {count} реда за {seconds:.1f} с.")
+
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    for pragma in BULK_LOAD_PRAGMAS: conn.execute(pragma)
+    try:
+        for table_name in tables:
+            print(f"Сливане на {table_name}...")
+            conn.execute("ATTACH DATABASE ? AS part", (parts[table_name],))
+            conn.execute("BEGIN")
+            order = f" ORDER BY {MERGE_ORDER[table_name]}" if table_name in MERGE_ORDER else ""
+            conn.execute(f"INSERT INTO main.{table_name} SELECT * FROM part.{table_name}{order}")
+            conn.execute("COMMIT")
+            conn.execute("DETACH DATABASE part")
+    finally:
+        conn.close()
+        for part_file in parts.values():
+            if os.path.exists(part_file): os.remove(part_file)
+
 
 def create_indexes():
     """Създава индекси за по-бързи заявки."""
     print("Създаване на индекси...")
     conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute("CREATE INDEX idx_stop_times_trip_id ON stop_times (trip_id);")
-    cursor.execute("CREATE INDEX idx_stop_times_stop_id ON stop_times (stop_id);")
-    cursor.execute("CREATE INDEX idx_trips_route_id ON trips (route_id);")
-    cursor.execute("CREATE INDEX idx_shapes_shape_id ON shapes (shape_id);")
-    
+    for pragma in BULK_LOAD_PRAGMAS: conn.execute(pragma)
+    for statement in INDEXES: conn.execute(statement)
     conn.commit()
+    conn.execute("ANALYZE;")
+    # Връщаме нормален журнал, за да остане един самостоятелен файл без -wal/-shm.
+    conn.execute("PRAGMA journal_mode=DELETE;")
     conn.close()
     print("Индексите са създадени.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Импортира GTFS файловете в SQLite базата gtfs.db.")
+    parser.add_argument('--workers', type=int, default=None, help="брой паралелни процеси (по подразбиране - по един на таблица, до броя ядра)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="редове в една партида при вмъкване")
+    args = parser.parse_args()
+    start_time = time.time()
     create_database()
-    import_data()
+    import_data(args.workers, args.batch_size)
     create_indexes()
-    print("\nБазата данни 'gtfs.db' е създадена успешно!")
\ No newline at end of file
+    print(f"\nБазата данни 'gtfs.db' е създадена успешно за {time.time() - start_time:.1f} с!")
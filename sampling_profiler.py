@@ -0,0 +1,74 @@
+# Файл: sampling_profiler.py
+import json
+import os
+import sys
+import threading
+from collections import Counter
+
+
+def _stack_key(frame, max_depth):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """Снима стека на една нишка на всеки interval секунди от отделна нишка, докато не бъде спрян.
+
+    Резултатът е {стек във "folded" формат (root;...;leaf): брой проби}, подходящ за flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, thread_id, interval=0.001, max_depth=64):
+        self.thread_id, self.interval, self.max_depth = thread_id, interval, max_depth
+        self.stacks, self.samples = Counter(), 0
+        self._stop, self._thread = threading.Event(), None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: return
+            self.stacks[_stack_key(frame, self.max_depth)] += 1
+            self.samples += 1
+
+
+def profile_thread(interval=0.001):
+    """Стартира профилиране на текущата нишка."""
+    return SamplingProfiler(threading.get_ident(), interval).start()
+
+
+def save_profile(directory, profile_id, meta, profiler, keep):
+    """Записва профила като JSON файл в directory (общ за всички worker-и) и оставя само последните keep файла."""
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'{profile_id}.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(meta, id=profile_id, samples=profiler.samples, interval_ms=profiler.interval * 1000, stacks=dict(profiler.stacks.most_common())), f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(directory, f'{profile_id}.json'))
+    for name in list_profile_files(directory)[keep:]:
+        try: os.remove(os.path.join(directory, name))
+        except FileNotFoundError: pass
+
+
+def list_profile_files(directory):
+    """Имената на профилите, от най-новия."""
+    try: names = [name for name in os.listdir(directory) if name.endswith('.json')]
+    except FileNotFoundError: return []
+    return sorted(names, reverse=True)
+
+
+def load_profile(directory, profile_id):
+    try:
+        with open(os.path.join(directory, f'{profile_id}.json'), encoding='utf-8') as f: return json.load(f)
+    except FileNotFoundError: return None
@@ -0,0 +1,51 @@
+# Файл: service_calendar.py
+from datetime import datetime, timedelta
+
+SECONDS_PER_DAY = 86400
+
+
+def parse_service_date(text):
+    """'YYYYMMDD' или 'YYYY-MM-DD' -> date; ValueError при друг формат."""
+    return datetime.strptime(text.replace('-', '') if len(text) == 10 else text, '%Y%m%d').date()
+
+
+class ServiceCalendar:
+    """Активните услуги за всяка дата от calendar_dates.txt, изчислени веднъж при зареждането на фийда.
+
+    Дата с поне едно добавяне (exception_type 1) е празничен ден - активни са всички услуги, които някога се добавят;
+    в противен случай - всички останали. Изключенията за самата дата се прилагат отгоре.
+    Датите, които ги няма във файла, делят общия набор default_services.
+    """
+
+    def __init__(self, calendar_dates_rows, all_service_ids):
+        added, removed = {}, {}
+        for r in calendar_dates_rows:
+            if r.get('exception_type') == '1': added.setdefault(r['date'], set()).add(r['service_id'])
+            elif r.get('exception_type') == '2': removed.setdefault(r['date'], set()).add(r['service_id'])
+        holiday_service_ids = set().union(*added.values())
+        self.default_services = frozenset(set(all_service_ids) - holiday_service_ids)
+        self.services_by_date = {}
+        for date_str in added.keys() | removed.keys():
+            services = (holiday_service_ids if date_str in added else self.default_services) | added.get(date_str, set())
+            self.services_by_date[date_str] = frozenset(services - removed.get(date_str, set()))
+        # Периодът на фийда - от първата до последната дата в calendar_dates.txt (None, ако във файла няма дати).
+        dates = sorted(self.services_by_date)
+        self.first_date, self.last_date = (parse_service_date(dates[0]), parse_service_date(dates[-1])) if dates else (None, None)
+        # Делнично/празнично разписание по деня от седмицата на датите, в които услугата се среща.
+        self.weekday_schedule_ids, self.holiday_schedule_ids = set(), set()
+        for r in calendar_dates_rows:
+            (self.holiday_schedule_ids if datetime.strptime(r['date'], '%Y%m%d').weekday() >= 5 else self.weekday_schedule_ids).add(str(r['service_id']))
+
+    def covers(self, day):
+        return self.first_date is None or self.first_date <= day <= self.last_date
+
+    def services_on(self, day):
+        return self.services_by_date.get(day.strftime('%Y%m%d'), self.default_services)
+
+    def service_days(self, day):
+        """[(услуги, отместване в секунди)] за днешния ден на услугата и предишния.
+
+        Курсовете на вчерашния ден с времена след 24:00 още се движат след полунощ; за тях времето от началото
+        на днешния ден е времето в разписанието минус отместването.
+        """
+        return [(self.services_on(day), 0), (self.services_on(day - timedelta(days=1)), SECONDS_PER_DAY)]
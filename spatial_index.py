@@ -0,0 +1,116 @@
+# Файл: spatial_index.py
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE_LAT = EARTH_RADIUS_M * math.pi / 180
+DEFAULT_CELL_DEG = 0.01
+
+
+def _haversine_python(lat, lon, lats, lons, indices):
+    phi1, cos_phi1, result = math.radians(lat), math.cos(math.radians(lat)), []
+    for i in indices:
+        phi2 = math.radians(lats[i])
+        a = math.sin((phi2 - phi1) / 2) ** 2 + cos_phi1 * math.cos(phi2) * math.sin(math.radians(lons[i] - lon) / 2) ** 2
+        result.append(2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a))))
+    return result
+
+
+def _haversine_numpy(lat, lon, lats, lons):
+    phi1, phi2 = np.radians(lat), np.radians(lats)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+class GridIndex:
+    """Равномерна решетка от клетки cell_deg x cell_deg върху (lat, lon) за търсене в радиус и в правоъгълник.
+
+    Решетката дава кандидатите, а точните разстояния се смятат наведнъж за всички тях (с numpy, ако е наличен).
+    """
+    __slots__ = ('items', 'lats', 'lons', 'cell_deg', 'cells', '_np_lats', '_np_lons')
+
+    def __init__(self, items, lats, lons, cell_deg=DEFAULT_CELL_DEG):
+        self.items, self.lats, self.lons, self.cell_deg = list(items), array('d', lats), array('d', lons), cell_deg
+        self.cells = {}
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            key = self._cell(lat, lon)
+            if key not in self.cells: self.cells[key] = array('i')
+            self.cells[key].append(i)
+        self._np_lats = np.frombuffer(self.lats, dtype=np.float64) if np is not None else None
+        self._np_lons = np.frombuffer(self.lons, dtype=np.float64) if np is not None else None
+
+    @classmethod
+    def from_points(cls, points, cell_deg=DEFAULT_CELL_DEG):
+        """Изгражда индекса от итератор на (item, lat, lon)."""
+        items, lats, lons = [], array('d'), array('d')
+        for item, lat, lon in points:
+            items.append(item); lats.append(lat); lons.append(lon)
+        return cls(items, lats, lons, cell_deg)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        (lat_lo, lon_lo), (lat_hi, lon_hi) = self._cell(min_lat, min_lon), self._cell(max_lat, max_lon)
+        candidates = array('i')
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self.cells):
+            for (cell_lat, cell_lon), members in self.cells.items():
+                if lat_lo <= cell_lat <= lat_hi and lon_lo <= cell_lon <= lon_hi: candidates.extend(members)
+        else:
+            for cell_lat in range(lat_lo, lat_hi + 1):
+                for cell_lon in range(lon_lo, lon_hi + 1):
+                    members = self.cells.get((cell_lat, cell_lon))
+                    if members: candidates.extend(members)
+        return candidates
+
+    def within_radius(self, lat, lon, radius_m, limit=None):
+        """Елементите на не повече от radius_m метра като [(item, разстояние в метри)], от най-близкия."""
+        d_lat = radius_m / METERS_PER_DEGREE_LAT
+        d_lon = d_lat / max(math.cos(math.radians(lat)), 1e-6)
+        candidates = self._candidates(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon)
+        if not candidates: return []
+        if np is not None:
+            idx = np.frombuffer(candidates, dtype=np.int32)
+            dist = _haversine_numpy(lat, lon, self._np_lats[idx], self._np_lons[idx])
+            inside = np.flatnonzero(dist <= radius_m)
+            order = inside[np.argsort(dist[inside], kind='stable')][:limit]
+            return [(self.items[idx[k]], float(dist[k])) for k in order]
+        dist = _haversine_python(lat, lon, self.lats, self.lons, candidates)
+        found = sorted(((d, i) for d, i in zip(dist, candidates) if d <= radius_m), key=lambda x: x[0])[:limit]
+        return [(self.items[i], d) for d, i in found]
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon, limit=None):
+        """Елементите в правоъгълника [min_lat, max_lat] x [min_lon, max_lon] по реда на добавяне."""
+        candidates = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        if not candidates: return []
+        if np is not None:
+            idx = np.sort(np.frombuffer(candidates, dtype=np.int32))
+            lats, lons = self._np_lats[idx], self._np_lons[idx]
+            inside = idx[(lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)][:limit]
+            return [self.items[i] for i in inside]
+        inside = [i for i in sorted(candidates) if min_lat <= self.lats[i] <= max_lat and min_lon <= self.lons[i] <= max_lon][:limit]
+        return [self.items[i] for i in inside]
+
+
+def haversine_pairs(lats1, lons1, lats2, lons2):
+    """Разстоянията в метри между двойките точки (lats1[i], lons1[i]) и (lats2[i], lons2[i]) като array('d').
+
+    Липсващите координати (NaN) дават NaN.
+    """
+    result = array('d')
+    if np is not None:
+        arrays = [np.frombuffer(a, dtype=np.float64) for a in (lats1, lons1, lats2, lons2)]
+        if len(arrays[0]): result.frombytes(_haversine_numpy(*arrays).tobytes())
+        return result
+    for lat1, lon1, lat2, lon2 in zip(lats1, lons1, lats2, lons2):
+        if math.isnan(lat2) or math.isnan(lat1): result.append(math.nan); continue
+        result.extend(_haversine_python(lat1, lon1, (lat2,), (lon2,), (0,)))
+    return result
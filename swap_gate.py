@@ -0,0 +1,44 @@
+# Файл: swap_gate.py
+import threading
+from contextlib import contextmanager
+
+
+class SwapGate:
+    """Споделен достъп за много читатели и изключителен за един писач, с предимство за чакащия писач.
+
+    Читателите държат вратата за кратко (една заявка, един цикъл); писачът я взима само за самата подмяна.
+    Не е реентрантна: нишка, която вече държи споделен достъп, не бива да го иска отново.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers, self._writer, self._waiting_writers = 0, False, 0
+
+    def acquire_shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+
+    def release_shared(self):
+        with self._condition:
+            self._readers -= 1
+            if not self._readers: self._condition.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try: yield
+        finally: self.release_shared()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting_writers += 1
+            try: self._condition.wait_for(lambda: not self._writer and not self._readers)
+            finally: self._waiting_writers -= 1
+            self._writer = True
+        try: yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()